@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+""" Deterministic generators of synthetic input for benchmarking
+    pyHiCTools: a random genome FASTA, Hi-C FASTQ reads spanning
+    ligation junctions and name-sorted paired SAM with realistic CIGARs.
+"""
+
+import random
+
+
+def make_genome(length, chroms=3, seed=1):
+
+    ''' Return dict of chromosome name to random sequence, with total
+        length split unevenly between chromosomes.
+    '''
+
+    rng = random.Random(seed)
+    weights = [chroms - i for i in range(chroms)]
+    genome = {}
+    for i, weight in enumerate(weights, 1):
+        size = max(1000, length * weight // sum(weights))
+        genome[f'chr{i}'] = ''.join(rng.choices('ACGT', k=size))
+    return genome
+
+
+def write_fasta(path, genome, width=60):
+    with open(path, 'w') as out:
+        for name, seq in genome.items():
+            out.write(f'>{name}\n')
+            for i in range(0, len(seq), width):
+                out.write(f'{seq[i: i + width]}\n')
+
+
+def write_fastq(path, genome, n, restriction='^GATC', read_length=100,
+                junction_rate=0.5, seed=2):
+
+    ''' Write n Hi-C reads. A fraction junction_rate are chimeric,
+        reading from a restriction site on one fragment through the
+        ligation junction into another fragment.
+    '''
+
+    rng = random.Random(seed)
+    site = restriction.replace('^', '')
+    cut = restriction.index('^')
+    junction = site[:len(site) - cut] + site[cut:]
+    names = list(genome)
+    with open(path, 'w') as out:
+        for i in range(n):
+            seq = random_read(rng, genome, names, read_length)
+            if rng.random() < junction_rate:
+                left = rng.randint(10, read_length - len(junction) - 10)
+                seq = (seq[:left] + junction
+                       + random_read(rng, genome, names, read_length))
+                seq = seq[:read_length]
+            out.write(f'@read{i:09d}\n{seq}\n+\n{"K" * len(seq)}\n')
+
+
+def random_read(rng, genome, names, length):
+    seq = genome[rng.choice(names)]
+    start = rng.randrange(len(seq) - length)
+    return seq[start: start + length]
+
+
+def write_sam(path, genome, n, read_length=100, cis_rate=0.7, seed=3):
+
+    ''' Write n name-sorted read pairs. Cis pairs have log-uniform
+        separation; CIGARs include soft clips, insertions and deletions.
+    '''
+
+    rng = random.Random(seed)
+    names = list(genome)
+    with open(path, 'w') as out:
+        out.write('@HD\tVN:1.6\tSO:queryname\n')
+        for name, seq in genome.items():
+            out.write(f'@SQ\tSN:{name}\tLN:{len(seq)}\n')
+        out.write('@PG\tID:generate\tPN:generate\n')
+        for i in range(n):
+            chrom1 = rng.choice(names)
+            pos1 = rng.randint(1, len(genome[chrom1]) - 2 * read_length)
+            if rng.random() < cis_rate:
+                chrom2 = chrom1
+                distance = int(10 ** rng.uniform(2, 6))
+                pos2 = min(pos1 + distance,
+                           len(genome[chrom2]) - 2 * read_length)
+            else:
+                chrom2 = rng.choice(names)
+                pos2 = rng.randint(1, len(genome[chrom2]) - 2 * read_length)
+            reads = [(chrom1, pos1, rng.random() < 0.5),
+                     (chrom2, pos2, rng.random() < 0.5)]
+            for r, (chrom, pos, reverse) in enumerate(reads):
+                mchrom, mpos, mreverse = reads[1 - r]
+                flag = (0x1 | (0x40 if r == 0 else 0x80)
+                        | (0x10 if reverse else 0) | (0x20 if mreverse else 0))
+                rnext = '=' if mchrom == chrom else mchrom
+                tlen = 0
+                if mchrom == chrom:
+                    tlen = (mpos - pos) + (read_length if mpos >= pos
+                                           else -read_length)
+                cigar = random_cigar(rng, read_length)
+                out.write(
+                    f'read{i:09d}\t{flag}\t{chrom}\t{pos}\t60\t{cigar}\t'
+                    f'{rnext}\t{mpos}\t{tlen}\t*\t*\t'
+                    f'NM:i:{rng.randint(0, 3)}\tAS:i:{read_length - i % 10}\n')
+
+
+def random_cigar(rng, length):
+
+    ''' Return a CIGAR of a read of length bases, mostly full matches. '''
+
+    p = rng.random()
+    if p < 0.85:
+        return f'{length}M'
+    clip = rng.randint(5, length // 2)
+    if p < 0.90:
+        return f'{clip}S{length - clip}M'
+    elif p < 0.95:
+        return f'{length - clip}M{clip}S'
+    elif p < 0.98:
+        size = rng.randint(1, 5)
+        return f'{clip}M{size}I{length - clip - size}M'
+    else:
+        return f'{clip}M{rng.randint(1, 20)}D{length - clip}M'
+
+
+def genome_length(pairs):
+
+    ''' Return genome length scaled to the number of read pairs. '''
+
+    return max(100000, 10 * pairs)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+""" Time each pyHiCTools subcommand on synthetic input of several sizes,
+    reporting records per second and peak resident memory, and compare
+    against a stored baseline.
+
+    Example:
+        python benchmarks/run.py --sizes 10000 100000
+        python benchmarks/run.py --save  # Record current results.
+
+    Exits with status 1 if the records per second of any benchmark fall
+    more than --threshold below the baseline, or if there is no baseline
+    to compare against. Baselines are machine specific and are not
+    committed; record one with --save before making changes.
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import argparse
+import subprocess
+import generate
+
+
+BENCHMARKS = ['digest', 'truncate', 'process', 'filter', 'extract']
+
+RESTRICTION = '^GATC'
+
+
+def parse_arguments():
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--sizes', nargs='+', type=int, default=[10000, 100000],
+        help='Numbers of read pairs (and FASTQ reads) to benchmark.')
+    parser.add_argument(
+        '--command', default=f'{sys.executable} '
+        f'{os.path.join(os.path.dirname(here), "bin", "pyHiCTools")}',
+        help='Command used to run pyHiCTools.')
+    parser.add_argument(
+        '--threads', type=int, default=1,
+        help='Threads passed to each subcommand.')
+    parser.add_argument(
+        '--workdir', default=os.path.join(here, 'data'),
+        help='Directory for generated input and output.')
+    parser.add_argument(
+        '--baseline', default=os.path.join(here, 'baseline.json'),
+        help='Stored baseline results.')
+    parser.add_argument(
+        '--threshold', type=float, default=0.2,
+        help='Maximum allowed fractional drop in records per second.')
+    parser.add_argument(
+        '--save', action='store_true',
+        help='Save results as the new baseline.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    os.makedirs(args.workdir, exist_ok=True)
+    command = shlex.split(args.command)
+    results = {}
+    print('benchmark\tsize\trecords\tseconds\trecords_per_sec\tpeak_rss_mb')
+    for size in args.sizes:
+        files = generate_input(args.workdir, size)
+        for name in BENCHMARKS:
+            records, seconds, rss = run_benchmark(
+                command, name, files, args.threads)
+            key = f'{name}:{size}'
+            results[key] = {'records': records, 'seconds': seconds,
+                            'records_per_sec': records / seconds,
+                            'peak_rss_mb': rss}
+            print(f'{name}\t{size}\t{records}\t{seconds:.3f}\t'
+                  f'{records / seconds:.0f}\t{rss:.1f}', flush=True)
+
+    if args.save:
+        with open(args.baseline, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+        print(f'Saved baseline to {args.baseline}.')
+        return 0
+    return compare(results, args.baseline, args.threshold)
+
+
+def generate_input(workdir, size):
+
+    ''' Write synthetic input for size read pairs, reusing existing
+        files as generation is deterministic.
+    '''
+
+    files = {name: os.path.join(workdir, f'{size}.{name}') for name in
+             ['fa', 'fq', 'sam', 'digest', 'processed', 'out']}
+    if not all(os.path.exists(files[name]) for name in ['fa', 'fq', 'sam']):
+        genome = generate.make_genome(generate.genome_length(size))
+        generate.write_fasta(files['fa'], genome)
+        generate.write_fastq(files['fq'], genome, size, RESTRICTION)
+        generate.write_sam(files['sam'], genome, size)
+    return files
+
+
+def run_benchmark(command, name, files, threads):
+
+    ''' Run a benchmark and return records, seconds and peak RSS (MB).
+        Digest and process write the input of later benchmarks.
+    '''
+
+    threads = ['-@', str(threads)]
+    if name == 'digest':
+        args = ['digest', '-r', RESTRICTION, files['fa']]
+        out = files['digest']
+    elif name == 'truncate':
+        args = ['truncate', '-r', RESTRICTION, files['fq']]
+        out = files['out']
+    elif name == 'process':
+        args = ['process', '-d', files['digest'], files['sam']]
+        out = files['processed']
+    elif name == 'filter':
+        args = ['filter', '--min_inward', '1000', '--min_outward', '1000',
+                '--min_ditag', '100', '--max_ditag', '1000',
+                files['processed']]
+        out = files['out']
+    else:
+        args = ['extract', files['processed']]
+        out = files['out']
+    seconds, rss = timed(command + args + threads, out)
+    return count_records(name, files, out), seconds, rss
+
+
+def timed(args, out):
+
+    ''' Run args with stdout to out and return wall time and peak RSS
+        in MB of the child process.
+    '''
+
+    with open(out, 'w') as stdout, open(os.devnull, 'w') as stderr:
+        start = time.perf_counter()
+        child = subprocess.Popen(args, stdout=stdout, stderr=stderr)
+        _, status, usage = os.wait4(child.pid, 0)
+        seconds = time.perf_counter() - start
+    child.returncode = os.waitstatus_to_exitcode(status)
+    if child.returncode:
+        raise subprocess.CalledProcessError(child.returncode, args)
+    return seconds, usage.ru_maxrss / 1024
+
+
+def count_records(name, files, out):
+
+    ''' Return number of input records of a benchmark: fragments for
+        digest, reads for truncate and read pairs otherwise.
+    '''
+
+    if name == 'digest':
+        path, per_record = out, 1
+    elif name == 'truncate':
+        path, per_record = files['fq'], 4
+    else:
+        path, per_record = files['sam'], 2
+    with open(path) as f:
+        lines = sum(1 for line in f if not line.startswith('@')
+                    or name == 'truncate')
+    return lines // per_record
+
+
+def compare(results, baseline, threshold):
+
+    ''' Return 1 if any result regressed beyond threshold of baseline
+        or if there is no baseline.
+    '''
+
+    if not os.path.exists(baseline):
+        print(f'ERROR: No baseline at {baseline}; run with --save to '
+              f'create one.', file=sys.stderr)
+        return 1
+    with open(baseline) as f:
+        previous = json.load(f)
+    failed = []
+    for key, result in results.items():
+        if key not in previous:
+            print(f'WARNING: {key} not in baseline; not compared.',
+                  file=sys.stderr)
+            continue
+        ratio = result['records_per_sec'] / previous[key]['records_per_sec']
+        if ratio < 1 - threshold:
+            failed.append(f'{key}: {ratio:.0%} of baseline records/sec.')
+    for failure in failed:
+        print(f'REGRESSION {failure}', file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -69,7 +69,8 @@ setup(
     url='https://github.com/StephenRicher/pyHiCTools',
     scripts=['bin/pyHiCTools'],
     python_requires='>=3.6.0',
-    install_requires=['pyCommonTools>=2.0'],
+    install_requires=['pyCommonTools>=2.0', 'numpy'],
+    extras_require={'bam': ['pysam'], 'cool': ['h5py']},
     license='MIT',
     classifiers=[
         'Development Status :: 3 - Alpha',
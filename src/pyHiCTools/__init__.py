@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
 
-import pyHiCTools.main
-import pyHiCTools.digest
-import pyHiCTools.truncate
-import pyHiCTools.map
-import pyHiCTools.deduplicate
-import pyHiCTools.process
-import pyHiCTools.extract
-import pyHiCTools.filter
-import pyHiCTools.valid_pair
+""" Submodules are imported on first attribute access (e.g.
+    pyHiCTools.process) rather than here, so the command line only
+    imports the implementation of the subcommand it runs.
+"""
+
+import importlib
+
+
+def __getattr__(name):
+    try:
+        return importlib.import_module(f'{__name__}.{name}')
+    except ModuleNotFoundError as error:
+        if error.name != f'{__name__}.{name}':
+            raise
+        raise AttributeError(
+            f'module {__name__} has no attribute {name}') from None
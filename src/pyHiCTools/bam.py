@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+""" Read and write name-sorted BAM files directly with pysam.
+    BGZF compression and decompression is multithreaded by htslib and
+    tags are read and written in binary form, avoiding the SAM text
+    round trip of piping through samtools view.
+"""
+
+import os
+import sys
+import gzip
+import pyCommonTools as pct
+from pyHiCTools import instrument
+from pyHiCTools.reader import check_mates
+
+
+BAM_MAGIC = b'BAM\x01'
+
+
+def is_bam(path):
+
+    ''' Return True if path is a BAM file. Standard input is never
+        sniffed, as pysam reads it by file descriptor and would miss
+        any bytes buffered by Python; BAM on stdin requires --bam.
+    '''
+
+    if path == '-' or not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        if f.read(2) != b'\x1f\x8b':
+            return False
+    try:
+        with gzip.open(path) as f:
+            return f.read(len(BAM_MAGIC)) == BAM_MAGIC
+    except OSError:
+        return False
+
+
+def use_pysam(infile, bam):
+
+    ''' Return True if input or output should be handled by pysam. '''
+
+    return bam or is_bam(infile)
+
+
+def open_input(infile, threads=1):
+
+    ''' Open SAM or BAM input, detecting the format from its content. '''
+
+    import pysam
+    return pysam.AlignmentFile(infile, 'r', threads=threads)
+
+
+def open_output(template, threads=1, bam=True):
+
+    ''' Open BAM (or SAM) output to stdout with the header of template. '''
+
+    import pysam
+    mode = 'wb' if bam else 'w'
+    return pysam.AlignmentFile('-', mode, template=template, threads=threads)
+
+
+def read_segment_batches(in_bam, batch_size, keep=None):
+
+    ''' Yield lists of up to batch_size read pairs from a name-sorted
+        AlignmentFile (or iterable of segments), with each pair as two
+        adjacent segments. If given, only pairs with a query name
+        accepted by keep are read.
+    '''
+
+    log = pct.create_logger()
+
+    segments = iter(in_bam)
+    if keep is not None:
+        segments = (segment for segment in segments
+                    if keep(segment.query_name))
+    batch = []
+    for segment in segments:
+        mate = next(segments, None)
+        if mate is None:
+            log.error('Odd number of alignments in file.')
+            sys.exit(1)
+        check_mates(segment.query_name, mate.query_name)
+        batch.append(segment)
+        batch.append(mate)
+        if len(batch) >= 2 * batch_size:
+            instrument.advance(len(batch), in_bam)
+            yield batch
+            batch = []
+    if batch:
+        instrument.advance(len(batch), in_bam)
+        yield batch
+
+
+def get_optional(segment, tags):
+
+    ''' Return dict of pct.Sam style optional keys (e.g. "dt:i") to tag
+        values of segment.
+    '''
+
+    return {tag: segment.get_tag(tag[:2]) for tag in tags}
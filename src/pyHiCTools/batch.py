@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+""" Run pyHiCTools pipeline over many samples listed in a sample sheet.
+    The digest is loaded once and shared read-only with the sample
+    processes, several samples run at once within the --threads core
+    budget, and the QC of all samples is written as one table.
+
+    The sample sheet has one tab-separated "sample path" line per
+    sample; blank lines and lines starting with "#" are ignored. Each
+    sample writes {outdir}/{sample}.sam (or .bam) and its QC to
+    {outdir}/{sample}.qc once it completes. Samples with a QC file are
+    skipped, so an interrupted batch can be rerun to resume it.
+"""
+
+import os
+import sys
+import multiprocessing
+import multiprocessing.connection
+import pyCommonTools as pct
+from pyHiCTools import instrument
+from pyHiCTools.pipeline import pipeline
+from pyHiCTools.digest_index import load_digest
+from pyHiCTools.mates import MAX_PENDING
+
+
+def batch(sheet, digest, qc, min_inward, min_outward, min_ditag, max_ditag,
+          outdir='.', jobs=None, threads=1, extract=False, batch_size=None,
+          bam=False, unsorted=False, max_pending=MAX_PENDING, expr=None):
+
+    log = pct.create_logger()
+
+    samples = read_sheet(sheet)
+    jobs = min(jobs or threads, len(samples)) or 1
+    options = {
+        'min_inward': min_inward, 'min_outward': min_outward,
+        'min_ditag': min_ditag, 'max_ditag': max_ditag, 'expr': expr,
+        'batch_size': batch_size, 'bam': bam, 'unsorted': unsorted,
+        'max_pending': max_pending, 'threads': max(1, threads // jobs)}
+
+    os.makedirs(outdir, exist_ok=True)
+    pending = []
+    for sample, infile in samples:
+        if os.path.exists(qc_path(outdir, sample)):
+            log.info(f'Skipping completed sample {sample}.')
+        else:
+            pending.append((sample, infile))
+
+    failed = []
+    if pending:
+        # Loaded once and inherited by each sample process.
+        d = load_digest(digest)
+        failed = run_samples(pending, d, outdir, extract, options, jobs)
+
+    with pct.open(qc, stderr = True, mode = 'w') as qc_out:
+        for sample, infile in samples:
+            path = qc_path(outdir, sample)
+            if os.path.exists(path):
+                instrument.write_qc_rows(qc_out, sample, read_qc(path))
+
+    if failed:
+        log.error(f'{len(failed)} samples failed: {", ".join(failed)}.')
+        sys.exit(1)
+
+
+def read_sheet(sheet):
+
+    ''' Return list of (sample, path) of a sample sheet. '''
+
+    log = pct.create_logger()
+
+    samples = []
+    with pct.open(sheet) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 2 or not all(fields):
+                log.error(f'Line {number} of {sheet} is not a tab-separated '
+                          'sample and path.')
+                sys.exit(1)
+            samples.append(tuple(fields))
+    names = [sample for sample, infile in samples]
+    for sample in names:
+        if os.sep in sample or sample.startswith('.'):
+            log.error(f'Invalid sample name {sample} in {sheet}.')
+            sys.exit(1)
+        if names.count(sample) > 1:
+            log.error(f'Duplicate sample name {sample} in {sheet}.')
+            sys.exit(1)
+    if not samples:
+        log.error(f'No samples in {sheet}.')
+        sys.exit(1)
+    return samples
+
+
+def qc_path(outdir, sample):
+    return os.path.join(outdir, f'{sample}.qc')
+
+
+def read_qc(path):
+
+    ''' Return (label, value) rows of a QC file of a single sample. '''
+
+    with open(path) as f:
+        return [tuple(line.rstrip('\n').split('\t')[1:]) for line in f]
+
+
+def run_samples(samples, digest, outdir, extract, options, jobs):
+
+    ''' Run pipeline on each sample in a separate process with at most
+        jobs running at once. Returns names of failed samples.
+    '''
+
+    log = pct.create_logger()
+
+    queue = list(reversed(samples))
+    running = {}
+    failed = []
+    while queue or running:
+        while queue and len(running) < jobs:
+            sample, infile = queue.pop()
+            log.info(f'Running sample {sample}.')
+            process = multiprocessing.Process(
+                target=run_sample,
+                args=(sample, infile, digest, outdir, extract, options))
+            process.start()
+            running[process.sentinel] = (sample, process)
+        for sentinel in multiprocessing.connection.wait(list(running)):
+            sample, process = running.pop(sentinel)
+            process.join()
+            path = qc_path(outdir, sample)
+            if process.exitcode == 0:
+                # The QC file marks the sample as complete.
+                os.replace(f'{path}.tmp', path)
+                log.info(f'Completed sample {sample}.')
+            else:
+                log.error(f'Sample {sample} failed with exit code '
+                          f'{process.exitcode}.')
+                failed.append(sample)
+    return failed
+
+
+def run_sample(sample, infile, digest, outdir, extract, options):
+
+    ''' Run pipeline on one sample with stdout redirected to the sample
+        output file. Runs in a child process.
+    '''
+
+    suffix = 'bam' if options['bam'] else 'sam'
+    output = os.path.join(outdir, f'{sample}.{suffix}')
+    with open(output, 'wb') as out:
+        # pysam writes BAM output to the stdout file descriptor.
+        sys.stdout.flush()
+        os.dup2(out.fileno(), sys.stdout.fileno())
+    if extract:
+        extract = os.path.join(outdir, f'{sample}.extract.tsv')
+    pipeline(infile, digest, f'{qc_path(outdir, sample)}.tmp', sample,
+             extract=extract or None, **options)
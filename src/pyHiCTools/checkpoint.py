@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+""" Checkpointed output for long runs of pyHiCTools process and filter.
+
+    Output is written to numbered segment files in the checkpoint
+    directory. Each segment is sealed (flushed, synced and renamed) once
+    it holds output of --checkpoint_interval read pairs, after which the
+    input offset of the next unread line (a BGZF virtual offset for
+    compressed input) and the cumulative QC counts are recorded in
+    checkpoint.json. A run restarted with --resume discards any unsealed
+    output, seeks the input to the recorded offset and continues, so the
+    output and QC are identical to an uninterrupted run. Once complete,
+    the segments are written to stdout in order and removed.
+"""
+
+import os
+import sys
+import glob
+import json
+import shutil
+import collections
+import pyCommonTools as pct
+from pyHiCTools.reader import read_batches
+from pyHiCTools.bam import use_pysam
+from pyHiCTools.compress import is_bgzf, BgzfReader
+
+
+# Read pairs per sealed segment.
+CHECKPOINT_INTERVAL = 10000000
+
+STATE = 'checkpoint.json'
+
+
+class Checkpoint:
+
+    ''' Segmented output and input position of a checkpointed run.
+        Options identify the run; resuming with different options or
+        a modified input is refused.
+    '''
+
+    def __init__(self, directory, infile, options, resume=False,
+                 interval=CHECKPOINT_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.reader = open_reader(infile)
+        self.run = {
+            'input': [os.path.realpath(infile), *input_stat(infile)],
+            'options': options}
+        self.counts = collections.Counter()
+        self.segment = 0
+        self.offset = 0
+        self.complete = False
+        self.pending = collections.deque()
+        self.restore(resume)
+        self.out = None
+        self.pairs = 0
+
+    def restore(self, resume):
+        log = pct.create_logger()
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, STATE)
+        if not os.path.exists(path):
+            if resume:
+                log.info(f'No checkpoint in {self.directory}; starting '
+                         'from the beginning.')
+            self.remove_segments()
+            return
+        if not resume:
+            log.error(f'{self.directory} holds a checkpoint of a previous '
+                      'run; use --resume to continue it.')
+            sys.exit(1)
+        with open(path) as f:
+            state = json.load(f)
+        if state['run'] != json.loads(json.dumps(self.run)):
+            log.error(f'Checkpoint in {self.directory} was written with '
+                      'different input or options.')
+            sys.exit(1)
+        self.segment = state['segment']
+        self.offset = state['offset']
+        self.complete = state['complete']
+        self.counts.update(state['counts'])
+        self.remove_segments(after=self.segment)
+        self.reader.seek(self.offset)
+        log.info(f'Resuming after segment {self.segment} at input offset '
+                 f'{self.offset}.')
+
+    def segments(self):
+        return sorted(glob.glob(
+            os.path.join(glob.escape(self.directory), 'segment.*')))
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, f'segment.{number:06d}')
+
+    def remove_segments(self, after=0):
+        for path in self.segments():
+            number = os.path.basename(path).split('.')[1]
+            if path.endswith('.tmp') or int(number) > after:
+                os.remove(path)
+
+    def chunks(self, batch_size, keep=None):
+
+        ''' Yield chunks of read_batches from the resumed input offset,
+            recording the offset after each.
+        '''
+
+        if self.complete:
+            return
+        lines = (line.decode() for line in iter(self.reader.readline, b''))
+        for chunk in read_batches(lines, batch_size, keep):
+            self.pending.append((self.reader.tell(), len(chunk[1]) // 2))
+            yield chunk
+
+    def write(self, out):
+
+        ''' Write output of the next chunk from chunks. The caller must
+            update counts with the chunk before writing it.
+        '''
+
+        offset, pairs = self.pending.popleft()
+        if self.out is None:
+            path = self.segment_path(self.segment + 1)
+            self.out = open(f'{path}.tmp', 'w')
+        self.out.write(out)
+        self.offset = offset
+        self.pairs += pairs
+        if self.pairs >= self.interval:
+            self.seal()
+
+    def seal(self):
+
+        ''' Seal the current segment and record the checkpoint. '''
+
+        if self.out is None:
+            return
+        self.out.flush()
+        os.fsync(self.out.fileno())
+        self.out.close()
+        self.out = None
+        self.segment += 1
+        path = self.segment_path(self.segment)
+        os.replace(f'{path}.tmp', path)
+        self.pairs = 0
+        self.save()
+
+    def save(self):
+        path = os.path.join(self.directory, STATE)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump({'run': self.run, 'segment': self.segment,
+                       'offset': self.offset, 'complete': self.complete,
+                       'counts': self.counts}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{path}.tmp', path)
+
+    def finish(self):
+
+        ''' Seal the last segment, then write all segments to stdout
+            and remove the checkpoint.
+        '''
+
+        self.seal()
+        self.complete = True
+        self.save()
+        self.reader.close()
+        for path in self.segments():
+            with open(path) as segment:
+                shutil.copyfileobj(segment, sys.stdout)
+        sys.stdout.flush()
+        os.remove(os.path.join(self.directory, STATE))
+        for path in self.segments():
+            os.remove(path)
+
+
+def open_checkpoint(directory, infile, options, resume=False,
+                    interval=CHECKPOINT_INTERVAL, bam=False, pairs=None,
+                    unsorted=False):
+
+    ''' Return Checkpoint of a run or exit if the run cannot be
+        checkpointed.
+    '''
+
+    log = pct.create_logger()
+
+    if use_pysam(infile, bam):
+        log.error('--checkpoint requires SAM input and output.')
+        sys.exit(1)
+    elif pairs or unsorted:
+        log.error('--checkpoint cannot be used with --pairs, --decay or '
+                  '--unsorted.')
+        sys.exit(1)
+    return Checkpoint(directory, infile, options, resume, interval)
+
+
+def open_reader(infile):
+
+    ''' Return seekable binary line reader of a SAM or BGZF SAM file. '''
+
+    log = pct.create_logger()
+
+    if infile == '-' or not os.path.isfile(infile):
+        log.error('--checkpoint requires input from a file.')
+        sys.exit(1)
+    with open(infile, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    if not compressed:
+        return open(infile, 'rb')
+    if is_bgzf(infile):
+        return BgzfReader(infile)
+    log.error(f'{infile} is gzip compressed and cannot be resumed; '
+              'compress SAM input with bgzip for --checkpoint.')
+    sys.exit(1)
+
+
+def input_stat(infile):
+
+    stat = os.stat(infile)
+    return [stat.st_size, stat.st_mtime_ns]
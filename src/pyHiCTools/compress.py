@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+""" Compress independent blocks of output as gzip members or BGZF
+    blocks. Concatenated members form a valid gzip (or BGZF) file, so
+    blocks can be compressed in parallel by worker processes and written
+    in order by the parent.
+"""
+
+import zlib
+import gzip
+import struct
+from pyHiCTools import instrument
+
+
+# Maximum uncompressed bytes per BGZF block, as used by htslib.
+BGZF_BLOCK_SIZE = 65280
+
+# Empty BGZF block marking end of file.
+BGZF_EOF = bytes.fromhex(
+    '1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+@instrument.timed
+def compress(data, compression, level=6):
+
+    ''' Return data compressed as one gzip member or a series of BGZF
+        blocks.
+    '''
+
+    if compression == 'gzip':
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    elif compression == 'bgzf':
+        return b''.join(
+            bgzf_block(data[i: i + BGZF_BLOCK_SIZE], level)
+            for i in range(0, len(data), BGZF_BLOCK_SIZE))
+    else:
+        raise ValueError(f'Unknown compression {compression}.')
+
+
+def bgzf_block(data, level=6):
+
+    ''' Return a single BGZF block of at most BGZF_BLOCK_SIZE bytes. '''
+
+    for block_level in (level, 0):
+        deflate = zlib.compressobj(block_level, zlib.DEFLATED, -15)
+        compressed = deflate.compress(data) + deflate.flush()
+        # Block size minus one must fit in 16 bits.
+        if len(compressed) + 26 <= 65536:
+            break
+    header = struct.pack(
+        '<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+        ord('B'), ord('C'), 2, len(compressed) + 25)
+    footer = struct.pack('<II', zlib.crc32(data), len(data))
+    return header + compressed + footer
+
+
+def finish(out, compression):
+
+    ''' Write any end-of-file marker required by compression. '''
+
+    if compression == 'bgzf':
+        out.write(BGZF_EOF)
+
+
+def is_bgzf(path):
+
+    ''' Return True if path begins with a BGZF block. '''
+
+    with open(path, 'rb') as f:
+        header = f.read(16)
+    return (len(header) == 16 and header[:4] == b'\x1f\x8b\x08\x04'
+            and header[12:14] == b'BC')
+
+
+class BgzfReader:
+
+    ''' Read lines of a BGZF file with tell and seek of BGZF virtual
+        offsets, the compressed offset of a block shifted left 16 bits
+        plus the uncompressed offset within the block.
+    '''
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.data = b''
+        self.pos = 0
+        self.block_start = 0
+        self.next_block = 0
+
+    def load(self, start):
+
+        ''' Decompress the block at start. Returns False at end of file. '''
+
+        self.file.seek(start)
+        self.block_start = self.next_block = start
+        self.data = b''
+        self.pos = 0
+        header = self.file.read(12)
+        if not header:
+            return False
+        xlen, = struct.unpack('<H', header[10:12])
+        extra = self.file.read(xlen)
+        bsize = None
+        i = 0
+        while i + 4 <= xlen:
+            length, = struct.unpack('<H', extra[i + 2: i + 4])
+            if extra[i: i + 2] == b'BC':
+                bsize, = struct.unpack('<H', extra[i + 4: i + 6])
+            i += 4 + length
+        if header[:4] != b'\x1f\x8b\x08\x04' or bsize is None:
+            raise ValueError(f'Invalid BGZF block at offset {start}.')
+        self.data = zlib.decompress(self.file.read(bsize - xlen - 19), -15)
+        self.file.read(8)
+        self.next_block = start + bsize + 1
+        return True
+
+    def readline(self):
+        parts = []
+        while True:
+            if self.pos >= len(self.data):
+                if not self.load(self.next_block):
+                    break
+                continue
+            end = self.data.find(b'\n', self.pos)
+            if end == -1:
+                parts.append(self.data[self.pos:])
+                self.pos = len(self.data)
+                continue
+            parts.append(self.data[self.pos: end + 1])
+            self.pos = end + 1
+            break
+        return b''.join(parts)
+
+    def tell(self):
+        return (self.block_start << 16) | self.pos
+
+    def seek(self, offset):
+        self.load(offset >> 16)
+        self.pos = offset & 0xFFFF
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+""" Summarise contact probability against genomic separation, P(s), and
+    cis/trans interactions per chromosome of pairs processed by
+    pyHiCTools process. Separations (insert sizes) of cis pairs are
+    counted in log-spaced bins per chromosome and orientation, and trans
+    pairs are counted once for each of their chromosomes. Chunks are
+    summarised by worker processes and merged. The table has one row
+    per non-empty bin, with the count and contact probability (count
+    per base pair of bin width, as a fraction of the cis pairs of the
+    chromosome), and a row of trans pairs per chromosome and
+    orientation.
+"""
+
+import sys
+import numpy as np
+import pyCommonTools as pct
+from pyHiCTools.reader import read_batches, pairs, get_tags, CHUNK_SIZE
+from pyHiCTools.parallel import imap_chunks, Writer
+from pyHiCTools.bam import use_pysam, open_input, read_segment_batches
+from pyHiCTools.process import ORIENTATIONS
+from pyHiCTools.histogram import LogHistogram
+from pyHiCTools.subsample import make_subsample
+
+
+BINS_PER_DECADE = 10
+
+DECAY_TAGS = ['or:Z', 'it:Z', 'is:i']
+
+HEADER = ('sample\tchromosome\tinteraction_type\torientation\tlower\t'
+          'upper\tcount\tprobability\n')
+
+
+def decay(infile, sample=None, threads=1, subsample=None, seed=0,
+          bam=False):
+
+    if not sample:
+        sample = 'stdin' if infile == '-' else infile
+    keep = make_subsample(subsample, seed)
+
+    summary = Decay()
+    if use_pysam(infile, bam):
+        with open_input(infile, threads) as in_bam:
+            summary.set_chroms(in_bam.references, in_bam.lengths)
+            for segments in read_segment_batches(in_bam, CHUNK_SIZE, keep):
+                summary.add_segments(segments)
+    else:
+        with pct.open(infile) as f:
+            chunks = read_batches(f, CHUNK_SIZE, keep)
+            for chunk_summary in imap_chunks(decay_chunk, chunks, threads):
+                summary.merge(chunk_summary)
+    with Writer(sys.stdout) as out:
+        summary.write(out, sample)
+
+
+def decay_chunk(chunk):
+
+    ''' Return Decay of a chunk from read_batches. '''
+
+    summary = Decay()
+    is_header, lines = chunk
+    if is_header:
+        summary.add_header(lines)
+    else:
+        summary.add_lines(lines)
+    return summary
+
+
+class Decay:
+
+    ''' Mergeable log-binned separation counts of cis pairs, and counts
+        of trans pairs, per chromosome and orientation.
+    '''
+
+    def __init__(self, bins_per_decade=BINS_PER_DECADE):
+        self.bins_per_decade = bins_per_decade
+        self.histogram = LogHistogram((len(ORIENTATIONS),), bins_per_decade)
+        self.cis = {}
+        self.trans = {}
+        # Chromosomes in order of the SAM/BAM header.
+        self.chroms = {}
+
+    def set_chroms(self, names, lengths):
+        self.chroms.update(dict.fromkeys(names))
+
+    def add_header(self, lines):
+
+        ''' Add chromosomes of SAM @SQ header lines. '''
+
+        for line in lines:
+            if line.startswith('@SQ'):
+                fields = dict(field.split(':', 1)
+                              for field in line.rstrip('\n').split('\t')[1:])
+                self.set_chroms([fields['SN']], [int(fields['LN'])])
+
+    def add_lines(self, lines):
+
+        ''' Add processed SAM lines of complete pairs. '''
+
+        chroms1, chroms2, tags = [], [], []
+        for line1, line2 in pairs(lines):
+            chroms1.append(line1.split('\t', 3)[2])
+            chroms2.append(line2.split('\t', 3)[2])
+            tags.append(get_tags(line1, DECAY_TAGS))
+        self.add(chroms1, chroms2, tags)
+
+    def add_segments(self, segments):
+
+        ''' Add processed pysam segments of complete pairs. '''
+
+        chroms1, chroms2, tags = [], [], []
+        for read1, read2 in pairs(segments):
+            chroms1.append(read1.reference_name)
+            chroms2.append(read2.reference_name)
+            tags.append({tag: read1.get_tag(tag[:2]) for tag in DECAY_TAGS})
+        self.add(chroms1, chroms2, tags)
+
+    def add(self, chroms1, chroms2, tags):
+
+        ''' Add pairs given the chromosome of each read and the optional
+            tag dicts of read 1.
+        '''
+
+        if not tags:
+            return
+        orientations = {name: i for i, name in enumerate(ORIENTATIONS)}
+        orientation = np.array([orientations[tag['or:Z']] for tag in tags])
+        cis = np.array([tag['it:Z'] == 'cis' for tag in tags])
+        insert_size = np.array([tag['is:i'] for tag in tags])
+        chroms1 = np.array(chroms1)
+        chroms2 = np.array(chroms2)
+
+        names, index = np.unique(chroms1[cis], return_inverse=True)
+        histogram = LogHistogram(
+            (len(names), len(ORIENTATIONS)), self.bins_per_decade)
+        histogram.add(insert_size[cis], index, orientation[cis])
+        for name, counts in zip(names, histogram.counts):
+            self.cis_counts(str(name))[:] += counts
+
+        # Each trans pair counts towards both of its chromosomes.
+        trans_chroms = np.concatenate([chroms1[~cis], chroms2[~cis]])
+        trans_orientation = np.tile(orientation[~cis], 2)
+        names, index = np.unique(trans_chroms, return_inverse=True)
+        counts = np.zeros((len(names), len(ORIENTATIONS)), dtype=np.int64)
+        np.add.at(counts, (index, trans_orientation), 1)
+        for name, chrom_counts in zip(names, counts):
+            self.trans_counts(str(name))[:] += chrom_counts
+
+    def cis_counts(self, chrom):
+        if chrom not in self.cis:
+            self.cis[chrom] = np.zeros_like(self.histogram.counts)
+        return self.cis[chrom]
+
+    def trans_counts(self, chrom):
+        if chrom not in self.trans:
+            self.trans[chrom] = np.zeros(len(ORIENTATIONS), dtype=np.int64)
+        return self.trans[chrom]
+
+    def merge(self, other):
+        if other.bins_per_decade != self.bins_per_decade:
+            raise ValueError('Cannot merge decays with different bins.')
+        self.set_chroms(other.chroms, [])
+        for chrom, counts in other.cis.items():
+            self.cis_counts(chrom)[:] += counts
+        for chrom, counts in other.trans.items():
+            self.trans_counts(chrom)[:] += counts
+        return self
+
+    def rows(self, sample):
+
+        ''' Yield table rows of each chromosome, in header order and
+            then sorted by name.
+        '''
+
+        histogram = self.histogram
+        widths = np.array(
+            [np.inf if histogram.upper(b) is None
+             else histogram.upper(b) - histogram.lower(b) + 1
+             for b in range(histogram.counts.shape[-1])])
+        chroms = [chrom for chrom in self.chroms
+                  if chrom in self.cis or chrom in self.trans]
+        chroms += sorted(
+            (set(self.cis) | set(self.trans)).difference(self.chroms))
+        for chrom in chroms:
+            counts = self.cis.get(chrom)
+            if counts is not None:
+                probability = counts / counts.sum() / widths
+                for (o, b), count in np.ndenumerate(counts):
+                    if count:
+                        upper = histogram.upper(b)
+                        yield (f'{sample}\t{chrom}\tcis\t{ORIENTATIONS[o]}\t'
+                               f'{histogram.lower(b)}\t'
+                               f'{"inf" if upper is None else upper}\t'
+                               f'{count}\t{probability[o, b]:.6g}\n')
+            counts = self.trans.get(chrom)
+            if counts is not None:
+                for o, count in enumerate(counts):
+                    if count:
+                        yield (f'{sample}\t{chrom}\ttrans\t{ORIENTATIONS[o]}'
+                               f'\tNA\tNA\t{count}\tNA\n')
+
+    def write(self, out, sample):
+        out.write(HEADER)
+        out.write(''.join(self.rows(sample)))
+
+
+class DecayWriter(Decay):
+
+    ''' Accumulate a Decay of processed read pairs and write its table to
+        path on close. Accepts the calls of pairs_file.PairsWriter, so
+        it can be used as a side output of process and filter. Pairs are
+        buffered and added CHUNK_SIZE at a time, as callers may pass
+        them one by one.
+    '''
+
+    def __init__(self, path, sample, bins_per_decade=BINS_PER_DECADE):
+        super().__init__(bins_per_decade)
+        self.path = path
+        self.sample = sample
+        self.lines = []
+        self.segments = []
+
+    def add_sam(self, text):
+
+        ''' Add processed SAM text of header lines and complete pairs. '''
+
+        lines = text.splitlines()
+        self.add_header([line for line in lines if line.startswith('@')])
+        self.lines.extend(line for line in lines if not line.startswith('@'))
+        if len(self.lines) >= 2 * CHUNK_SIZE:
+            self.flush()
+
+    def add_segments(self, segments):
+        self.segments.extend(segments)
+        if len(self.segments) >= 2 * CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+
+        ''' Add buffered pairs. '''
+
+        self.add_lines(self.lines)
+        super().add_segments(self.segments)
+        self.lines = []
+        self.segments = []
+
+    def close(self):
+        self.flush()
+        with pct.open(self.path, mode='w') as out:
+            self.write(out, self.sample)
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+""" Remove PCR duplicate read pairs from named-sorted SAM/BAM files
+    processed by pyHiCTools process. Pairs are duplicates if both ends
+    share chromosome, 5' position and strand, in either mate order, and
+    the first pair in file order is kept.
+
+    Each pair is reduced to a 64 bit hash of its ends. Hashes are held
+    as sorted arrays in memory until --max_keys is reached; after that
+    the remaining pairs are spooled to disk and their hashes spilled as
+    sorted runs, partitioned by hash prefix, which are merged one
+    partition at a time to find the duplicates among the spooled pairs.
+"""
+
+import os
+import sys
+import hashlib
+import tempfile
+import functools
+import collections
+import numpy as np
+import pyCommonTools as pct
+from contextlib import ExitStack
+from pyHiCTools import instrument
+from pyHiCTools.reader import read_batches, CHUNK_SIZE
+from pyHiCTools.parallel import imap_chunks
+from pyHiCTools.process import parse_batch, segment_columns
+from pyHiCTools.bam import (
+    use_pysam, open_input, open_output, read_segment_batches)
+
+
+# Pair hashes held in memory (8 bytes each) before spilling to disk.
+MAX_KEYS = 50000000
+
+# Spilled runs are split into 2 ** PARTITION_BITS files by hash prefix.
+PARTITION_BITS = 8
+
+RUN_DTYPE = np.dtype([('hash', '<u8'), ('index', '<i8')])
+
+
+def deduplicate(infile, qc, sample, max_keys=MAX_KEYS, threads=1,
+                bam=False):
+
+    if not sample:
+        if infile == '-':
+            sample = 'stdin'
+        else:
+            sample = infile
+
+    with ExitStack() as stack:
+        tmpdir = stack.enter_context(tempfile.TemporaryDirectory())
+        keys = KeySet(max_keys, tmpdir)
+        if use_pysam(infile, bam):
+            deduplicate_bam(infile, keys, threads, bam)
+        else:
+            deduplicate_sam(stack.enter_context(pct.open(infile)),
+                            keys, threads)
+
+    write_qc(qc, sample, keys.counts)
+
+
+def deduplicate_sam(in_obj, keys, threads):
+
+    ''' Write non-duplicate pairs of SAM input to stdout. '''
+
+    chunks = read_batches(in_obj, CHUNK_SIZE)
+    spool_path = os.path.join(keys.tmpdir, 'spool.sam')
+    with open(spool_path, 'w') as spool:
+        for is_header, lines, hashes in imap_chunks(
+                hash_chunk, chunks, threads):
+            if is_header:
+                sys.stdout.write(''.join(lines))
+                continue
+            duplicate = keys.add(hashes)
+            if duplicate is None:
+                spool.writelines(lines)
+            else:
+                sys.stdout.write(''.join(unique_lines(lines, duplicate)))
+    if not keys.spooled:
+        return
+    duplicate = keys.spooled_duplicates()
+    with open(spool_path) as spool:
+        start = 0
+        for is_header, lines in read_batches(spool, CHUNK_SIZE):
+            end = start + len(lines) // 2
+            sys.stdout.write(''.join(
+                unique_lines(lines, duplicate[start:end])))
+            start = end
+
+
+def deduplicate_bam(infile, keys, threads, bam):
+
+    ''' Write non-duplicate pairs of SAM/BAM input with pysam. '''
+
+    spool_path = os.path.join(keys.tmpdir, 'spool.bam')
+    with open_input(infile, threads) as in_bam, \
+            open_output(in_bam, threads, bam) as out_bam:
+        spool = None
+        for segments in read_segment_batches(in_bam, CHUNK_SIZE):
+            columns = segment_columns(segments, in_bam.references)
+            duplicate = keys.add(pair_hashes(columns))
+            if duplicate is None:
+                if spool is None:
+                    import pysam
+                    spool = pysam.AlignmentFile(
+                        spool_path, 'wb', template=in_bam, threads=threads)
+                for segment in segments:
+                    spool.write(segment)
+                continue
+            for segment in unique_lines(segments, duplicate):
+                out_bam.write(segment)
+        if spool is None:
+            return
+        spool.close()
+        duplicate = keys.spooled_duplicates()
+        with open_input(spool_path, threads) as spooled:
+            start = 0
+            for segments in read_segment_batches(spooled, CHUNK_SIZE):
+                end = start + len(segments) // 2
+                for segment in unique_lines(
+                        segments, duplicate[start:end]):
+                    out_bam.write(segment)
+                start = end
+
+
+def unique_lines(records, duplicate):
+
+    ''' Return records of pairs not marked duplicate. '''
+
+    return [record for i in np.flatnonzero(~duplicate)
+            for record in records[2 * i: 2 * i + 2]]
+
+
+def hash_chunk(chunk):
+
+    ''' Return (is_header, lines, pair hashes) of a chunk from
+        read_batches. Lines are returned with their hashes, as the
+        input is read by one consumer only.
+    '''
+
+    is_header, lines = chunk
+    if is_header:
+        return is_header, lines, None
+    return is_header, lines, pair_hashes(parse_batch(lines))
+
+
+@functools.lru_cache(maxsize=None)
+def chrom_hash(name):
+
+    return int.from_bytes(
+        hashlib.blake2b(name.encode(), digest_size=8).digest(), 'little')
+
+
+def mix(x):
+
+    ''' Vectorised splitmix64 finaliser of uint64 values. '''
+
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def pair_hashes(columns):
+
+    ''' Return 64 bit hash of the (chromosome, 5' position, strand) of
+        both ends of each pair of parse_batch columns, independent of
+        mate order.
+    '''
+
+    chroms = np.array([chrom_hash(name) for name in columns['names']],
+                      dtype=np.uint64)
+    five_prime = np.where(
+        columns['reverse'], columns['right'], columns['left'])
+    ends = mix(chroms[columns['rname']] ^ (
+        (five_prime.astype(np.uint64) << np.uint64(1))
+        | columns['reverse'].astype(np.uint64)))
+    low = np.minimum(ends[0::2], ends[1::2])
+    high = np.maximum(ends[0::2], ends[1::2])
+    return mix(low ^ mix(high))
+
+
+class KeySet:
+
+    ''' Set of pair hashes seen so far, held as sorted arrays of
+        geometrically decreasing size until max_keys is exceeded, then
+        spilled with the hashes of all later pairs to partitioned runs
+        on disk.
+    '''
+
+    def __init__(self, max_keys, tmpdir):
+        self.max_keys = max_keys
+        self.tmpdir = tmpdir
+        self.levels = []
+        self.size = 0
+        self.spooled = 0
+        self.buffer = []
+        self.counts = collections.Counter()
+
+    def add(self, hashes):
+
+        ''' Return boolean array marking duplicate pairs of a batch, or
+            None if the batch must be spooled to disk.
+        '''
+
+        self.counts['total'] += len(hashes)
+        if self.spooled or self.size + len(hashes) > self.max_keys:
+            self.spool(hashes)
+            return None
+        keys, first = np.unique(hashes, return_index=True)
+        seen = np.zeros(len(keys), dtype=bool)
+        for level in self.levels:
+            i = np.minimum(np.searchsorted(level, keys), len(level) - 1)
+            seen |= level[i] == keys
+        duplicate = np.ones(len(hashes), dtype=bool)
+        duplicate[first[~seen]] = False
+        self.insert(keys[~seen])
+        self.counts['duplicate'] += int(duplicate.sum())
+        return duplicate
+
+    def insert(self, keys):
+        if not len(keys):
+            return
+        self.levels.append(keys)
+        self.size += len(keys)
+        while (len(self.levels) > 1
+                and len(self.levels[-2]) <= 2 * len(self.levels[-1])):
+            last = self.levels.pop()
+            self.levels[-1] = np.sort(np.concatenate([self.levels[-1], last]))
+
+    def spool(self, hashes):
+        if not self.spooled:
+            # Keys seen before spooling precede every spooled pair.
+            self.buffer = [
+                run_records(level, np.full(len(level), -1, dtype=np.int64))
+                for level in self.levels]
+            self.levels = []
+            self.size = sum(len(run) for run in self.buffer)
+        self.buffer.append(run_records(hashes, np.arange(
+            self.spooled, self.spooled + len(hashes), dtype=np.int64)))
+        self.spooled += len(hashes)
+        self.size += len(hashes)
+        if self.size >= self.max_keys:
+            self.spill()
+
+    def spill(self):
+
+        ''' Write buffered hashes as a sorted run to partition files. '''
+
+        if not self.buffer:
+            return
+        run = np.concatenate(self.buffer)
+        run.sort(order=['hash', 'index'])
+        partition = run['hash'] >> np.uint64(64 - PARTITION_BITS)
+        bounds = np.searchsorted(partition, np.arange(2 ** PARTITION_BITS + 1))
+        for p in range(2 ** PARTITION_BITS):
+            if bounds[p] < bounds[p + 1]:
+                with open(self.partition_path(p), 'ab') as out:
+                    run[bounds[p]: bounds[p + 1]].tofile(out)
+        self.buffer = []
+        self.size = 0
+
+    def partition_path(self, partition):
+        return os.path.join(self.tmpdir, f'keys.{partition}.bin')
+
+    def spooled_duplicates(self):
+
+        ''' Merge the runs of each partition and return boolean array
+            marking duplicate spooled pairs.
+        '''
+
+        self.spill()
+        duplicate = np.zeros(self.spooled, dtype=bool)
+        for p in range(2 ** PARTITION_BITS):
+            path = self.partition_path(p)
+            if not os.path.exists(path):
+                continue
+            run = np.fromfile(path, dtype=RUN_DTYPE)
+            os.remove(path)
+            run.sort(order=['hash', 'index'], kind='stable')
+            repeat = np.empty(len(run), dtype=bool)
+            repeat[0] = False
+            repeat[1:] = run['hash'][1:] == run['hash'][:-1]
+            duplicate[run['index'][repeat]] = True
+        self.counts['duplicate'] += int(duplicate.sum())
+        return duplicate
+
+
+def run_records(hashes, index):
+
+    run = np.empty(len(hashes), dtype=RUN_DTYPE)
+    run['hash'] = hashes
+    run['index'] = index
+    return run
+
+
+def write_qc(qc, sample, counts):
+
+    ''' Write QC in the format of pyHiCTools filter. '''
+
+    total = counts['total']
+    duplicate = counts['duplicate']
+    rows = [
+        ('Total', total),
+        ('Retained', total - duplicate),
+        ('Filtered', duplicate),
+        ('Duplicate', duplicate)]
+    with pct.open(qc, stderr = True, mode = 'w') as qc_out:
+        instrument.write_qc_rows(qc_out, sample, rows)
@@ -6,64 +6,266 @@
 '''
 
 import re
+import os
 import sys
+import mmap
+import array
+import multiprocessing
 import pyCommonTools as pct
+from pyHiCTools.digest_index import write_index
 
 
-def digest(infile, restriction):
+# Regular expression character classes of IUPAC degenerate bases.
+IUPAC = {
+    'R': '[AG]', 'Y': '[CT]', 'S': '[GC]', 'W': '[AT]', 'K': '[GT]',
+    'M': '[AC]', 'B': '[CGT]', 'D': '[AGT]', 'H': '[ACT]', 'V': '[ACG]',
+    'N': '[ACGT]',
+}
+
+# Fragments formatted per write of digest output.
+WRITE_FRAGMENTS = 65536
+
+
+def digest(infile, restriction, threads=1, chunk_size=1048576, index=None):
 
     ''' Iterate through each infile. '''
 
-    log = pct.create_logger()
+    d = {}
+    for ref, error, ends in scan_fasta(
+            infile, restriction, threads, chunk_size):
+        # Fragment ends are only kept for the index.
+        if not write_digest(ref, error, ends) and index:
+            d.setdefault(ref, array.array('q')).extend(ends)
+    if index:
+        write_index(index, d)
 
-    with pct.open(infile) as in_obj:
 
-        header = 1
-        for index, line in enumerate(in_obj):
-            if line.startswith('>'):
-                if header > 1:
-                    find_cut_sites(''.join(seqs), ref, restriction)
-                ref = line.rsplit()[0][1:]
+def scan_fasta(infile, restriction, threads=1, chunk_size=1048576):
+
+    ''' Yield (ref, error, fragment ends) of each reference of a FASTA
+        file, with error as returned by CutSiteScanner.finish. References
+        of seekable files are digested in parallel.
+    '''
+
+    log = pct.create_logger()
+
+    if threads > 1 and is_seekable(infile):
+        regions = index_fasta(infile)
+        jobs = [(infile, ref, start, end, restriction, chunk_size)
+                for ref, start, end in regions]
+        with multiprocessing.Pool(threads) as pool:
+            for result in pool.imap(digest_region, jobs):
+                log.info(f'Digesting reference {result[0]}.')
+                yield result
+    else:
+        if threads > 1:
+            log.info('Input is not a seekable FASTA file - '
+                     'digesting with a single process.')
+        with pct.open(infile) as in_obj:
+            for ref, chunks in read_fasta(in_obj, chunk_size):
                 log.info(f'Digesting reference {ref}.')
-                header += 1
-                seqs = []
-            elif header == 1 and index == 0:
-                log.error(f'FASTA line 1 does not begin with ">".')
-                sys.exit(1)
-            else:
-                seqs.append(line.upper().strip('\n'))
-        find_cut_sites(''.join(seqs), ref, restriction)
+                scanner = CutSiteScanner(restriction)
+                for chunk in chunks:
+                    scanner.feed(chunk)
+                yield ref, scanner.finish(ref), scanner.ends
 
 
 def find_cut_sites(ref_seq, ref, restriction):
 
+    scanner = CutSiteScanner(restriction)
+    scanner.feed(ref_seq)
+    return write_digest(ref, scanner.finish(ref), scanner.ends)
+
+
+def write_digest(ref, error, ends):
+
+    ''' Write digest of a single reference or log why it failed. '''
+
     log = pct.create_logger()
 
-    if not ref_seq:
-        log.error(f'Reference {ref} contains no sequence.')
-        ec = 1
-    elif invalid_seq(ref_seq):
-        log.error(f'Invalid FASTA character in {ref}.')
-        ec = 1
-    else:
-        overhang = restriction.index('^')
-        site = restriction.replace('^', '')
-        matches = re.finditer(site, ref_seq)
-        index = 0
-        previous_end = 0
-        for match in matches:
+    if error:
+        log.error(error)
+        return 1
+    for out in digest_lines(ref, ends):
+        sys.stdout.write(out)
+    return 0
+
+
+def digest_lines(ref, ends, fragments=WRITE_FRAGMENTS):
+
+    ''' Yield the BED-like digest of fragment ends of ref as text of up
+        to fragments lines at a time.
+    '''
+
+    previous_end = 0
+    for i in range(0, len(ends), fragments):
+        lines = []
+        for index, end in enumerate(ends[i: i + fragments], i + 1):
+            lines.append(f'{ref}\t{previous_end + 1}\t{end}\t{index}\n')
+            previous_end = end
+        yield ''.join(lines)
+
+
+class CutSiteScanner:
+
+    ''' Find restriction cut sites in a reference sequence supplied
+        as consecutive chunks. A site-length overlap is carried between
+        chunks so that sites spanning a chunk boundary are found exactly
+        once, in the same order as re.finditer on the whole sequence.
+        Only fragment end positions are kept; the text digest is
+        formatted from them by digest_lines.
+    '''
+
+    def __init__(self, restriction):
+        self.overhang = restriction.index('^')
+        self.site = restriction.replace('^', '')
+        self.pattern = re.compile(iupac_pattern(self.site))
+        self.carry = ''
+        self.offset = 0
+        self.length = 0
+        self.invalid = False
+        self.ends = array.array('q')
+
+    def feed(self, chunk):
+        self.length += len(chunk)
+        if self.invalid or invalid_seq(chunk):
+            self.invalid = True
+            return
+        buffer = self.carry + chunk
+        keep_from = max(0, len(buffer) - len(self.site) + 1)
+        for match in self.pattern.finditer(buffer):
+            keep_from = max(keep_from, match.end())
             # Skip if restriction sequence at start of reference.
-            if match.start() == 0:
+            if self.offset + match.start() == 0:
                 continue
-            index += 1
-            start = 1 if index == 1 else previous_end + 1
-            end = match.start() + overhang
-            sys.stdout.write(f'{ref}\t{start}\t{end}\t{index}\n')
-            previous_end = end
-        sys.stdout.write(
-            f'{ref}\t{previous_end + 1}\t{len(ref_seq)}\t{index + 1}\n')
-        ec = 0
-    return ec
+            self.ends.append(self.offset + match.start() + self.overhang)
+        self.carry = buffer[keep_from:]
+        self.offset += keep_from
+
+    def finish(self, ref):
+
+        ''' Add the final fragment and return None, or an error message
+            if ref is empty or invalid.
+        '''
+
+        if not self.length:
+            return f'Reference {ref} contains no sequence.'
+        elif self.invalid:
+            return f'Invalid FASTA character in {ref}.'
+        self.ends.append(self.length)
+        return None
+
+
+def read_fasta(in_obj, chunk_size):
+
+    ''' Yield (ref, chunks) for each FASTA record, where chunks is an
+        iterator of upper-case sequence of roughly chunk_size. Each
+        chunks iterator must be consumed before advancing to the next
+        record.
+    '''
+
+    log = pct.create_logger()
+
+    lines = iter(in_obj)
+    line = next(lines, None)
+    if line is None:
+        return
+    if not line.startswith('>'):
+        log.error(f'FASTA line 1 does not begin with ">".')
+        sys.exit(1)
+    while line is not None:
+        ref = line.rsplit()[0][1:]
+
+        def chunks():
+            nonlocal line
+            seqs = []
+            size = 0
+            for line in lines:
+                if line.startswith('>'):
+                    break
+                seq = line.upper().strip('\n')
+                seqs.append(seq)
+                size += len(seq)
+                if size >= chunk_size:
+                    yield ''.join(seqs)
+                    seqs = []
+                    size = 0
+            else:
+                line = None
+            if seqs:
+                yield ''.join(seqs)
+
+        record = chunks()
+        yield ref, record
+        # Exhaust the record if the caller did not.
+        for _ in record:
+            pass
+
+
+def is_seekable(infile):
+
+    ''' Return True if infile is an uncompressed regular file. '''
+
+    return (infile != '-' and os.path.isfile(infile)
+            and not infile.endswith('.gz'))
+
+
+def index_fasta(infile):
+
+    ''' Return (ref, start, end) byte offsets of the sequence belonging
+        to each FASTA record, in reference order.
+    '''
+
+    log = pct.create_logger()
+
+    regions = []
+    with open(infile, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return regions
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:1] != b'>':
+                log.error(f'FASTA line 1 does not begin with ">".')
+                sys.exit(1)
+            headers = [match.start()
+                       for match in re.finditer(rb'^>', mm, re.MULTILINE)]
+            headers.append(len(mm))
+            for header, next_header in zip(headers, headers[1:]):
+                header_end = mm.find(b'\n', header, next_header)
+                header_end = next_header if header_end == -1 else header_end
+                line = mm[header:header_end].decode()
+                ref = line.rsplit()[0][1:]
+                regions.append(
+                    (ref, min(header_end + 1, next_header), next_header))
+    return regions
+
+
+def digest_region(job):
+
+    ''' Digest the sequence of one reference from a byte range of a
+        FASTA file. Run in a worker process.
+    '''
+
+    infile, ref, start, end, restriction, chunk_size = job
+    scanner = CutSiteScanner(restriction)
+    with open(infile, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = f.read(min(chunk_size, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            scanner.feed(block.replace(b'\n', b'').decode('latin-1').upper())
+    return ref, scanner.finish(ref), scanner.ends
+
+
+def iupac_pattern(seq):
+
+    ''' Return regular expression matching a sequence which may
+        contain IUPAC degenerate bases.
+    '''
+
+    return ''.join(IUPAC.get(base, base) for base in seq.upper())
 
 
 def invalid_seq(seq):
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+""" Cache of binary digest indexes computed on demand from a FASTA
+    reference and restriction enzyme, so pyHiCTools process can run
+    without a separately generated (and possibly mismatched) digest.
+
+    Entries are named by the content hash of the reference and the
+    restriction site, so the same genome is digested once however it is
+    named. Each entry records the path, size and mtime of the reference
+    it was built from, so later runs find it without rehashing. Entries
+    are evicted least recently used first once the cache exceeds its
+    size limit.
+"""
+
+import os
+import sys
+import glob
+import array
+import pyCommonTools as pct
+from pyHiCTools.digest import scan_fasta
+from pyHiCTools.digest_index import (
+    write_index, read_header, file_hash, source_stat, SUFFIX)
+
+
+# Cache size limit in megabytes.
+CACHE_SIZE = 2048
+
+
+def resolve_digest(digest, reference=None, restriction=None, threads=1,
+                   cache_dir=None, cache_size=CACHE_SIZE):
+
+    ''' Return digest, or the path of the cached index of reference
+        digested with restriction if digest is None.
+    '''
+
+    log = pct.create_logger()
+
+    if digest is not None:
+        if reference or restriction:
+            log.error('Use either --digest or --reference with '
+                      '--restriction, not both.')
+            sys.exit(1)
+        return digest
+    if not (reference and restriction):
+        log.error('Either --digest or --reference with --restriction '
+                  'is required.')
+        sys.exit(1)
+    if not os.path.isfile(reference):
+        log.error(f'Reference {reference} must be a FASTA file.')
+        sys.exit(1)
+    return cached_digest(reference, restriction, threads,
+                         cache_dir or default_cache_dir(), cache_size)
+
+
+def default_cache_dir():
+    cache_home = os.environ.get(
+        'XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.environ.get(
+        'PYHICTOOLS_CACHE', os.path.join(cache_home, 'pyHiCTools'))
+
+
+def cached_digest(reference, restriction, threads, cache_dir, cache_size):
+
+    ''' Return path of the cached index of reference digested with
+        restriction, digesting and caching it if needed.
+    '''
+
+    log = pct.create_logger()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    site = restriction.replace('^', '_')
+    source = [os.path.realpath(reference), *source_stat(reference)]
+    path = find_entry(cache_dir, site, source)
+    if path is None:
+        path = os.path.join(
+            cache_dir, f'{file_hash(reference)}.{site}.{SUFFIX}')
+        if not os.path.exists(path):
+            log.info(f'Digesting {reference} with {restriction} '
+                     f'into {path}.')
+            write_index(path, digest_reference(
+                reference, restriction, threads), source=source)
+            evict(cache_dir, cache_size, keep=path)
+    log.info(f'Loading cached digest index {path}.')
+    # Modification time orders entries for LRU eviction.
+    os.utime(path)
+    return path
+
+
+def find_entry(cache_dir, site, source):
+
+    ''' Return path of entry for site built from source or None. '''
+
+    for candidate in glob.glob(
+            os.path.join(glob.escape(cache_dir), f'*.{site}.{SUFFIX}')):
+        try:
+            header = read_header(candidate)
+        except (OSError, ValueError):
+            # Entry evicted, or being written, by another process.
+            continue
+        if header and header[0]['source'] == source:
+            return candidate
+    return None
+
+
+def digest_reference(reference, restriction, threads):
+
+    ''' Return dict of reference -> fragment end positions. '''
+
+    log = pct.create_logger()
+
+    d = {}
+    for ref, error, ends in scan_fasta(reference, restriction, threads):
+        if error:
+            log.error(error)
+            sys.exit(1)
+        d.setdefault(ref, array.array('q')).extend(ends)
+    return d
+
+
+def evict(cache_dir, cache_size, keep):
+
+    ''' Remove least recently used entries, except keep, until the cache
+        is no larger than cache_size megabytes.
+    '''
+
+    log = pct.create_logger()
+
+    entries = []
+    for path in glob.glob(
+            os.path.join(glob.escape(cache_dir), f'*.{SUFFIX}')):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime_ns, stat.st_size, path))
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= cache_size * 1024 * 1024:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        log.info(f'Evicted {path} from digest cache.')
+        total -= size
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+""" Read and write a compact binary restriction digest index.
+
+    The index stores, for each reference, the sorted end position of
+    every restriction fragment. Arrays are memory-mapped on load so
+    startup is independent of digest size and pages are shared between
+    processes reading the same index.
+
+    Layout: 8 byte magic, 8 byte little-endian header length, JSON
+    header (dtype, source file stat and chromosome table of name, offset
+    and fragment count) padded to 8 bytes, then the concatenated arrays.
+"""
+
+import os
+import json
+import mmap
+import glob
+import array
+import struct
+import hashlib
+import tempfile
+import contextlib
+import numpy as np
+import pyCommonTools as pct
+from pyHiCTools import instrument
+
+
+MAGIC = b'PHTDIGI\x01'
+SUFFIX = 'pht'
+
+
+def write_index(path, digest, source=None):
+
+    ''' Write dict of reference -> fragment end positions to path.
+        Written to a temporary file and renamed so readers never see a
+        partial index.
+    '''
+
+    end_max = max((ends[-1] for ends in digest.values() if len(ends)),
+                  default=0)
+    dtype = np.dtype('<u4') if end_max < 2**32 else np.dtype('<i8')
+    refs = []
+    offset = 0
+    for ref, ends in digest.items():
+        refs.append([ref, offset, len(ends)])
+        offset += len(ends) * dtype.itemsize
+    header = json.dumps(
+        {'dtype': dtype.str, 'source': source, 'refs': refs}).encode()
+    header += b' ' * (-(len(MAGIC) + 8 + len(header)) % 8)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(MAGIC)
+            out.write(struct.pack('<Q', len(header)))
+            out.write(header)
+            for ends in digest.values():
+                out.write(np.asarray(ends, dtype=dtype).tobytes())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def read_header(path):
+
+    ''' Return (header dict, data offset) of index or None if path is
+        not a binary digest index.
+    '''
+
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return None
+        size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(size))
+    return header, len(MAGIC) + 8 + size
+
+
+def read_index(path):
+
+    ''' Memory-map index and return dict of reference -> read-only
+        array of fragment end positions.
+    '''
+
+    header, data_offset = read_header(path)
+    dtype = np.dtype(header['dtype'])
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    d = {}
+    for ref, offset, count in header['refs']:
+        d[ref] = np.frombuffer(
+            buffer, dtype=dtype, count=count, offset=data_offset + offset)
+    return d
+
+
+def is_index(path):
+
+    if path == '-' or not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+@instrument.timed
+def load_digest(path):
+
+    ''' Return dict of reference -> fragment end positions from either
+        a binary index or a text digest. Text digests are converted once
+        and cached next to the text file, keyed by content hash.
+    '''
+
+    log = pct.create_logger()
+
+    if is_index(path):
+        return read_index(path)
+    if path == '-':
+        with pct.open(path) as digest:
+            return as_arrays(process_digest(digest))
+
+    cached = find_cached_index(path)
+    if cached:
+        log.info(f'Loading cached digest index {cached}.')
+        return read_index(cached)
+
+    with pct.open(path) as digest:
+        d = process_digest(digest)
+    cache = f'{path}.{file_hash(path)}.{SUFFIX}'
+    try:
+        write_index(cache, d, source=source_stat(path))
+        log.info(f'Cached digest index to {cache}.')
+    except OSError as e:
+        log.warning(f'Unable to cache digest index: {e}')
+        return as_arrays(d)
+    # Remove indexes cached from previous versions of the digest.
+    for stale in glob.glob(f'{glob.escape(path)}.*.{SUFFIX}'):
+        if stale != cache:
+            # May already be removed by a concurrent run.
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(stale)
+    return read_index(cache)
+
+
+def find_cached_index(path):
+
+    ''' Return path of a valid cached index of text digest or None.
+        A cache whose recorded source size and mtime match is trusted
+        without rehashing; otherwise the content hash is checked and
+        the cache rewritten with the new size and mtime.
+    '''
+
+    log = pct.create_logger()
+
+    candidates = glob.glob(f'{glob.escape(path)}.*.{SUFFIX}')
+    if not candidates:
+        return None
+    stat = source_stat(path)
+    for candidate in candidates:
+        header = read_header(candidate)
+        if header and header[0]['source'] == stat:
+            return candidate
+    cache = f'{path}.{file_hash(path)}.{SUFFIX}'
+    if cache not in candidates:
+        return None
+    try:
+        write_index(cache, read_index(cache), source=stat)
+    except OSError as e:
+        log.warning(f'Unable to update cached digest index: {e}')
+    return cache
+
+
+def source_stat(path):
+
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def file_hash(path, blocksize=1048576):
+
+    ''' Return truncated SHA-256 hex digest of file contents. '''
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()[:16]
+
+
+def as_arrays(digest):
+
+    return {ref: np.frombuffer(ends, dtype=np.int64)
+            for ref, ends in digest.items()}
+
+
+def process_digest(digest):
+
+    ''' Parse a text digest into dict of reference -> array of
+        fragment end positions.
+    '''
+
+    log = pct.create_logger()
+
+    d = {}
+    for fragment in digest:
+        [ref, start, end, number] = fragment.split()
+        if not (int(start) > 0 and int(end) > 0):
+            log.error(f'Negative fragment start/end positions on ref {ref}.')
+        if ref not in d.keys():
+            if not (int(start) == 1 and int(number) == 1):
+                log.error(f'Invalid first fragment in ref {ref}.')
+            d[ref] = array.array('q')
+        d[ref].append(int(end))
+    return d
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+""" Estimate pyHiCTools filter thresholds from processed read pairs in
+    constant memory. Insert sizes of cis pairs are counted in log-spaced
+    bins per orientation. Once pairs are far enough apart that ligation
+    is random, Inward and Outward pairs each make up a quarter of the
+    pairs of a bin; --min_inward and --min_outward are the smallest
+    insert sizes beyond which their proportions stay within --tolerance
+    of this. --min_ditag and --max_ditag are the bounds of the
+    log-binned ditag lengths outside the --quantile tails. Sketches of
+    several inputs, or of earlier runs saved with --save, are merged.
+"""
+
+import sys
+import numpy as np
+import pyCommonTools as pct
+from pyHiCTools.reader import read_batches, CHUNK_SIZE
+from pyHiCTools.parallel import imap_chunks
+from pyHiCTools.bam import use_pysam
+from pyHiCTools.extract import read_stats, stats_chunk
+from pyHiCTools.process import ORIENTATIONS, INTERACTIONS
+from pyHiCTools.histogram import LogHistogram
+
+
+BINS_PER_DECADE = 10
+
+# Proportion of each of Inward and Outward pairs at large insert sizes.
+RANDOM_PROPORTION = 0.25
+
+
+def estimate(infiles, sample=None, threads=1, sketches=None, save=None,
+             max_pairs=None, quantile=0.01, tolerance=0.025, min_count=1000,
+             bam=False):
+
+    log = pct.create_logger()
+
+    if not 0 < quantile < 0.5:
+        log.error('--quantile must be between 0 and 0.5.')
+        sys.exit(1)
+    if not (infiles or sketches):
+        infiles = ['-']
+    if not sample:
+        sample = ('stdin' if infiles == ['-']
+                  else ','.join(infiles or sketches))
+
+    sketch = Sketch()
+    for path in sketches or []:
+        sketch.merge(Sketch.load(path))
+    for infile in infiles:
+        sketch.merge(file_sketch(infile, threads, max_pairs, bam))
+    if save:
+        sketch.save(save)
+    if not sketch.ditag_length.counts.sum():
+        log.error('No read pairs to estimate thresholds from.')
+        sys.exit(1)
+
+    thresholds = sketch.thresholds(quantile, tolerance, min_count)
+    for name in ['min_inward', 'min_outward']:
+        if thresholds[name] is None:
+            log.warning(f'Proportion of {name[4:].capitalize()} pairs did '
+                        f'not converge; more pairs or a larger --tolerance '
+                        f'are needed to estimate --{name}.')
+    sys.stdout.write(''.join(
+        f'{sample}\t{name}\t{"NA" if value is None else value}\n'
+        for name, value in thresholds.items()))
+
+
+def file_sketch(infile, threads=1, max_pairs=None, bam=False):
+
+    ''' Return Sketch of the first max_pairs read pairs of infile. '''
+
+    sketch = Sketch()
+    if use_pysam(infile, bam):
+        for stats in read_stats(infile, threads, bam=bam):
+            if max_pairs is not None:
+                stats = {column: values[:max_pairs - sketch.pairs]
+                         for column, values in stats.items()}
+            sketch.add(stats)
+            if sketch.pairs == max_pairs:
+                break
+        return sketch
+
+    with pct.open(infile) as f:
+        chunks = limit_pairs(read_batches(f, CHUNK_SIZE), max_pairs)
+        for chunk_sketch in imap_chunks(sketch_chunk, chunks, threads):
+            sketch.merge(chunk_sketch)
+    return sketch
+
+
+def limit_pairs(chunks, max_pairs=None):
+
+    ''' Yield chunks of read_batches up to a total of max_pairs pairs. '''
+
+    if max_pairs is None:
+        yield from chunks
+        return
+    remaining = max_pairs
+    for is_header, lines in chunks:
+        if not is_header:
+            lines = lines[:2 * remaining]
+            remaining -= len(lines) // 2
+        yield is_header, lines
+        if not remaining:
+            return
+
+
+def sketch_chunk(chunk):
+
+    ''' Return Sketch of a chunk from read_batches. '''
+
+    sketch = Sketch()
+    stats = stats_chunk(chunk)
+    if stats is not None:
+        sketch.add(stats)
+    return sketch
+
+
+class Sketch:
+
+    ''' Mergeable log-binned histograms of insert size of cis pairs per
+        orientation and of ditag length of all pairs.
+    '''
+
+    def __init__(self, bins_per_decade=BINS_PER_DECADE):
+        self.bins_per_decade = bins_per_decade
+        self.insert_size = LogHistogram(
+            (len(ORIENTATIONS),), bins_per_decade)
+        self.ditag_length = LogHistogram((), bins_per_decade)
+
+    @property
+    def pairs(self):
+        return int(self.ditag_length.counts.sum())
+
+    def add(self, stats):
+        cis = stats['interaction'] == INTERACTIONS.index('cis')
+        self.insert_size.add(
+            stats['insert_size'][cis], stats['orientation'][cis])
+        self.ditag_length.add(stats['ditag_length'])
+        return self
+
+    def merge(self, other):
+        if not np.array_equal(self.ditag_length.edges,
+                              other.ditag_length.edges):
+            raise ValueError('Cannot merge sketches with different bins.')
+        self.insert_size.merge(other.insert_size)
+        self.ditag_length.merge(other.ditag_length)
+        return self
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, edges=self.ditag_length.edges,
+                     bins_per_decade=self.bins_per_decade,
+                     insert_size=self.insert_size.counts,
+                     ditag_length=self.ditag_length.counts)
+
+    @classmethod
+    def load(cls, path):
+        log = pct.create_logger()
+        with np.load(path) as data:
+            sketch = cls(int(data.get('bins_per_decade', BINS_PER_DECADE)))
+            if ('edges' not in data or not np.array_equal(
+                    sketch.ditag_length.edges, data['edges'])):
+                log.error(f'{path} is not a pyHiCTools estimate sketch.')
+                sys.exit(1)
+            sketch.insert_size.counts += data['insert_size']
+            sketch.ditag_length.counts += data['ditag_length']
+        return sketch
+
+    def proportions(self, min_count=1):
+
+        ''' Return array of proportion of each orientation per insert
+            size bin, with bins of fewer than min_count pairs masked.
+        '''
+
+        counts = self.insert_size.counts
+        totals = counts.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            proportions = counts / totals
+        return np.ma.masked_array(
+            proportions, np.broadcast_to(totals < min_count, counts.shape))
+
+    def converged(self, orientation, tolerance, min_count):
+
+        ''' Return lower bound of the first insert size bin after which
+            the proportion of orientation stays within tolerance of
+            RANDOM_PROPORTION, or None if it does not converge.
+        '''
+
+        proportions = self.proportions(min_count)[
+            ORIENTATIONS.index(orientation)]
+        bins = np.flatnonzero(~np.ma.getmaskarray(proportions))
+        if not len(bins):
+            return None
+        outside = np.abs(
+            proportions.data[bins] - RANDOM_PROPORTION) > tolerance
+        if outside[-1]:
+            return None
+        # First bin of the final run of bins within tolerance.
+        first = bins[len(outside) - np.argmax(outside[::-1])] \
+            if outside.any() else bins[0]
+        return self.insert_size.lower(first)
+
+    def thresholds(self, quantile=0.01, tolerance=0.025, min_count=1000):
+
+        ''' Return dict of recommended filter thresholds. '''
+
+        ditag = self.ditag_length
+        return {
+            'min_inward': self.converged('Inward', tolerance, min_count),
+            'min_outward': self.converged('Outward', tolerance, min_count),
+            'min_ditag': ditag.lower(ditag.quantile_bin(quantile)),
+            'max_ditag': ditag.upper(ditag.quantile_bin(1 - quantile)),
+        }
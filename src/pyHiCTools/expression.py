@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+
+""" Compile filter expressions over the HiC tags written by pyHiCTools
+    process into predicates evaluated on columnar arrays of read pairs.
+
+    Expressions compare the tags dt (ditag length), is (insert size),
+    fs (fragment separation), fn (fragment number of the first read),
+    or (orientation) and it (interaction type) with numbers, quoted
+    strings and + - * / arithmetic, combined with and, or, not and
+    parentheses, e.g.
+
+        fs > 0 and (or != 'Inward' or is >= 1000) and dt <= 1000
+
+    A read pair is retained if the expression is true. Each top-level
+    "and" term is a clause and pairs are counted against the first
+    clause they fail.
+"""
+
+import re
+import collections
+import numpy as np
+from pyHiCTools.process import ORIENTATIONS, INTERACTIONS
+
+
+# Numeric tags and the batch_filter column holding them.
+NUMERIC_TAGS = {
+    'dt': ('dt:i', 'ditag_length'),
+    'is': ('is:i', 'insert_size'),
+    'fs': ('fs:i', 'fragment_seperation'),
+    'fn': ('fn:i', 'read1_fragment'),
+}
+
+# Categorical tags, their batch_filter column and category names.
+CATEGORICAL_TAGS = {
+    'or': ('or:Z', 'orientation', ORIENTATIONS),
+    'it': ('it:Z', 'interaction', INTERACTIONS),
+}
+
+TOKEN = re.compile(
+    r'\s*(?:(?P<number>\d+(?:\.\d*)?)'
+    r'|(?P<string>\'[^\']*\'|"[^"]*")'
+    r'|(?P<word>[A-Za-z_]\w*)'
+    r'|(?P<operator><=|>=|==|!=|<|>|[-+*/()]))')
+
+COMPARATORS = {
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+}
+
+ARITHMETIC = {
+    '+': lambda a, b: a + b,
+    '-': lambda a, b: a - b,
+    '*': lambda a, b: a * b,
+    '/': lambda a, b: a / b,
+}
+
+# A clause of a filter expression: source text, SAM tags read and a
+# predicate returning a boolean array from a dict of columns.
+Clause = collections.namedtuple('Clause', ['text', 'tags', 'predicate'])
+
+# A parsed sub-expression. Kind is 'bool', 'number', 'string' or the
+# name of a categorical tag; start and end index the source text.
+Term = collections.namedtuple(
+    'Term', ['evaluate', 'kind', 'tags', 'start', 'end'])
+
+
+def compile_clauses(expressions):
+
+    ''' Return list of Clause of each expression. Raises ValueError if
+        an expression is invalid.
+    '''
+
+    clauses = []
+    for text in expressions:
+        clauses.extend(Parser(text).clauses())
+    return clauses
+
+
+def clause_tags(clauses):
+
+    ''' Return SAM tags read by any clause. '''
+
+    return sorted({tag for clause in clauses for tag in clause.tags})
+
+
+def tag_columns(optionals, tags):
+
+    ''' Return dict of batch_filter style columns of the requested tags
+        from a list of optional tag dicts, as returned by get_tags.
+    '''
+
+    columns = {}
+    for tag, column in NUMERIC_TAGS.values():
+        if tag in tags:
+            columns[column] = np.array(
+                [optional[tag] for optional in optionals], dtype=np.int64)
+    for tag, column, categories in CATEGORICAL_TAGS.values():
+        if tag in tags:
+            codes = {name: i for i, name in enumerate(categories)}
+            columns[column] = np.array(
+                [codes[optional[tag]] for optional in optionals],
+                dtype=np.int8)
+    return columns
+
+
+def first_failed(clauses, columns, reasons, offset):
+
+    ''' Set reasons of pairs not yet failed (0) to offset plus the
+        index of the first clause they fail. Returns reasons.
+    '''
+
+    for i, clause in enumerate(clauses):
+        keep = np.asarray(clause.predicate(columns), dtype=bool)
+        reasons[(reasons == 0) & ~keep] = offset + i
+    return reasons
+
+
+class Parser:
+
+    ''' Recursive descent parser of a single filter expression. The
+        tag names "or" and "is" are Python keywords, so the expression
+        is parsed here rather than with the ast module: a word is a tag
+        where an operand is expected and an operator otherwise.
+    '''
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = list(tokenise(text))
+        self.pos = 0
+
+    def clauses(self):
+        terms = self.conjunction()
+        if self.accept('word', 'or'):
+            term = all_of(terms)
+            while True:
+                term = either(term, all_of(self.conjunction()))
+                if not self.accept('word', 'or'):
+                    break
+            terms = [term]
+        if self.pos < len(self.tokens):
+            self.error('unexpected', self.tokens[self.pos])
+        return [Clause(self.text[term.start:term.end], term.tags,
+                       term.evaluate) for term in terms]
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def accept(self, kind, value=None):
+        token = self.peek()
+        if (token is not None and token[0] == kind
+                and (value is None or token[1] == value)):
+            self.pos += 1
+            return token
+        return None
+
+    def accept_any(self, kind, values):
+        token = self.peek()
+        if token is not None and token[0] == kind and token[1] in values:
+            self.pos += 1
+            return token
+        return None
+
+    def expect(self, kind, value=None):
+        token = self.accept(kind, value)
+        if token is None:
+            self.error(f'expected "{value or kind}" but found', self.peek())
+        return token
+
+    def error(self, message, token):
+        if token is None:
+            raise ValueError(
+                f'Invalid expression "{self.text}": {message} end of input.')
+        raise ValueError(f'Invalid expression "{self.text}": {message} '
+                         f'"{token[1]}" at position {token[2] + 1}.')
+
+    def disjunction(self):
+        term = all_of(self.conjunction())
+        while self.accept('word', 'or'):
+            term = either(term, all_of(self.conjunction()))
+        return term
+
+    def conjunction(self):
+        terms = [self.boolean(self.negation())]
+        while self.accept('word', 'and'):
+            terms.append(self.boolean(self.negation()))
+        return terms
+
+    def boolean(self, term):
+        if term.kind != 'bool':
+            raise ValueError(
+                f'Invalid expression "{self.text}": '
+                f'"{self.text[term.start:term.end]}" is not a comparison.')
+        return term
+
+    def negation(self):
+        token = self.accept('word', 'not')
+        if token is None:
+            return self.comparison()
+        term = self.boolean(self.negation())
+        evaluate = term.evaluate
+        return Term(lambda columns: np.logical_not(evaluate(columns)),
+                    'bool', term.tags, token[2], term.end)
+
+    def comparison(self):
+        left = self.sum()
+        result = None
+        while True:
+            token = self.accept_any('operator', COMPARATORS)
+            if token is None:
+                break
+            right = self.sum()
+            term = self.compare(left, token, right)
+            result = term if result is None else all_of([result, term])
+            left = right
+        return left if result is None else result
+
+    def compare(self, left, token, right):
+        operator = token[1]
+        if left.kind in CATEGORICAL_TAGS or right.kind in CATEGORICAL_TAGS:
+            if left.kind == 'string':
+                left, right = right, left
+            if right.kind != 'string' or operator not in ('==', '!='):
+                self.error(f'{left.kind} can only be compared with == or '
+                           '!= to a quoted string, not with', token)
+            categories = CATEGORICAL_TAGS[left.kind][2]
+            value = right.evaluate(None)
+            if value not in categories:
+                raise ValueError(
+                    f'Invalid expression "{self.text}": {left.kind} must '
+                    f'be one of {", ".join(categories)}, not "{value}".')
+            right = constant(categories.index(value), right)
+        elif left.kind != 'number' or right.kind != 'number':
+            self.error('cannot compare non-numeric values with', token)
+        return combine(COMPARATORS[operator], left, right, 'bool')
+
+    def sum(self):
+        left = self.product()
+        while True:
+            token = self.accept_any('operator', ('+', '-'))
+            if token is None:
+                return left
+            left = self.arithmetic(left, token, self.product())
+
+    def product(self):
+        left = self.unary()
+        while True:
+            token = self.accept_any('operator', ('*', '/'))
+            if token is None:
+                return left
+            left = self.arithmetic(left, token, self.unary())
+
+    def arithmetic(self, left, token, right):
+        if left.kind != 'number' or right.kind != 'number':
+            self.error('arithmetic on non-numeric values with', token)
+        return combine(ARITHMETIC[token[1]], left, right, 'number')
+
+    def unary(self):
+        token = self.accept('operator', '-')
+        if token is None:
+            return self.atom()
+        term = self.unary()
+        if term.kind != 'number':
+            self.error('cannot negate non-numeric value with', token)
+        evaluate = term.evaluate
+        return Term(lambda columns: -evaluate(columns), 'number',
+                    term.tags, token[2], term.end)
+
+    def atom(self):
+        token = self.peek()
+        if token is None:
+            self.error('expected a value but found', token)
+        kind, value, start, end = token
+        self.pos += 1
+        if kind == 'number':
+            number = float(value) if '.' in value else int(value)
+            return Term(lambda columns: number, 'number', (), start, end)
+        elif kind == 'string':
+            string = value[1:-1]
+            return Term(lambda columns: string, 'string', (), start, end)
+        elif kind == 'word' and value in NUMERIC_TAGS:
+            tag, column = NUMERIC_TAGS[value]
+            return Term(lambda columns: columns[column], 'number', (tag,),
+                        start, end)
+        elif kind == 'word' and value in CATEGORICAL_TAGS:
+            tag, column, categories = CATEGORICAL_TAGS[value]
+            return Term(lambda columns: columns[column], value, (tag,),
+                        start, end)
+        elif value == '(':
+            term = self.disjunction()
+            close = self.expect('operator', ')')
+            return term._replace(start=start, end=close[3])
+        tags = ', '.join(list(NUMERIC_TAGS) + list(CATEGORICAL_TAGS))
+        self.error(f'expected a number, quoted string or one of {tags} '
+                   'but found', token)
+
+
+def tokenise(text):
+
+    ''' Yield (kind, value, start, end) of each token of text. '''
+
+    pos = 0
+    while text[pos:].strip():
+        match = TOKEN.match(text, pos)
+        if match is None:
+            start = len(text) - len(text[pos:].lstrip())
+            raise ValueError(f'Invalid expression "{text}": unexpected '
+                             f'"{text[start]}" at position {start + 1}.')
+        kind = match.lastgroup
+        yield kind, match.group(kind), match.start(kind), match.end(kind)
+        pos = match.end()
+
+
+def constant(value, term):
+    return term._replace(evaluate=lambda columns: value, kind='number')
+
+
+def combine(function, left, right, kind):
+    evaluate_left = left.evaluate
+    evaluate_right = right.evaluate
+    return Term(
+        lambda columns: function(evaluate_left(columns),
+                                 evaluate_right(columns)),
+        kind, left.tags + right.tags, left.start, right.end)
+
+
+def all_of(terms):
+    if len(terms) == 1:
+        return terms[0]
+    evaluates = [term.evaluate for term in terms]
+
+    def evaluate(columns):
+        result = evaluates[0](columns)
+        for other in evaluates[1:]:
+            result = result & other(columns)
+        return result
+
+    return Term(evaluate, 'bool', sum((term.tags for term in terms), ()),
+                terms[0].start, terms[-1].end)
+
+
+def either(left, right):
+    return combine(lambda a, b: a | b, left, right, 'bool')
@@ -6,14 +6,46 @@
 """
 
 import sys
+import json
+import struct
 import fileinput
+import numpy as np
 import pyHiCTools as hic
 import pyCommonTools as pct
 from contextlib import ExitStack
+from pyHiCTools.reader import read_batches, pairs, get_tags, CHUNK_SIZE
+from pyHiCTools.parallel import imap_chunks, Writer
+from pyHiCTools.bam import use_pysam, open_input, read_segment_batches
+from pyHiCTools.process import stats_lists, ORIENTATIONS, INTERACTIONS
+from pyHiCTools.histogram import LogHistogram
+from pyHiCTools.subsample import make_subsample
 
-def extract(infile, sample):
+
+# Optional tags of read 1 written by extract.
+EXTRACT_TAGS = ['or:Z', 'it:Z', 'dt:i', 'is:i', 'fs:i']
+
+# Fixed dtypes of columnar output, with orientation and interaction
+# dictionary-encoded as indices into ORIENTATIONS and INTERACTIONS.
+COLUMNS = {
+    'orientation': '|u1',
+    'interaction': '|u1',
+    'ditag_length': '<i4',
+    'insert_size': '<i8',
+    'fragment_seperation': '<i4',
+}
+
+HEADER = ('sample\torientation\tinteraction_type\tditag_length\t'
+          'insert_size\tfragment_seperation\n')
+
+# Per-process state set by set_worker.
+worker = {}
+
+
+def extract(infile, sample, threads=1, output_format='tsv', output=None,
+            subsample=None, seed=0, bam=False):
 
     log = pct.create_logger()
+    keep = make_subsample(subsample, seed)
 
     if not sample:
         if infile == '-':
@@ -21,23 +53,230 @@ def extract(infile, sample):
         else:
             sample = infile
 
+    if output_format != 'tsv':
+        if output_format == 'columnar':
+            if not output:
+                log.error('Columnar output requires an --output prefix.')
+                sys.exit(1)
+            sink = ColumnWriter(output, sample)
+        else:
+            sink = Summary(sample)
+        for stats in read_stats(infile, threads, keep, bam):
+            sink.add(stats)
+        sink.close()
+        return
+
+    if use_pysam(infile, bam):
+        sys.stdout.write(HEADER)
+        write_bam_rows(infile, sample, threads, keep)
+        return
+
+    with pct.open(infile) as f, Writer(sys.stdout) as output:
+
+        output.write(HEADER)
+
+        chunks = read_batches(f, CHUNK_SIZE, keep)
+        for out in imap_chunks(extract_chunk, chunks, threads,
+                               initializer=set_worker, initargs=(sample,)):
+            output.write(out)
+
+
+def write_bam_rows(infile, sample, threads, keep=None):
+
+    ''' Write extracted rows of a BAM file read with pysam. '''
+
+    with open_input(infile, threads) as in_bam:
+        for segments in read_segment_batches(in_bam, CHUNK_SIZE, keep):
+            out = []
+            for read1, read2 in pairs(segments):
+                out.append(
+                    f'{sample}\t{read1.get_tag("or")}\t'
+                    f'{read1.get_tag("it")}\t{read1.get_tag("dt")}\t'
+                    f'{read1.get_tag("is")}\t{read1.get_tag("fs")}\n')
+            sys.stdout.write(''.join(out))
+
+
+def read_stats(infile, threads=1, keep=None, bam=False):
+
+    ''' Yield dict of per-pair arrays of extract columns for each chunk
+        of read pairs, encoded as in process.batch_filter. BAM is read
+        with pysam if bam is True or detected from infile.
+    '''
+
+    if use_pysam(infile, bam):
+        with open_input(infile, threads) as in_bam:
+            for segments in read_segment_batches(
+                    in_bam, CHUNK_SIZE, keep):
+                yield tag_stats(
+                    {tag: read1.get_tag(tag[:2]) for tag in EXTRACT_TAGS}
+                    for read1, read2 in pairs(segments))
+        return
+
     with pct.open(infile) as f:
+        chunks = read_batches(f, CHUNK_SIZE, keep)
+        for stats in imap_chunks(stats_chunk, chunks, threads):
+            if stats is not None:
+                yield stats
+
+
+def stats_chunk(chunk):
+
+    ''' Return extract column arrays of a chunk from read_batches. '''
+
+    is_header, lines = chunk
+    if is_header:
+        return None
+    return tag_stats(
+        get_tags(line1, EXTRACT_TAGS) for line1, line2 in pairs(lines))
+
+
+def tag_stats(tags):
+
+    ''' Return dict of extract column arrays from an iterable of
+        optional tag dicts of read 1 of each pair.
+    '''
+
+    orientations = {name: i for i, name in enumerate(ORIENTATIONS)}
+    interactions = {name: i for i, name in enumerate(INTERACTIONS)}
+    columns = {column: [] for column in COLUMNS}
+    for tag in tags:
+        columns['orientation'].append(orientations[tag['or:Z']])
+        columns['interaction'].append(interactions[tag['it:Z']])
+        columns['ditag_length'].append(tag['dt:i'])
+        columns['insert_size'].append(tag['is:i'])
+        columns['fragment_seperation'].append(tag['fs:i'])
+    return {column: np.array(values, dtype=COLUMNS[column])
+            for column, values in columns.items()}
+
 
+class ColumnWriter:
+
+    ''' Stream extract columns to one .npy file per column, with a JSON
+        file of sample name, row count and category names. The array
+        headers are rewritten with the final length on close so the
+        files can be loaded (or memory-mapped) with numpy.load.
+    '''
+
+    # Fixed size of .npy preamble so the header can be rewritten.
+    HEADER_SIZE = 128
+
+    def __init__(self, prefix, sample):
+        self.prefix = prefix
+        self.sample = sample
+        self.rows = 0
+        self.files = {}
+        for column, dtype in COLUMNS.items():
+            f = open(f'{prefix}.{column}.npy', 'wb')
+            self.write_header(f, dtype, 0)
+            self.files[column] = f
+
+    def write_header(self, f, dtype, rows):
+        header = (f"{{'descr': '{dtype}', 'fortran_order': False, "
+                  f"'shape': ({rows},), }}")
+        header = header.ljust(self.HEADER_SIZE - 11) + '\n'
+        f.seek(0)
+        f.write(b'\x93NUMPY\x01\x00')
+        f.write(struct.pack('<H', len(header)))
+        f.write(header.encode('latin1'))
+
+    def add(self, stats):
+        for column, f in self.files.items():
+            f.write(np.ascontiguousarray(
+                stats[column], dtype=COLUMNS[column]).tobytes())
+        self.rows += len(stats['orientation'])
+
+    def close(self):
+        for column, f in self.files.items():
+            self.write_header(f, COLUMNS[column], self.rows)
+            f.close()
+        with open(f'{self.prefix}.json', 'w') as out:
+            json.dump({
+                'sample': self.sample,
+                'rows': self.rows,
+                'columns': COLUMNS,
+                'categories': {'orientation': ORIENTATIONS,
+                               'interaction': INTERACTIONS},
+            }, out, indent=2)
+
+
+def load_columns(prefix, mmap_mode='r'):
+
+    ''' Return metadata and dict of column arrays written by
+        ColumnWriter.
+    '''
+
+    with open(f'{prefix}.json') as f:
+        metadata = json.load(f)
+    columns = {column: np.load(f'{prefix}.{column}.npy', mmap_mode=mmap_mode)
+               for column in metadata['columns']}
+    return metadata, columns
+
+
+class Summary:
+
+    ''' Log-binned histograms of ditag length, insert size and fragment
+        separation per orientation and interaction type, written as a
+        table of non-empty bins.
+    '''
+
+    METRICS = ['ditag_length', 'insert_size', 'fragment_seperation']
+
+    def __init__(self, sample):
+        self.sample = sample
+        self.histograms = {
+            metric: LogHistogram((len(ORIENTATIONS), len(INTERACTIONS)))
+            for metric in self.METRICS}
+
+    def add(self, stats):
+        for metric, histogram in self.histograms.items():
+            histogram.add(
+                stats[metric], stats['orientation'], stats['interaction'])
+
+    def close(self):
         sys.stdout.write(
-            'sample\torientation\tinteraction_type\tditag_length\t'
-            'insert_size\tfragment_seperation\n')
-
-        for i, line in enumerate(f):
-            if line.startswith('@'):
-                continue
-            else:
-                try:
-                    read1 = pct.Sam(line)
-                    read2 = pct.Sam(next(f))
-                except StopIteration:
-                    log.exception('Odd number of alignments in file')
-                    sys.exit(1)
-                sys.stdout.write(
-                    f'{sample}\t{read1.optional["or:Z"]}\t'
-                    f'{read1.optional["it:Z"]}\t{read1.optional["dt:i"]}\t'
-                    f'{read1.optional["is:i"]}\t{read1.optional["fs:i"]}\n')
+            'sample\tmetric\torientation\tinteraction_type\t'
+            'lower\tupper\tcount\n')
+        for metric, histogram in self.histograms.items():
+            intervals = histogram.intervals()
+            for (o, i, b), count in np.ndenumerate(histogram.counts):
+                if count:
+                    lower, upper = intervals[b]
+                    sys.stdout.write(
+                        f'{self.sample}\t{metric}\t{ORIENTATIONS[o]}\t'
+                        f'{INTERACTIONS[i]}\t{lower}\t{upper}\t{count}\n')
+
+
+def stats_rows(stats, sample):
+
+    ''' Return extracted rows of process.batch_filter arrays. '''
+
+    stats = stats_lists(stats)
+    return ''.join(
+        f'{sample}\t{orientation}\t{interaction}\t{ditag}\t{insert}\t'
+        f'{seperation}\n' for orientation, interaction, ditag, insert,
+        seperation in zip(stats['orientation'], stats['interaction'],
+                          stats['ditag_length'], stats['insert_size'],
+                          stats['fragment_seperation']))
+
+
+def set_worker(sample):
+
+    worker['sample'] = sample
+
+
+def extract_chunk(chunk):
+
+    ''' Return extracted rows of a chunk from read_batches. '''
+
+    is_header, lines = chunk
+    if is_header:
+        return ''
+    sample = worker['sample']
+    out = []
+    for line1, line2 in pairs(lines):
+        tags = get_tags(line1, EXTRACT_TAGS)
+        out.append(
+            f'{sample}\t{tags["or:Z"]}\t'
+            f'{tags["it:Z"]}\t{tags["dt:i"]}\t'
+            f'{tags["is:i"]}\t{tags["fs:i"]}\n')
+    return ''.join(out)
@@ -7,19 +7,50 @@
 
 import sys
 import fileinput
+import collections
+import numpy as np
 import pyCommonTools as pct
 import pyHiCTools as hic
+from contextlib import ExitStack
+from pyHiCTools import instrument
+from pyHiCTools.reader import (
+    read_batches, pairs, get_tags, raw_record, CHUNK_SIZE)
+from pyHiCTools.parallel import imap_chunks, Writer
+from pyHiCTools.process import ORIENTATIONS, INTERACTIONS
+from pyHiCTools.pairs_file import PairsWriter, combine_writers
+from pyHiCTools.checkpoint import open_checkpoint, CHECKPOINT_INTERVAL
+from pyHiCTools.subsample import make_subsample
+from pyHiCTools.expression import (
+    compile_clauses, clause_tags, tag_columns, first_failed)
+from pyHiCTools.bam import (
+    use_pysam, open_input, open_output, read_segment_batches, get_optional)
 
 
-def filter(infile, qc, sample, min_inward, min_outward, min_ditag, max_ditag):
+# Outcomes of filter_reason, in order of precedence.
+REASONS = ['retained', 'above_ditag', 'below_ditag', 'same_fragment',
+           'below_min_inward', 'below_min_outward']
+
+# Optional tags read by filter_reason.
+FILTER_TAGS = ['dt:i', 'it:Z', 'fs:i', 'or:Z', 'is:i']
+
+# Per-process state set by set_worker.
+worker = {}
+
+
+def filter(infile, qc, sample, min_inward, min_outward, min_ditag, max_ditag,
+           threads=1, bam=False, pairs=None, expr=None, checkpoint=None,
+           resume=False, checkpoint_interval=CHECKPOINT_INTERVAL,
+           subsample=None, seed=0, decay=None):
 
     ''' Iterate through each infile. '''
 
     log = pct.create_logger()
     inputs = [min_inward, min_outward, max_ditag, min_ditag]
-    if all(i is None for i in inputs):
+    if all(i is None for i in inputs) and not expr:
         log.error('No filter settings defined.')
         sys.exit(1)
+    clauses = check_clauses(expr)
+    keep = make_subsample(subsample, seed)
 
     if not sample:
         if infile == '-':
@@ -27,61 +58,229 @@ def filter(infile, qc, sample, min_inward, min_outward, min_ditag, max_ditag):
         else:
             sample = infile
 
-    with pct.open(infile) as in_obj:
-        total = 0
-        retained = 0
-        invalid = 0
-        above_ditag = 0
-        below_ditag = 0
-        same_fragment = 0
-        below_min_inward = 0
-        below_min_outward = 0
-
-        for line in in_obj:
-            if line.startswith("@"):
-                sys.stdout.write(line)
-            else:
-                try:
-                    read1 = pct.Sam(line)
-                    read2 = pct.Sam(next(in_obj))
-                    total += 1
-                except StopIteration:
-                    log.exception('Odd number of alignments in file.')
-                    sys.exit(1)
-                if max_ditag is not None:
-                    if read1.optional['dt:i'] > max_ditag:
-                        above_ditag += 1
-                        continue
-                if min_ditag is not None:
-                    if read1.optional['dt:i'] < min_ditag:
-                        below_ditag += 1
-                        continue
-                if read1.optional['it:Z'] == "cis":
-                    if read1.optional['fs:i'] == 0:
-                        same_fragment += 1
-                        continue
-                    if read1.optional['or:Z'] == 'Inward':
-                        if min_inward is not None:
-                            if read1.optional['is:i'] < min_inward:
-                                below_min_inward += 1
-                                continue
-                    elif read1.optional['or:Z'] == 'Outward':
-                        if min_outward is not None:
-                            if read1.optional['is:i'] < min_outward:
-                                below_min_outward += 1
-                                continue
-                retained += 1
-                sys.stdout.write(read1.get_record())
-                sys.stdout.write(read2.get_record())
-
-        with pct.open(qc, stderr = True, mode = 'w') as qc_out:
-            qc_out.write(
-                f'{sample}\tTotal\t{total}\n'
-                f'{sample}\tRetained\t{retained}\n'
-                f'{sample}\tFiltered\t{total - retained}\n'
-                f'{sample}\tInvalid\t{invalid}\n'
-                f'{sample}\tDitag < {min_ditag}bp\t{above_ditag}\n'
-                f'{sample}\tDitag > {max_ditag}bp\t{below_ditag}\n'
-                f'{sample}\tSame fragment\t{same_fragment}\n'
-                f'{sample}\tInward insert < {min_inward}bp\t{below_min_inward}\n'
-                f'{sample}\tOutward insert < {min_outward}bp\t{below_min_outward}\n')
+    with ExitStack() as stack:
+        writers = []
+        if pairs:
+            writers.append(stack.enter_context(PairsWriter(pairs, threads)))
+        if decay:
+            # Imported here so decay is only loaded when needed.
+            from pyHiCTools.decay import DecayWriter
+            writers.append(DecayWriter(decay, sample))
+        writer = combine_writers(writers)
+        thresholds = (min_inward, min_outward, min_ditag, max_ditag)
+        if checkpoint:
+            cp = open_checkpoint(
+                checkpoint, infile,
+                ['filter', *thresholds, expr, subsample, seed], resume,
+                checkpoint_interval, bam, pairs or decay)
+            counts = cp.counts
+            for out, chunk_counts in imap_chunks(
+                    filter_chunk, cp.chunks(CHUNK_SIZE, keep), threads,
+                    initializer=set_worker, initargs=(*thresholds, expr)):
+                counts.update(chunk_counts)
+                cp.write(out)
+            cp.finish()
+        elif use_pysam(infile, bam):
+            set_worker(*thresholds, expr)
+            counts = filter_bam(infile, threads, bam, writer, keep)
+        else:
+            in_obj = stack.enter_context(pct.open(infile))
+            output = stack.enter_context(Writer(sys.stdout))
+            counts = collections.Counter()
+            chunks = read_batches(in_obj, CHUNK_SIZE, keep)
+            for out, chunk_counts in imap_chunks(
+                    filter_chunk, chunks, threads, initializer=set_worker,
+                    initargs=(*thresholds, expr)):
+                output.write(out)
+                counts.update(chunk_counts)
+                if writer is not None:
+                    writer.add_sam(out)
+        if writer is not None:
+            writer.close()
+
+    write_qc(qc, sample, counts, min_inward, min_outward,
+             min_ditag, max_ditag, clauses)
+
+
+def check_clauses(expr):
+
+    ''' Return compiled clauses of filter expressions or exit if any
+        expression is invalid.
+    '''
+
+    try:
+        return compile_clauses(expr or [])
+    except ValueError as error:
+        log = pct.create_logger()
+        log.error(error)
+        sys.exit(1)
+
+
+def set_worker(min_inward, min_outward, min_ditag, max_ditag, expr=None):
+
+    worker['thresholds'] = {
+        'min_inward': min_inward, 'min_outward': min_outward,
+        'min_ditag': min_ditag, 'max_ditag': max_ditag}
+    worker['clauses'] = compile_clauses(expr or [])
+    worker['tags'] = FILTER_TAGS + [
+        tag for tag in clause_tags(worker['clauses'])
+        if tag not in FILTER_TAGS]
+
+
+def filter_chunk(chunk):
+
+    ''' Return retained SAM records and filter counts of a chunk from
+        read_batches.
+    '''
+
+    is_header, lines = chunk
+    counts = collections.Counter()
+    if is_header:
+        return ''.join(lines), counts
+    if worker['clauses']:
+        columns = tag_columns(
+            [get_tags(line1, worker['tags']) for line1, line2 in pairs(lines)],
+            worker['tags'])
+        retained, counts = apply_filter(
+            columns, worker['thresholds'], worker['clauses'])
+        return ''.join([raw_record(line) for i in retained
+                        for line in lines[2 * i: 2 * i + 2]]), counts
+    out = []
+    for line1, line2 in pairs(lines):
+        counts['total'] += 1
+        reason = filter_reason(
+            get_tags(line1, FILTER_TAGS), **worker['thresholds'])
+        if reason:
+            counts[reason] += 1
+            continue
+        counts['retained'] += 1
+        out.append(raw_record(line1))
+        out.append(raw_record(line2))
+    return ''.join(out), counts
+
+
+def filter_bam(infile, threads, bam, writer=None, keep=None):
+
+    ''' Filter SAM/BAM with pysam and return filter counts. '''
+
+    counts = collections.Counter()
+    with open_input(infile, threads) as in_bam, \
+            open_output(in_bam, threads, bam) as out_bam:
+        if writer is not None:
+            writer.set_chroms(in_bam.references, in_bam.lengths)
+        for segments in read_segment_batches(in_bam, CHUNK_SIZE, keep):
+            if worker['clauses']:
+                columns = tag_columns(
+                    [get_optional(read1, worker['tags'])
+                     for read1, read2 in pairs(segments)], worker['tags'])
+                retained, batch_counts = apply_filter(
+                    columns, worker['thresholds'], worker['clauses'])
+                counts.update(batch_counts)
+                segments = [segment for i in retained
+                            for segment in segments[2 * i: 2 * i + 2]]
+                for segment in segments:
+                    out_bam.write(segment)
+                if writer is not None:
+                    writer.add_segments(segments)
+                continue
+            retained = []
+            for read1, read2 in pairs(segments):
+                counts['total'] += 1
+                optional = get_optional(read1, FILTER_TAGS)
+                reason = filter_reason(optional, **worker['thresholds'])
+                if reason:
+                    counts[reason] += 1
+                    continue
+                counts['retained'] += 1
+                out_bam.write(read1)
+                out_bam.write(read2)
+                retained += [read1, read2]
+            if writer is not None:
+                writer.add_segments(retained)
+    return counts
+
+
+def filter_reason(optional, min_inward, min_outward, min_ditag, max_ditag):
+
+    ''' Return reason a read pair fails filtering or None if retained. '''
+
+    if max_ditag is not None:
+        if optional['dt:i'] > max_ditag:
+            return 'above_ditag'
+    if min_ditag is not None:
+        if optional['dt:i'] < min_ditag:
+            return 'below_ditag'
+    if optional['it:Z'] == "cis":
+        if optional['fs:i'] == 0:
+            return 'same_fragment'
+        if optional['or:Z'] == 'Inward':
+            if min_inward is not None:
+                if optional['is:i'] < min_inward:
+                    return 'below_min_inward'
+        elif optional['or:Z'] == 'Outward':
+            if min_outward is not None:
+                if optional['is:i'] < min_outward:
+                    return 'below_min_outward'
+    return None
+
+
+@instrument.timed
+def batch_filter_reasons(stats, min_inward, min_outward, min_ditag,
+                         max_ditag):
+
+    ''' Vectorised filter_reason over arrays from process.batch_filter.
+        Returns index into REASONS for each read pair, 0 if retained.
+    '''
+
+    ditag = stats['ditag_length']
+    insert = stats['insert_size']
+    cis = stats['interaction'] == INTERACTIONS.index('cis')
+    inward = stats['orientation'] == ORIENTATIONS.index('Inward')
+    outward = stats['orientation'] == ORIENTATIONS.index('Outward')
+    fail = np.zeros(len(ditag), dtype=bool)
+    conditions = [
+        ditag > max_ditag if max_ditag is not None else fail,
+        ditag < min_ditag if min_ditag is not None else fail,
+        cis & (stats['fragment_seperation'] == 0),
+        cis & inward & (insert < min_inward)
+        if min_inward is not None else fail,
+        cis & outward & (insert < min_outward)
+        if min_outward is not None else fail,
+    ]
+    return np.select(conditions, range(1, len(REASONS)), 0)
+
+
+def apply_filter(columns, thresholds, clauses=()):
+
+    ''' Return indices of retained pairs and filter counts of batch_filter
+        style columns. Pairs failing a clause are counted as
+        "clause {index}".
+    '''
+
+    reasons = batch_filter_reasons(columns, **thresholds)
+    reasons = first_failed(clauses, columns, reasons, len(REASONS))
+    names = REASONS + [f'clause {i}' for i in range(len(clauses))]
+    counts = collections.Counter(dict(zip(names, np.bincount(
+        reasons, minlength=len(names)).tolist())))
+    counts['total'] = len(reasons)
+    return np.flatnonzero(reasons == 0), counts
+
+
+def write_qc(qc, sample, counts, min_inward, min_outward,
+             min_ditag, max_ditag, clauses=()):
+
+    total = counts['total']
+    rows = [
+        ('Total', total),
+        ('Retained', counts['retained']),
+        ('Filtered', total - counts['retained']),
+        ('Invalid', counts['invalid']),
+        (f'Ditag < {min_ditag}bp', counts['above_ditag']),
+        (f'Ditag > {max_ditag}bp', counts['below_ditag']),
+        ('Same fragment', counts['same_fragment']),
+        (f'Inward insert < {min_inward}bp', counts['below_min_inward']),
+        (f'Outward insert < {min_outward}bp', counts['below_min_outward'])]
+    rows.extend((f'Failed {clause.text}', counts[f'clause {i}'])
+                for i, clause in enumerate(clauses))
+    with pct.open(qc, stderr = True, mode = 'w') as qc_out:
+        instrument.write_qc_rows(qc_out, sample, rows)
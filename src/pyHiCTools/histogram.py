@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+""" Fixed-size, mergeable, log-binned histograms for summarising read
+    pair distances in constant memory.
+"""
+
+import numpy as np
+
+
+def log_edges(bins_per_decade=10, decades=10):
+
+    ''' Return sorted unique integer lower edges of log-spaced bins from
+        1 to 10 ** decades.
+    '''
+
+    exponents = np.arange(decades * bins_per_decade + 1) / bins_per_decade
+    return np.unique(np.ceil(10 ** exponents).astype(np.int64))
+
+
+class LogHistogram:
+
+    ''' Counts of integer values in log-spaced bins, optionally grouped
+        by one or more categorical codes. Bin 0 holds values below 1 and
+        the final bin is open-ended.
+    '''
+
+    def __init__(self, shape=(), bins_per_decade=10, decades=10):
+        self.edges = log_edges(bins_per_decade, decades)
+        self.shape = tuple(shape)
+        self.counts = np.zeros(
+            self.shape + (len(self.edges) + 1,), dtype=np.int64)
+
+    def bin(self, values):
+        return np.searchsorted(self.edges, values, side='right')
+
+    def add(self, values, *groups):
+
+        ''' Count values, with groups giving the categorical code of
+            each value for each grouping dimension.
+        '''
+
+        index = np.ravel_multi_index(
+            (*groups, self.bin(values)), self.counts.shape)
+        self.counts += np.bincount(
+            index, minlength=self.counts.size).reshape(self.counts.shape)
+
+    def merge(self, other):
+        self.counts += other.counts
+        return self
+
+    def intervals(self):
+
+        ''' Return list of (lower, upper) inclusive bounds of each bin as
+            strings, with "-inf" and "inf" for the open-ended bins.
+        '''
+
+        lower = ['-inf'] + [str(edge) for edge in self.edges]
+        upper = [str(edge - 1) for edge in self.edges] + ['inf']
+        return list(zip(lower, upper))
+
+    def lower(self, index):
+
+        ''' Return the inclusive lower bound of a bin. '''
+
+        return 0 if index == 0 else int(self.edges[index - 1])
+
+    def upper(self, index):
+
+        ''' Return the inclusive upper bound of a bin, or None for the
+            open-ended final bin.
+        '''
+
+        return int(self.edges[index]) - 1 if index < len(self.edges) else None
+
+    def quantile_bin(self, q):
+
+        ''' Return index of the bin holding quantile q of all counts. '''
+
+        totals = self.counts.reshape(-1, self.counts.shape[-1]).sum(axis=0)
+        cumulative = np.cumsum(totals)
+        return int(np.searchsorted(
+            cumulative, max(q * cumulative[-1], 1), side='left'))
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+""" Optional instrumentation shared by all subcommands: per-stage wall
+    time and call counts, queue depths between pipeline stages,
+    periodic progress with records/sec and ETA,
+    cProfile or sampling profiler output, and a JSON report of QC and
+    timings. Instrumentation is off unless enabled by the command line
+    options added by add_arguments, and costs a flag check when off.
+"""
+
+import os
+import json
+import time
+import signal
+import resource
+import functools
+import contextlib
+import collections
+import pyCommonTools as pct
+
+
+# Per-process instrumentation state; copied to forked worker processes.
+state = {
+    'enabled': False,
+    'stages': collections.defaultdict(float),
+    'calls': collections.Counter(),
+    'records': 0,
+    'qc': {},
+    'queues': {},
+    'progress': None,
+    'last': 0.0,
+    'start': 0.0,
+}
+
+NULL_STAGE = contextlib.nullcontext()
+
+
+def add_arguments(parser):
+
+    ''' Add instrumentation options to a subcommand parser. '''
+
+    group = parser.add_argument_group('instrumentation arguments')
+    group.add_argument(
+        '--progress', nargs='?', const=10, default=None, type=float,
+        metavar='SECONDS',
+        help='Log records/sec and ETA to stderr every SECONDS '
+             '(default: %(const)s).')
+    group.add_argument(
+        '--profile', action='store_true',
+        help='Log wall time and call count of each processing stage.')
+    group.add_argument(
+        '--profile_dump', default=None, metavar='FILE',
+        help='Write cProfile statistics, or folded stacks with '
+             '--profiler sampling, of the main process to FILE.')
+    group.add_argument(
+        '--profiler', default='cprofile', choices=['cprofile', 'sampling'],
+        help='Profiler used for --profile_dump.')
+    group.add_argument(
+        '--json', dest='json_file', default=None, metavar='FILE',
+        help='Write QC counts and stage timings as JSON to FILE.')
+
+
+def wrap(function):
+
+    ''' Return function accepting and applying the instrumentation
+        options of add_arguments.
+    '''
+
+    @functools.wraps(function)
+    def wrapper(*args, progress=None, profile=False, profile_dump=None,
+                profiler='cprofile', json_file=None, **kwargs):
+        if not (progress or profile or profile_dump or json_file):
+            return function(*args, **kwargs)
+        enable(progress)
+        with dump_profile(profile_dump, profiler):
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - state['start']
+                if profile:
+                    log_stages(elapsed)
+                if json_file:
+                    write_json(json_file, function.__name__, kwargs, elapsed)
+    return wrapper
+
+
+def enable(progress=None):
+    state['enabled'] = True
+    state['progress'] = progress
+    state['start'] = state['last'] = time.perf_counter()
+
+
+def enabled():
+    return state['enabled']
+
+
+def stage(name):
+
+    ''' Return context manager accumulating wall time of a stage. '''
+
+    if not state['enabled']:
+        return NULL_STAGE
+    return timed_stage(name)
+
+
+@contextlib.contextmanager
+def timed_stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        state['stages'][name] += time.perf_counter() - start
+        state['calls'][name] += 1
+
+
+def timed(function):
+
+    ''' Decorator recording each call of function as a stage. '''
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not state['enabled']:
+            return function(*args, **kwargs)
+        with timed_stage(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def timed_iter(name, iterable):
+
+    ''' Return iterable with time spent producing each item recorded as
+        a stage.
+    '''
+
+    if not state['enabled']:
+        return iterable
+    return timed_items(name, iterable)
+
+
+def timed_items(name, iterable):
+    iterator = iter(iterable)
+    while True:
+        with timed_stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def call_timed(function, chunk):
+
+    ''' Run function(chunk) in a worker process and return the result
+        with the stage timings recorded during the call.
+    '''
+
+    state['stages'].clear()
+    state['calls'].clear()
+    with timed_stage(function.__name__):
+        result = function(chunk)
+    return result, (dict(state['stages']), dict(state['calls']))
+
+
+def merge(timings):
+
+    ''' Add stage timings returned by call_timed. '''
+
+    stages, calls = timings
+    for name, seconds in stages.items():
+        state['stages'][name] += seconds
+    state['calls'].update(calls)
+
+
+def queue_depth(name, depth, capacity):
+
+    ''' Record a sample of the depth of a bounded stage queue. A queue
+        that is mostly full is waiting on its consumer, one that is
+        mostly empty on its producer.
+    '''
+
+    if not state['enabled']:
+        return
+    queue = state['queues'].setdefault(
+        name, {'capacity': capacity, 'samples': 0, 'total': 0, 'max': 0})
+    queue['samples'] += 1
+    queue['total'] += depth
+    queue['max'] = max(queue['max'], depth)
+
+
+def queue_summary():
+
+    ''' Return dict of queue name to capacity and mean and maximum
+        sampled depth.
+    '''
+
+    return {name: {'capacity': queue['capacity'],
+                   'mean_depth': queue['total'] / queue['samples'],
+                   'max_depth': queue['max']}
+            for name, queue in state['queues'].items()}
+
+
+def advance(records, source=None):
+
+    ''' Count records read and log progress if due. Source is an open
+        file (or pysam AlignmentFile) used to estimate the ETA.
+    '''
+
+    if not state['enabled']:
+        return
+    state['records'] += records
+    interval = state['progress']
+    now = time.perf_counter()
+    if interval is None or now - state['last'] < interval:
+        return
+    state['last'] = now
+    log = pct.create_logger()
+    elapsed = now - state['start']
+    rate = state['records'] / elapsed
+    message = f'{state["records"]} records, {rate:.0f} records/s'
+    fraction = input_fraction(source)
+    if fraction:
+        eta = elapsed * (1 - fraction) / fraction
+        message += (f', {100 * fraction:.1f}% of input, ETA '
+                    f'{time.strftime("%H:%M:%S", time.gmtime(eta))}')
+    log.info(message)
+
+
+def input_fraction(source):
+
+    ''' Return fraction of a seekable input file read so far, or None. '''
+
+    if source is None:
+        return None
+    try:
+        if hasattr(source, 'check_index'):
+            # pysam AlignmentFile; tell is a BGZF virtual offset.
+            position = source.tell() >> 16
+            size = os.path.getsize(source.filename)
+        else:
+            fd = source.fileno()
+            position = os.lseek(fd, 0, os.SEEK_CUR)
+            size = os.fstat(fd).st_size
+    except (OSError, ValueError, AttributeError, TypeError):
+        return None
+    return min(position / size, 1) if size else None
+
+
+def report_qc(sample, rows):
+
+    ''' Record QC rows of (label, value) of a sample for the JSON report. '''
+
+    state['qc'][str(sample)] = dict(rows)
+
+
+def write_qc_rows(qc_out, sample, rows):
+
+    ''' Write QC rows as TSV lines and record them for the JSON report. '''
+
+    qc_out.write(''.join(f'{sample}\t{label}\t{value}\n'
+                         for label, value in rows))
+    report_qc(sample, rows)
+
+
+def log_stages(elapsed):
+
+    log = pct.create_logger()
+
+    log.info(f'Total wall time {elapsed:.3f}s, {state["records"]} records.')
+    for name, seconds in sorted(state['stages'].items(),
+                                key=lambda item: -item[1]):
+        log.info(f'Stage {name}: {seconds:.3f}s in '
+                 f'{state["calls"][name]} calls.')
+    for name, queue in queue_summary().items():
+        log.info(f'Queue {name}: mean depth {queue["mean_depth"]:.2f}, '
+                 f'max {queue["max_depth"]} of {queue["capacity"]}.')
+
+
+def write_json(path, command, arguments, elapsed):
+    report = {
+        'command': command,
+        'arguments': {key: value for key, value in arguments.items()
+                      if isinstance(value, (str, int, float, bool, list,
+                                            type(None)))},
+        'wall_seconds': elapsed,
+        'records': state['records'],
+        'peak_rss_mb': max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024,
+        'stages': {name: {'seconds': seconds, 'calls': state['calls'][name]}
+                   for name, seconds in state['stages'].items()},
+        'queues': queue_summary(),
+        'qc': state['qc'],
+    }
+    with open(path, 'w') as out:
+        # Counts may be numpy scalars.
+        json.dump(report, out, indent=2, default=lambda value: value.item())
+
+
+@contextlib.contextmanager
+def dump_profile(path, profiler):
+
+    ''' Profile the enclosed block and write the output to path. '''
+
+    if path is None:
+        yield
+    elif profiler == 'cprofile':
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(path)
+    else:
+        sampler = Sampler()
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            sampler.write(path)
+
+
+class Sampler:
+
+    ''' Statistical profiler sampling the main thread stack on a CPU
+        time interval timer. Writes folded stacks, one "frame;frame
+        count" line per stack, as read by flamegraph tools.
+    '''
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} '
+                         f'({os.path.basename(code.co_filename)}'
+                         f':{code.co_firstlineno})')
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.previous = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.previous)
+
+    def write(self, path):
+        with open(path, 'w') as out:
+            for stack, count in self.stacks.most_common():
+                out.write(f'{stack} {count}\n')
@@ -5,10 +5,18 @@
 
 import re
 import argparse
+import importlib
+import importlib.util
 import pyCommonTools as pct
-import pyHiCTools as hic
+from pyHiCTools import instrument
+from pyHiCTools.mates import MAX_PENDING
 from version import __version__
 
+
+# Leading docstring of a module, after any comment lines.
+DOCSTRING = re.compile(r'\s*(?:#[^\n]*\n\s*)*(\'\'\'|""")(.*?)\1', re.DOTALL)
+
+
 def main():
 
     parser = pct.make_parser(prog='pyHiCTools', version=__version__)
@@ -26,6 +34,120 @@ def main():
     fastq_input_arg = pct.get_in_arg(in_type = 'FASTQ')
     sam_input_arg = pct.get_in_arg(in_type = 'SAM')
 
+    bam_arg = argparse.ArgumentParser(add_help=False)
+    bam_arg.add_argument(
+        '--bam', action='store_true',
+        help='Write output in BAM format. BAM input files are detected '
+             'automatically but BAM on stdin requires --bam; both use '
+             '--threads for BGZF compression.')
+
+    # Parent parser option for commands which read, but do not write, BAM.
+    bam_input_arg = argparse.ArgumentParser(add_help=False)
+    bam_input_arg.add_argument(
+        '--bam', action='store_true',
+        help='Input is BAM. BAM input files are detected automatically '
+             'but BAM on stdin requires --bam.')
+
+    # Parent parser options for commands which filter read pairs.
+    filter_arg = argparse.ArgumentParser(add_help=False)
+    filter_arg.add_argument(
+        '--min_inward', default=None,
+        type=pct.positive_int,
+        help='Specify mininum insert size for inward facing read pairs.')
+    filter_arg.add_argument(
+        '--min_outward', default=None,
+        type=pct.positive_int,
+        help='Specify mininum insert size for outward facing read pairs.')
+    filter_arg.add_argument(
+        '--min_ditag', default=None,
+        type=pct.positive_int,
+        help='Specify minimum ditag size for read pairs.')
+    filter_arg.add_argument(
+        '--max_ditag', default=None,
+        type=pct.positive_int,
+        help='Specify maximum ditag size for read pairs.')
+    filter_arg.add_argument(
+        '--expr', action='append', default=None, metavar='EXPRESSION',
+        help='Retain read pairs for which EXPRESSION over the process '
+             'tags dt, is, fs, fn, or and it is true, e.g. '
+             '"it == \'cis\' and fs <= 1000". Repeat to require several '
+             'expressions; QC counts pairs failing each "and" clause.')
+
+    pairs_arg = argparse.ArgumentParser(add_help=False)
+    pairs_arg.add_argument(
+        '--pairs', default=None, metavar='FILE',
+        help='Also write read pairs to a sorted, block-compressed and '
+             'indexed .pairs file for region queries.')
+
+    decay_arg = argparse.ArgumentParser(add_help=False)
+    decay_arg.add_argument(
+        '--decay', default=None, metavar='FILE',
+        help='Also write the pyHiCTools decay table of output read pairs '
+             'to FILE.')
+
+    # Parent parser options for commands reading unpaired alignments.
+    mates_arg = argparse.ArgumentParser(add_help=False)
+    mates_arg.add_argument(
+        '--unsorted', action='store_true',
+        help='Input is not name sorted (e.g. coordinate sorted); pair '
+             'mates internally instead of requiring samtools sort -n.')
+    mates_arg.add_argument(
+        '--max_pending', default=MAX_PENDING,
+        type=pct.positive_int,
+        help='Unpaired alignments held in memory with --unsorted before '
+             'spilling to disk (default: %(default)s).')
+
+    # Parent parser options for digesting a reference on demand.
+    reference_arg = argparse.ArgumentParser(add_help=False)
+    reference_arg.add_argument(
+        '-d', '--digest', default=None,
+        help='Output of pyHiCTools digest (text or binary index) using '
+             'same reference genome as used to map reads. Text digests '
+             'are indexed and cached alongside the digest on first use.')
+    reference_arg.add_argument(
+        '--reference', default=None, metavar='FASTA',
+        help='Reference FASTA used to map reads; digested with '
+             '--restriction on first use and cached instead of --digest.')
+    reference_arg.add_argument(
+        '--restriction', default=None,
+        type=restriction_seq,
+        help='Restriction cut sequence with "^" to indicate cut site, '
+             'used with --reference. e.g. Mbol = ^GATC')
+    reference_arg.add_argument(
+        '--digest_cache', dest='cache_dir', default=None, metavar='DIR',
+        help='Directory of cached digests of --reference (default: '
+             '$PYHICTOOLS_CACHE or ~/.cache/pyHiCTools).')
+    reference_arg.add_argument(
+        '--cache_size', default=argparse.SUPPRESS,
+        type=pct.positive_int, metavar='MB',
+        help='Least recently used cached digests are removed beyond '
+             'this size (default: 2048).')
+
+    # Parent parser options for resumable runs.
+    checkpoint_arg = argparse.ArgumentParser(add_help=False)
+    checkpoint_arg.add_argument(
+        '--checkpoint', default=None, metavar='DIR',
+        help='Write output to sealed segments in DIR, recording the input '
+             'offset and QC of each, and copy them to stdout when done. '
+             'Requires SAM (plain or bgzip) input and output.')
+    checkpoint_arg.add_argument(
+        '--resume', action='store_true',
+        help='Continue the run checkpointed in --checkpoint DIR.')
+    checkpoint_arg.add_argument(
+        '--checkpoint_interval', default=argparse.SUPPRESS,
+        type=pct.positive_int, metavar='PAIRS',
+        help='Read pairs per checkpointed segment (default: 10000000).')
+
+    # Parent parser options for commands which can subsample read pairs.
+    subsample_arg = argparse.ArgumentParser(add_help=False)
+    subsample_arg.add_argument(
+        '--subsample', default=None, type=fraction, metavar='FRACTION',
+        help='Keep this fraction of read pairs, chosen by a hash of the '
+             'read name so the same pairs are kept at every stage.')
+    subsample_arg.add_argument(
+        '--seed', default=0, type=int,
+        help='Seed of the --subsample hash (default: %(default)s).')
+
     qc_arg = argparse.ArgumentParser(add_help=False)
     qc_arg.add_argument(
         '--qc', metavar='FILE', help='Output file for QC statistics.')
@@ -33,10 +155,17 @@ def main():
     # Digest sub-parser
     digest_parser = subparser.add_parser(
         'digest',
-        description=hic.digest.__doc__,
+        description=module_doc('digest'),
         help='Generate in silico restriction digest of reference FASTA.',
-        parents=[base_args, fastq_input_arg],
+        parents=[base_args, parallel_parser, fastq_input_arg],
         epilog=parser.epilog)
+    digest_parser.add_argument(
+        '--chunk_size', default=1048576,
+        type=pct.positive_int,
+        help='Number of bases of each reference to hold in memory at once.')
+    digest_parser.add_argument(
+        '--index', default=None, metavar='FILE',
+        help='Also write a binary digest index for pyHiCTools process.')
     requiredNamed_digest = digest_parser.add_argument_group(
         'required named arguments')
     requiredNamed_digest.add_argument(
@@ -44,85 +173,313 @@ def main():
         type=restriction_seq,
         help='''Restriction cut sequence with "^" to indicate cut site.
                   e.g. Mbol = ^GATC''')
-    digest_parser.set_defaults(function=hic.digest.digest)
+    digest_parser.set_defaults(function=command('digest', 'digest'))
 
     # Truncate sub-parser
     truncate_parser = subparser.add_parser(
         'truncate',
-        description=hic.truncate.__doc__,
+        description=module_doc('truncate'),
         help='Truncate FASTQ sequences at restriction enzyme ligation site.',
-        parents=[base_args, qc_arg, fastq_input_arg],
+        parents=[base_args, parallel_parser, qc_arg, subsample_arg,
+                 fastq_input_arg],
         epilog=parser.epilog)
     truncate_parser.add_argument(
         '-n', '--sample', default=None,
         help='Sample name in case infile name cannot be detected.')
+    truncate_parser.add_argument(
+        '--mate', default=None, metavar='FASTQ',
+        help='R2 FASTQ for paired-end mode. R1 and R2 are processed in '
+             'sync and QC is reported per read.')
+    truncate_parser.add_argument(
+        '-o', '--output', default=None, metavar='FILE',
+        help='Output file for truncated (R1) FASTQ (default: stdout).')
+    truncate_parser.add_argument(
+        '--mate_output', default=None, metavar='FILE',
+        help='Output file for truncated R2 FASTQ in paired-end mode.')
+    truncate_parser.add_argument(
+        '--compression', default=None, choices=['gzip', 'bgzf'],
+        help='Compress output in parallel blocks (default: gzip if '
+             '--output ends with ".gz").')
     requiredNamed_truncate = truncate_parser.add_argument_group(
         'required named arguments')
     requiredNamed_truncate.add_argument(
-        '-r', '--restriction', required=True,
+        '-r', '--restriction', required=True, action='append',
         type=restriction_seq,
         help=('Restriction cut sequence with "^" to indicate cut site.'
-              'e.g. Mbol = ^GATC'))
-    truncate_parser.set_defaults(function=hic.truncate.truncate)
+              'e.g. Mbol = ^GATC. Repeat for multiple enzymes; IUPAC '
+              'degenerate bases are supported, e.g. -r ^GATC -r G^ANTC'))
+    truncate_parser.set_defaults(function=command('truncate', 'truncate'))
 
     # Process sub-parser
     process_parser = subparser.add_parser(
         'process',
-        description=hic.process.__doc__,
+        description=module_doc('process'),
         help='Determine HiC fragment mappings from named-sorted SAM/BAM file.',
-        parents=[base_args, sam_input_arg],
+        parents=[base_args, parallel_parser, bam_arg, pairs_arg, decay_arg,
+                 mates_arg, reference_arg, checkpoint_arg, subsample_arg,
+                 sam_input_arg],
         epilog=parser.epilog)
-    requiredNamed_process = process_parser.add_argument_group(
-        'required named arguments')
-    requiredNamed_process.add_argument(
-        '-d', '--digest', required=True,
-        help='Output of pyHiCTools digest using same '
-             'reference genome as used to map reads.')
-    process_parser.set_defaults(function=hic.process.process)
+    process_parser.add_argument(
+        '--batch_size', default=None,
+        type=pct.positive_int,
+        help='Process read pairs in vectorised batches of this size.')
+    process_parser.set_defaults(function=command('process', 'process'))
 
     # Extract sub-parser
     extract_parser = subparser.add_parser(
         'extract',
-        description=hic.extract.__doc__,
+        description=module_doc('extract'),
         help='Extract HiC information encoded by hic process from SAM/BAM.',
-        parents=[base_args, sam_input_arg],
+        parents=[base_args, parallel_parser, bam_input_arg, subsample_arg,
+                 sam_input_arg],
         epilog=parser.epilog)
     extract_parser.add_argument(
         '-n', '--sample', default=None,
         help='Sample name for input.')
-    extract_parser.set_defaults(function=hic.extract.extract)
+    extract_parser.add_argument(
+        '--format', dest='output_format', default='tsv',
+        choices=['tsv', 'columnar', 'summary'],
+        help='Output a TSV row per read pair, columnar .npy files per '
+             'field (requires --output), or a table of log-binned '
+             'histograms per orientation and interaction type.')
+    extract_parser.add_argument(
+        '-o', '--output', default=None, metavar='PREFIX',
+        help='Output file prefix for columnar format.')
+    extract_parser.set_defaults(function=command('extract', 'extract'))
+
+    # Estimate sub-parser
+    estimate_parser = subparser.add_parser(
+        'estimate',
+        description=module_doc('estimate'),
+        help='Estimate filter thresholds from processed SAM/BAM.',
+        parents=[base_args, parallel_parser, bam_input_arg],
+        epilog=parser.epilog)
+    estimate_parser.add_argument(
+        'infiles', metavar='SAM', nargs='*',
+        help='Processed SAM/BAM files (default: stdin unless --sketch '
+             'is given).')
+    estimate_parser.add_argument(
+        '-n', '--sample', default=None,
+        help='Sample name for output.')
+    estimate_parser.add_argument(
+        '--sketch', dest='sketches', action='append', default=None,
+        metavar='FILE',
+        help='Merge a sketch saved by --save; may be repeated.')
+    estimate_parser.add_argument(
+        '--save', default=None, metavar='FILE',
+        help='Save the merged sketch to FILE (.npz).')
+    estimate_parser.add_argument(
+        '--max_pairs', default=None,
+        type=pct.positive_int,
+        help='Read at most this many pairs of each input.')
+    estimate_parser.add_argument(
+        '--quantile', default=0.01, type=float,
+        help='Fraction of pairs in each tail of the ditag length '
+             'distribution outside --min_ditag and --max_ditag '
+             '(default: %(default)s).')
+    estimate_parser.add_argument(
+        '--tolerance', default=0.025, type=float,
+        help='Maximum difference of Inward and Outward proportions from '
+             '0.25 (default: %(default)s).')
+    estimate_parser.add_argument(
+        '--min_count', default=1000,
+        type=pct.positive_int,
+        help='Ignore insert size bins with fewer cis pairs than this '
+             '(default: %(default)s).')
+    estimate_parser.set_defaults(function=command('estimate', 'estimate'))
+
+    # Decay sub-parser
+    decay_parser = subparser.add_parser(
+        'decay',
+        description=module_doc('decay'),
+        help='Summarise contact probability by separation and cis/trans '
+             'pairs per chromosome.',
+        parents=[base_args, parallel_parser, bam_input_arg, subsample_arg,
+                 sam_input_arg],
+        epilog=parser.epilog)
+    decay_parser.add_argument(
+        '-n', '--sample', default=None,
+        help='Sample name in case infile name cannot be detected.')
+    decay_parser.set_defaults(function=command('decay', 'decay'))
 
     # Filter sub-parser
     filter_parser = subparser.add_parser(
         'filter',
-        description=hic.filter.__doc__,
+        description=module_doc('filter'),
         help='Filter SAM/BAM file processed with pyHiCTools process.',
-        parents=[base_args, qc_arg, sam_input_arg],
+        parents=[base_args, parallel_parser, bam_arg, pairs_arg, decay_arg,
+                 qc_arg, filter_arg, checkpoint_arg, subsample_arg,
+                 sam_input_arg],
         epilog=parser.epilog)
     filter_parser.add_argument(
-        '--min_inward', default=None,
-        type=pct.positive_int,
-        help='Specify mininum insert size for inward facing read pairs.')
-    filter_parser.add_argument(
-        '--min_outward', default=None,
-        type=pct.positive_int,
-        help='Specify mininum insert size for outward facing read pairs.')
-    filter_parser.add_argument(
-        '--min_ditag', default=None,
+        '-n', '--sample', default=None,
+        help='Sample name in case infile name cannot be detected.')
+    filter_parser.set_defaults(function=command('filter', 'filter'))
+
+    # Deduplicate sub-parser
+    deduplicate_parser = subparser.add_parser(
+        'deduplicate',
+        description=module_doc('deduplicate'),
+        help='Remove PCR duplicate read pairs from processed SAM/BAM.',
+        parents=[base_args, parallel_parser, bam_arg, qc_arg, sam_input_arg],
+        epilog=parser.epilog)
+    deduplicate_parser.add_argument(
+        '-n', '--sample', default=None,
+        help='Sample name in case infile name cannot be detected.')
+    deduplicate_parser.add_argument(
+        '--max_keys', default=argparse.SUPPRESS,
         type=pct.positive_int,
-        help='Specify minimum ditag size for read pairs.')
-    filter_parser.add_argument(
-        '--max_ditag', default=None,
+        help='Read pair keys (8 bytes each) held in memory before '
+             'spilling to disk (default: 50000000).')
+    deduplicate_parser.set_defaults(
+        function=command('deduplicate', 'deduplicate'))
+
+    # Pipeline sub-parser
+    pipeline_parser = subparser.add_parser(
+        'pipeline',
+        description=module_doc('pipeline'),
+        help='Run process, filter and extract in a single pass.',
+        parents=[base_args, parallel_parser, bam_arg, pairs_arg, mates_arg,
+                 reference_arg, qc_arg, filter_arg, sam_input_arg],
+        epilog=parser.epilog)
+    pipeline_parser.add_argument(
+        '--extract', default=None, metavar='FILE',
+        help='Output file for pyHiCTools extract table of retained pairs.')
+    pipeline_parser.add_argument(
+        '--batch_size', default=None,
         type=pct.positive_int,
-        help='Specify maximum ditag size for read pairs.')
-    filter_parser.add_argument(
+        help='Read pairs per vectorised batch.')
+    pipeline_parser.add_argument(
         '-n', '--sample', default=None,
         help='Sample name in case infile name cannot be detected.')
-    filter_parser.set_defaults(function=hic.filter.filter)
+    pipeline_parser.set_defaults(function=command('pipeline', 'pipeline'))
+
+    # Batch sub-parser
+    batch_parser = subparser.add_parser(
+        'batch',
+        description=module_doc('batch'),
+        help='Run pipeline over the samples of a sample sheet.',
+        parents=[base_args, parallel_parser, bam_arg, mates_arg, qc_arg,
+                 filter_arg],
+        epilog=parser.epilog)
+    batch_parser.add_argument(
+        'sheet', metavar='SHEET',
+        help='Tab-separated file of sample name and SAM/BAM path.')
+    batch_parser.add_argument(
+        '--outdir', default='.', metavar='DIR',
+        help='Directory of per-sample output and QC (default: %(default)s).')
+    batch_parser.add_argument(
+        '-j', '--jobs', default=None,
+        type=pct.positive_int,
+        help='Samples to run at once; --threads are divided between '
+             'them (default: --threads).')
+    batch_parser.add_argument(
+        '--extract', action='store_true',
+        help='Also write the pyHiCTools extract table of each sample.')
+    batch_parser.add_argument(
+        '--batch_size', default=None,
+        type=pct.positive_int,
+        help='Read pairs per vectorised batch.')
+    requiredNamed_batch = batch_parser.add_argument_group(
+        'required named arguments')
+    requiredNamed_batch.add_argument(
+        '-d', '--digest', required=True,
+        help='Output of pyHiCTools digest (text or binary index) using '
+             'same reference genome as used to map reads.')
+    batch_parser.set_defaults(function=command('batch', 'batch'))
+
+    # Matrix sub-parser
+    matrix_parser = subparser.add_parser(
+        'matrix',
+        description=module_doc('matrix'),
+        help='Build sparse contact matrices from processed SAM/BAM.',
+        parents=[base_args, parallel_parser, bam_input_arg, sam_input_arg],
+        epilog=parser.epilog)
+    matrix_parser.add_argument(
+        '--resolutions', nargs='+', default=None, metavar='BP',
+        type=pct.positive_int,
+        help='Bin sizes of fixed resolution matrices '
+             '(default: 5kb, 10kb, 25kb, 50kb, 100kb, 250kb, 500kb, 1Mb).')
+    matrix_parser.add_argument(
+        '-d', '--digest', default=None,
+        help='Output of pyHiCTools digest; also build a fragment level '
+             'matrix from the fn:i tags of pyHiCTools process.')
+    matrix_parser.add_argument(
+        '--format', dest='output_format', default='npz',
+        choices=['npz', 'cool'],
+        help='Write one sparse .npz per resolution, or a cooler '
+             '.mcool (and .fragment.cool) file (requires h5py).')
+    requiredNamed_matrix = matrix_parser.add_argument_group(
+        'required named arguments')
+    requiredNamed_matrix.add_argument(
+        '-o', '--output', required=True, metavar='PREFIX',
+        help='Output file prefix.')
+    matrix_parser.set_defaults(function=command('matrix', 'matrix'))
+
+    # Query sub-parser
+    query_parser = subparser.add_parser(
+        'query',
+        description=module_doc('pairs_file'),
+        help='Query an indexed .pairs file by region.',
+        parents=[base_args],
+        epilog=parser.epilog)
+    query_parser.add_argument(
+        'infile', metavar='PAIRS',
+        help='Indexed .pairs file written with --pairs.')
+    query_parser.add_argument(
+        'region1', metavar='REGION',
+        help='Region as chrom or chrom:start-end, e.g. chr3:1-5Mb.')
+    query_parser.add_argument(
+        'region2', metavar='REGION', nargs='?', default=None,
+        help='Region of the other end of each pair (default: anywhere).')
+    query_parser.set_defaults(function=command('pairs_file', 'query'))
+
+    for command_parser in subparser.choices.values():
+        instrument.add_arguments(command_parser)
+        command_parser.set_defaults(function=instrument.wrap(
+            command_parser.get_default('function')))
 
     return (pct.execute(parser))
 
 
+def command(module, function):
+
+    ''' Return function of a pyHiCTools module which imports the module
+        when called, so only the subcommand that runs is imported.
+    '''
+
+    def run(**kwargs):
+        module_obj = importlib.import_module(f'pyHiCTools.{module}')
+        return getattr(module_obj, function)(**kwargs)
+
+    run.__name__ = function
+    return run
+
+
+def module_doc(module):
+
+    ''' Return docstring of a pyHiCTools module without importing it. '''
+
+    spec = importlib.util.find_spec(f'pyHiCTools.{module}')
+    with open(spec.origin) as f:
+        match = DOCSTRING.match(f.read())
+    return match.group(2) if match else None
+
+
+def fraction(value):
+
+    ''' Custom argument type for a fraction in (0, 1]. '''
+
+    try:
+        value = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{value} is not a number.')
+    if not 0 < value <= 1:
+        raise argparse.ArgumentTypeError(
+            f'Fraction {value} must be greater than 0 and at most 1.')
+    return value
+
+
 def restriction_seq(value):
 
     ''' Custom argument type for restriction enzyme argument. '''
@@ -130,8 +487,9 @@ def restriction_seq(value):
     if value.count('^') != 1:
         raise argparse.ArgumentTypeError(
             f'Restriction site {value} must contain one "^" at cut site.')
-    elif re.search('[^ATCG^]', value, re.IGNORECASE):
+    elif re.search('[^ATCGRYSWKMBDHVN^]', value, re.IGNORECASE):
         raise argparse.ArgumentTypeError(
-            f'Restriction site {value} must only contain "ATCG^".')
+            f'Restriction site {value} must only contain "^" and '
+            'IUPAC nucleotide codes.')
     else:
         return value.upper()
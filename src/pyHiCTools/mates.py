@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+""" Pair mates of SAM/BAM input in any order (e.g. coordinate-sorted)
+    so they can be processed without a separate sort by read name.
+
+    Records wait in a hash buffer keyed by read name until their mate
+    arrives and the pair is emitted, so name-grouped input passes
+    through unchanged. When more than max_pending records are waiting
+    they are written as a run sorted by name; the runs and remaining
+    records are k-way merged by name at the end of input to pair the
+    mates that were spilled. Secondary and supplementary alignments are
+    skipped.
+"""
+
+import os
+import sys
+import heapq
+import tempfile
+import itertools
+import pyCommonTools as pct
+
+
+# Records waiting for their mate before spilling a sorted run.
+MAX_PENDING = 1000000
+
+# Secondary and supplementary alignment flags.
+SKIP_FLAGS = 0x100 | 0x800
+
+
+class SamRuns:
+
+    ''' Read and write runs of SAM text records. '''
+
+    def name(self, line):
+        return line[:line.find('\t')]
+
+    def flag(self, line):
+        start = line.find('\t') + 1
+        return int(line[start:line.find('\t', start)])
+
+    def write(self, path, records):
+        with open(path, 'w') as out:
+            out.writelines(records)
+
+    def read(self, path):
+        with open(path) as f:
+            yield from f
+
+
+class BamRuns:
+
+    ''' Read and write runs of pysam segments as BAM files with the
+        header of template.
+    '''
+
+    def __init__(self, template):
+        self.template = template
+
+    def name(self, segment):
+        return segment.query_name
+
+    def flag(self, segment):
+        return segment.flag
+
+    def write(self, path, records):
+        import pysam
+        with pysam.AlignmentFile(path, 'wb', template=self.template) as out:
+            for segment in records:
+                out.write(segment)
+
+    def read(self, path):
+        import pysam
+        with pysam.AlignmentFile(path, 'rb') as f:
+            yield from f
+
+
+def pair_mates(records, runs=None, max_pending=MAX_PENDING):
+
+    ''' Yield records with each pair of mates adjacent, in the order the
+        pairs are completed. SAM header lines are yielded first as they
+        are encountered.
+    '''
+
+    log = pct.create_logger()
+
+    runs = runs or SamRuns()
+    pending = {}
+    skipped = 0
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = []
+        for record in records:
+            if isinstance(record, str) and record.startswith('@'):
+                yield record
+                continue
+            if runs.flag(record) & SKIP_FLAGS:
+                skipped += 1
+                continue
+            name = runs.name(record)
+            mate = pending.pop(name, None)
+            if mate is not None:
+                yield mate
+                yield record
+                continue
+            pending[name] = record
+            if len(pending) > max_pending:
+                paths.append(os.path.join(tmpdir, f'run{len(paths)}'))
+                runs.write(paths[-1],
+                           (pending[name] for name in sorted(pending)))
+                pending = {}
+        if skipped:
+            log.info(f'Skipped {skipped} secondary or supplementary '
+                     'alignments.')
+        if paths:
+            log.info(f'Merging {len(paths)} spilled runs of unpaired reads.')
+        remaining = [pending[name] for name in sorted(pending)]
+        merged = heapq.merge(
+            *[runs.read(path) for path in paths], remaining, key=runs.name)
+        unpaired = 0
+        for name, group in itertools.groupby(merged, key=runs.name):
+            group = list(group)
+            if len(group) == 2:
+                yield from group
+            elif len(group) == 1:
+                unpaired += 1
+            else:
+                log.error(f'{name} has {len(group)} primary alignments.')
+                sys.exit(1)
+        if unpaired:
+            log.warning(f'Discarded {unpaired} reads without a mate.')
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+
+""" Build sparse contact matrices at multiple resolutions in a single
+    pass over a SAM/BAM file processed by pyHiCTools process. Each pair
+    is binned by the 5' position of both reads (and, with a digest, by
+    the fn:i fragment tags) and encoded as an integer key of the upper
+    triangle bin pair. Keys are counted per chunk and merged, so memory
+    scales with the number of non-zero pixels rather than read pairs.
+"""
+
+import sys
+import json
+import numpy as np
+import pyCommonTools as pct
+from pyHiCTools.reader import read_batches, get_tags, CHUNK_SIZE
+from pyHiCTools.parallel import imap_chunks
+from pyHiCTools.digest_index import load_digest
+from pyHiCTools.process import parse_batch
+from pyHiCTools.bam import use_pysam, open_input, read_segment_batches
+
+
+RESOLUTIONS = [5000, 10000, 25000, 50000, 100000, 250000, 500000, 1000000]
+
+# Pending chunk keys held before merging into the running counts.
+MERGE_SIZE = 4194304
+
+# Per-process state set by set_worker.
+worker = {}
+
+
+def matrix(infile, output, resolutions=None, digest=None,
+           output_format='npz', threads=1, bam=False):
+
+    log = pct.create_logger()
+
+    resolutions = sorted(set(resolutions or RESOLUTIONS))
+
+    if use_pysam(infile, bam):
+        with open_input(infile, threads) as in_bam:
+            chroms = list(zip(in_bam.references, in_bam.lengths))
+            binnings = make_binnings(chroms, resolutions, digest)
+            chunks = (bam_columns(segments, digest is not None)
+                      for segments in read_segment_batches(in_bam, CHUNK_SIZE))
+            counts = imap_chunks(
+                count_bins, chunks, threads, initializer=set_worker,
+                initargs=(chroms, worker_binnings(binnings)))
+            matrices = count_matrices(counts, binnings)
+    else:
+        with pct.open(infile) as in_obj:
+            batches = read_batches(in_obj, CHUNK_SIZE)
+            header, batches = read_header(batches)
+            chroms = header_chroms(header)
+            binnings = make_binnings(chroms, resolutions, digest)
+            counts = imap_chunks(
+                sam_chunk, batches, threads, initializer=set_worker,
+                initargs=(chroms, worker_binnings(binnings)))
+            matrices = count_matrices(counts, binnings)
+
+    for binning, (keys, counts) in zip(binnings, matrices):
+        log.info(f'Resolution {binning["label"]}: {binning["nbins"]} bins, '
+                 f'{len(keys)} non-zero pixels.')
+    if output_format == 'cool':
+        write_cool(output, chroms, binnings, matrices)
+    else:
+        for binning, (keys, counts) in zip(binnings, matrices):
+            write_npz(f'{output}.{binning["label"]}.npz',
+                      chroms, binning, keys, counts)
+
+
+def read_header(batches):
+
+    ''' Return SAM header lines and an iterator of the remaining
+        alignment batches from read_batches.
+    '''
+
+    header = []
+    for is_header, lines in batches:
+        if not is_header:
+            return header, alignment_batches(lines, batches)
+        header.extend(lines)
+    return header, iter([])
+
+
+def alignment_batches(first, batches):
+
+    ''' Yield first and the alignment batches of read_batches. '''
+
+    yield first
+    for is_header, lines in batches:
+        if not is_header:
+            yield lines
+
+
+def header_chroms(header):
+
+    ''' Return list of (name, length) of @SQ lines of a SAM header. '''
+
+    log = pct.create_logger()
+
+    chroms = []
+    for line in header:
+        if not line.startswith('@SQ'):
+            continue
+        fields = dict(field.split(':', 1)
+                      for field in line.rstrip('\n').split('\t')[1:])
+        chroms.append((fields['SN'], int(fields['LN'])))
+    if not chroms:
+        log.error('No @SQ header lines; chromosome lengths are required.')
+        sys.exit(1)
+    return chroms
+
+
+def make_binnings(chroms, resolutions, digest=None):
+
+    ''' Return list of dicts describing each matrix: its label,
+        resolution (None for fragments), per-chromosome bin offsets and
+        total bin count. Fragment bins also hold fragment ends.
+    '''
+
+    log = pct.create_logger()
+
+    lengths = np.array([length for name, length in chroms], dtype=np.int64)
+    binnings = []
+    if digest is not None:
+        d = load_digest(digest)
+        missing = [name for name, length in chroms if name not in d]
+        if missing:
+            log.error(f'References {", ".join(missing)} not in digest.')
+            sys.exit(1)
+        ends = [np.asarray(d[name], dtype=np.int64) for name, length in chroms]
+        binnings.append(binning('fragment', None, [len(e) for e in ends]))
+        binnings[-1]['ends'] = ends
+    for resolution in resolutions:
+        binnings.append(binning(
+            str(resolution), resolution, -(-lengths // resolution)))
+    return binnings
+
+
+def binning(label, resolution, nbins):
+
+    offsets = np.zeros(len(nbins) + 1, dtype=np.int64)
+    np.cumsum(nbins, out=offsets[1:])
+    return {'label': label, 'resolution': resolution,
+            'offsets': offsets, 'nbins': int(offsets[-1])}
+
+
+def worker_binnings(binnings):
+
+    ''' Return binnings without fragment ends, which workers do not
+        need, to avoid copying them to every worker process.
+    '''
+
+    return [{key: value for key, value in binning.items() if key != 'ends'}
+            for binning in binnings]
+
+
+def set_worker(chroms, binnings):
+
+    worker['index'] = {name: i for i, (name, length) in enumerate(chroms)}
+    worker['binnings'] = binnings
+
+
+def sam_chunk(lines):
+
+    ''' Return counts of each matrix for a batch of SAM lines. '''
+
+    columns = parse_batch(lines)
+    index = worker['index']
+    codes = np.array([index[name] for name in columns['names']],
+                     dtype=np.int64)
+    fragment = None
+    if worker['binnings'][0]['resolution'] is None:
+        fragment = np.array([get_tags(line, ['fn:i'])['fn:i']
+                             for line in lines], dtype=np.int64)
+    return count_bins({
+        'chrom': codes[columns['rname']],
+        'position': np.where(
+            columns['reverse'], columns['right'], columns['left']),
+        'fragment': fragment})
+
+
+def bam_columns(segments, fragments):
+
+    ''' Return chromosome, 5' position and fragment arrays of a batch of
+        pysam segments.
+    '''
+
+    reverse = np.array([s.is_reverse for s in segments])
+    left = np.array([s.reference_start for s in segments], dtype=np.int64)
+    right = np.array([s.reference_end for s in segments], dtype=np.int64)
+    fragment = None
+    if fragments:
+        fragment = np.array([s.get_tag('fn') for s in segments],
+                            dtype=np.int64)
+    return {
+        'chrom': np.array([s.reference_id for s in segments], dtype=np.int64),
+        'position': np.where(reverse, right, left + 1),
+        'fragment': fragment}
+
+
+def count_bins(columns):
+
+    ''' Return list of (keys, counts) of upper triangle bin pairs of a
+        batch of read pairs for each matrix, with keys sorted.
+    '''
+
+    results = []
+    for binning in worker['binnings']:
+        if binning['resolution'] is None:
+            local = columns['fragment']
+        else:
+            local = (columns['position'] - 1) // binning['resolution']
+        bins = binning['offsets'][columns['chrom']] + local
+        low = np.minimum(bins[0::2], bins[1::2])
+        high = np.maximum(bins[0::2], bins[1::2])
+        results.append(np.unique(
+            low * binning['nbins'] + high, return_counts=True))
+    return results
+
+
+def count_matrices(chunk_counts, binnings):
+
+    ''' Merge per-chunk counts into one sorted (keys, counts) per
+        matrix, merging pending chunks whenever MERGE_SIZE keys are
+        held.
+    '''
+
+    matrices = [SparseCounts() for _ in binnings]
+    for results in chunk_counts:
+        for sparse, (keys, counts) in zip(matrices, results):
+            sparse.add(keys, counts)
+    return [sparse.result() for sparse in matrices]
+
+
+class SparseCounts:
+
+    ''' Running sum of counts of integer keys. '''
+
+    def __init__(self):
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.pending = []
+        self.size = 0
+
+    def add(self, keys, counts):
+        self.pending.append((keys, counts))
+        self.size += len(keys)
+        if self.size >= MERGE_SIZE:
+            self.merge()
+
+    def merge(self):
+        if not self.pending:
+            return
+        keys = np.concatenate([self.keys] + [k for k, c in self.pending])
+        counts = np.concatenate([self.counts] + [c for k, c in self.pending])
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.counts = np.zeros(len(self.keys), dtype=np.int64)
+        np.add.at(self.counts, inverse.reshape(-1), counts)
+        self.pending = []
+        self.size = len(self.keys)
+
+    def result(self):
+        self.merge()
+        return self.keys, self.counts
+
+
+def pixels(keys, nbins):
+
+    ''' Return bin1, bin2 and CSR row pointer of sorted keys. '''
+
+    bin1, bin2 = np.divmod(keys, nbins)
+    indptr = np.searchsorted(bin1, np.arange(nbins + 1), side='left')
+    return bin1, bin2, indptr
+
+
+def bin_table(chroms, binning):
+
+    ''' Return chromosome index, 0-based start and end of every bin. '''
+
+    chrom, start, end = [], [], []
+    for i, (name, length) in enumerate(chroms):
+        if binning['resolution'] is None:
+            ends = binning['ends'][i]
+            starts = np.concatenate([[0], ends[:-1]])
+        else:
+            starts = np.arange(0, length, binning['resolution'])
+            ends = np.minimum(starts + binning['resolution'], length)
+        chrom.append(np.full(len(starts), i, dtype=np.int32))
+        start.append(starts)
+        end.append(ends)
+    return (np.concatenate(chrom), np.concatenate(start).astype(np.int64),
+            np.concatenate(end).astype(np.int64))
+
+
+def write_npz(path, chroms, binning, keys, counts):
+
+    ''' Write upper triangle COO pixels and the CSR row pointer of a
+        matrix, with chromosome names, lengths and bin offsets.
+    '''
+
+    bin1, bin2, indptr = pixels(keys, binning['nbins'])
+    chrom, start, end = bin_table(chroms, binning)
+    np.savez_compressed(
+        path, bin1=bin1, bin2=bin2, count=counts, indptr=indptr,
+        chroms=np.array([name for name, length in chroms]),
+        lengths=np.array([length for name, length in chroms]),
+        chrom_offsets=binning['offsets'], resolution=binning['resolution'] or 0,
+        bin_chrom=chrom, bin_start=start, bin_end=end)
+
+
+def write_cool(prefix, chroms, binnings, matrices):
+
+    ''' Write fixed resolutions to a multi-resolution {prefix}.mcool and
+        fragment resolution to {prefix}.fragment.cool in the cooler
+        (format version 3) HDF5 layout.
+    '''
+
+    log = pct.create_logger()
+
+    try:
+        import h5py
+    except ImportError:
+        log.error('Cooler output requires h5py (pip install h5py).')
+        sys.exit(1)
+
+    fixed = [(b, m) for b, m in zip(binnings, matrices) if b['resolution']]
+    if fixed:
+        with h5py.File(f'{prefix}.mcool', 'w') as f:
+            f.attrs['format'] = 'HDF5::MCOOL'
+            f.attrs['format-version'] = 2
+            group = f.create_group('resolutions')
+            for binning, (keys, counts) in fixed:
+                write_cooler(group.create_group(binning['label']),
+                             chroms, binning, keys, counts)
+    for binning, (keys, counts) in zip(binnings, matrices):
+        if binning['resolution'] is None:
+            with h5py.File(f'{prefix}.fragment.cool', 'w') as f:
+                write_cooler(f, chroms, binning, keys, counts)
+
+
+def write_cooler(group, chroms, binning, keys, counts):
+
+    ''' Write one matrix to an HDF5 group in the cooler layout. '''
+
+    options = {'compression': 'gzip', 'compression_opts': 6}
+    names = [name.encode() for name, length in chroms]
+    width = max(len(name) for name in names)
+    group.create_dataset(
+        'chroms/name', data=np.array(names, dtype=f'S{width}'), **options)
+    group.create_dataset(
+        'chroms/length', data=np.array(
+            [length for name, length in chroms], dtype=np.int32), **options)
+    chrom, start, end = bin_table(chroms, binning)
+    group.create_dataset('bins/chrom', data=chrom, **options)
+    group.create_dataset('bins/start', data=start.astype(np.int32), **options)
+    group.create_dataset('bins/end', data=end.astype(np.int32), **options)
+    bin1, bin2, indptr = pixels(keys, binning['nbins'])
+    group.create_dataset('pixels/bin1_id', data=bin1, **options)
+    group.create_dataset('pixels/bin2_id', data=bin2, **options)
+    group.create_dataset(
+        'pixels/count', data=counts.astype(np.int32), **options)
+    group.create_dataset(
+        'indexes/chrom_offset', data=binning['offsets'], **options)
+    group.create_dataset('indexes/bin1_offset', data=indptr, **options)
+    group.attrs.update({
+        'format': 'HDF5::Cooler',
+        'format-version': 3,
+        'bin-type': 'fixed' if binning['resolution'] else 'variable',
+        'bin-size': binning['resolution'] or 'null',
+        'storage-mode': 'symmetric-upper',
+        'nbins': binning['nbins'],
+        'nchroms': len(chroms),
+        'nnz': len(keys),
+        'genome-assembly': 'unknown',
+        'metadata': json.dumps({}),
+        'generated-by': 'pyHiCTools',
+    })
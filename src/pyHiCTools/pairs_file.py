@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+
+""" Write and query block-compressed, indexed 4DN .pairs files of read
+    pairs processed by pyHiCTools.
+
+    Rows are upper triangle (chr1/pos1 before chr2/pos2 in reference
+    order, by 5' position) and sorted by chr1, chr2, pos1, pos2, as for
+    pairix, so each chromosome pair is contiguous. Sorting uses a bounded
+    in-memory buffer spilled to sorted temporary runs and merged on
+    close. Rows are written in BGZF blocks that never span a change of
+    chromosome pair, so the file remains readable with zcat, and a
+    tab separated index ({path}.idx) records the chromosome pair,
+    position ranges, offset and length of every block. Queries read
+    only the blocks that overlap the requested regions.
+"""
+
+import os
+import re
+import sys
+import gzip
+import heapq
+import bisect
+import tempfile
+import collections
+from contextlib import ExitStack
+import pyCommonTools as pct
+from pyHiCTools.reader import get_tags, reference_length
+from pyHiCTools.parallel import imap_chunks
+from pyHiCTools.compress import compress, BGZF_EOF
+
+
+COLUMNS = ['readID', 'chr1', 'pos1', 'chr2', 'pos2', 'strand1', 'strand2',
+           'frag1', 'frag2', 'orientation', 'interaction_type',
+           'ditag_length', 'insert_size', 'fragment_seperation']
+
+# Optional tags of read 1 written as pairs columns.
+PAIRS_TAGS = ['or:Z', 'it:Z', 'dt:i', 'is:i', 'fs:i', 'fn:i']
+
+# Rows held in memory before spilling a sorted run to disk.
+BUFFER_ROWS = 1000000
+
+# Maximum rows per indexed block.
+BLOCK_ROWS = 4096
+
+INDEX_SUFFIX = 'idx'
+
+Region = collections.namedtuple('Region', 'chrom start end')
+
+
+class PairsWriter:
+
+    ''' Accumulate processed read pairs and write them as a sorted,
+        indexed .pairs file on close.
+    '''
+
+    def __init__(self, path, threads=1, buffer_rows=BUFFER_ROWS):
+        self.path = path
+        self.threads = threads
+        self.buffer_rows = buffer_rows
+        self.chroms = {}
+        self.sizes = []
+        self.rows = []
+        self.runs = []
+        self.tmpdir = tempfile.TemporaryDirectory(
+            dir=os.path.dirname(os.path.abspath(path)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.tmpdir.cleanup()
+
+    def chrom_index(self, chrom):
+        if chrom not in self.chroms:
+            self.chroms[chrom] = len(self.chroms)
+        return self.chroms[chrom]
+
+    def set_chroms(self, names, lengths):
+        for name, length in zip(names, lengths):
+            self.chrom_index(name)
+            self.sizes.append((name, length))
+
+    def add_sam(self, text):
+
+        ''' Add processed SAM text of header lines and complete pairs. '''
+
+        lines = iter(text.splitlines())
+        for line in lines:
+            if line.startswith('@'):
+                if line.startswith('@SQ'):
+                    fields = dict(field.split(':', 1)
+                                  for field in line.split('\t')[1:])
+                    self.set_chroms([fields['SN']], [int(fields['LN'])])
+                continue
+            self.add_row(*sam_pair(line, next(lines)))
+
+    def add_segments(self, segments):
+
+        ''' Add a batch of processed pysam segments. '''
+
+        it = iter(segments)
+        for read1, read2 in zip(it, it):
+            self.add_row(*segment_pair(read1, read2))
+
+    def add_row(self, name, ends, tags):
+        ends = [(self.chrom_index(chrom), pos, chrom, strand, fragment)
+                for chrom, pos, strand, fragment in ends]
+        ends.sort()
+        (i1, pos1, chr1, strand1, frag1), \
+            (i2, pos2, chr2, strand2, frag2) = ends
+        self.rows.append((
+            (i1, i2, pos1, pos2),
+            f'{name}\t{chr1}\t{pos1}\t{chr2}\t{pos2}\t{strand1}\t{strand2}\t'
+            f'{frag1}\t{frag2}\t{tags["or:Z"]}\t{tags["it:Z"]}\t'
+            f'{tags["dt:i"]}\t{tags["is:i"]}\t{tags["fs:i"]}\n'))
+        if len(self.rows) >= self.buffer_rows:
+            self.spill()
+
+    def spill(self):
+
+        ''' Write buffered rows to a sorted temporary run. '''
+
+        self.rows.sort(key=lambda row: row[0])
+        fd, path = tempfile.mkstemp(dir=self.tmpdir.name, suffix='.pairs')
+        with os.fdopen(fd, 'w') as out:
+            out.writelines(line for key, line in self.rows)
+        self.runs.append(path)
+        self.rows = []
+
+    def row_key(self, line):
+        fields = line.split('\t', 5)
+        return (self.chroms[fields[1]], self.chroms[fields[3]],
+                int(fields[2]), int(fields[4]))
+
+    def sorted_rows(self, stack):
+        self.rows.sort(key=lambda row: row[0])
+        buffered = (line for key, line in self.rows)
+        runs = [stack.enter_context(open(path)) for path in self.runs]
+        return heapq.merge(*runs, buffered, key=self.row_key)
+
+    def close(self):
+
+        ''' Merge sorted runs and write the compressed file and index. '''
+
+        log = pct.create_logger()
+
+        header = ''.join(
+            ['## pairs format v1.0\n',
+             '#sorted: chr1-chr2-pos1-pos2\n',
+             '#shape: upper triangle\n']
+            + [f'#chromsize: {name} {length}\n' for name, length in self.sizes]
+            + [f'#columns: {" ".join(COLUMNS)}\n'])
+        with ExitStack() as stack:
+            out = stack.enter_context(open(self.path, 'wb'))
+            index = stack.enter_context(
+                open(f'{self.path}.{INDEX_SUFFIX}', 'w'))
+            index.write('#chr1\tchr2\tpos1_start\tpos1_end\tpos2_start\t'
+                        'pos2_end\toffset\tlength\n')
+            out.write(compress(header.encode(), 'bgzf'))
+            blocks = row_blocks(self.sorted_rows(stack), BLOCK_ROWS)
+            nblocks = 0
+            for entry, data in imap_chunks(
+                    compress_block, blocks, self.threads):
+                index.write('\t'.join(map(str, entry))
+                            + f'\t{out.tell()}\t{len(data)}\n')
+                out.write(data)
+                nblocks += 1
+            out.write(BGZF_EOF)
+        log.info(f'Wrote {nblocks} indexed blocks to {self.path}.')
+
+
+class Tee:
+
+    ''' Forward the calls of PairsWriter to several writers. '''
+
+    def __init__(self, writers):
+        self.writers = writers
+
+    def set_chroms(self, names, lengths):
+        for writer in self.writers:
+            writer.set_chroms(names, lengths)
+
+    def add_sam(self, text):
+        for writer in self.writers:
+            writer.add_sam(text)
+
+    def add_segments(self, segments):
+        for writer in self.writers:
+            writer.add_segments(segments)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+def combine_writers(writers):
+
+    ''' Return None, the only writer, or a Tee of writers. '''
+
+    if not writers:
+        return None
+    return writers[0] if len(writers) == 1 else Tee(writers)
+
+
+def sam_pair(line1, line2):
+
+    ''' Return read name, (chrom, 5' position, strand, fragment) of each
+        read and HiC tags of a pair of processed SAM lines.
+    '''
+
+    tags = get_tags(line1, PAIRS_TAGS)
+    fragment2 = get_tags(line2, ['fn:i'])['fn:i']
+    ends = []
+    lefts = []
+    for line in (line1, line2):
+        name, flag, chrom, pos, mapq, cigar = line.split('\t', 6)[:6]
+        pos = int(pos)
+        lefts.append(pos)
+        if int(flag) & 0x10:
+            ends.append((chrom, pos + reference_length(cigar) - 1, '-'))
+        else:
+            ends.append((chrom, pos, '+'))
+    return name, fragment_ends(
+        ends, *lefts, tags['fn:i'], fragment2), tags
+
+
+def segment_pair(read1, read2):
+
+    ''' Return read name, ends and HiC tags of a pair of processed pysam
+        segments, as sam_pair.
+    '''
+
+    tags = {tag: read1.get_tag(tag[:2]) for tag in PAIRS_TAGS}
+    ends = []
+    for read in (read1, read2):
+        if read.is_reverse:
+            ends.append((read.reference_name, read.reference_end, '-'))
+        else:
+            ends.append((read.reference_name, read.reference_start + 1, '+'))
+    return read1.query_name, fragment_ends(
+        ends, read1.reference_start, read2.reference_start,
+        tags['fn:i'], read2.get_tag('fn')), tags
+
+
+def fragment_ends(ends, left1, left2, fragment1, fragment2):
+
+    ''' Return ends with the fragment number of each read. Process
+        tags read 1 with the fragment of the leftmost read of cis pairs,
+        so fn:i tags are swapped back when the reads were reordered.
+    '''
+
+    (chrom1, pos1, strand1), (chrom2, pos2, strand2) = ends
+    if chrom1 == chrom2 and left1 > left2:
+        fragment1, fragment2 = fragment2, fragment1
+    return [(chrom1, pos1, strand1, fragment1),
+            (chrom2, pos2, strand2, fragment2)]
+
+
+def row_blocks(rows, block_rows):
+
+    ''' Yield (index entry, text) of blocks of up to block_rows sorted
+        rows, starting a new block at every change of chromosome pair.
+        Index entries are chr1, chr2, pos1 range and pos2 range.
+    '''
+
+    block = []
+    entry = None
+    for line in rows:
+        fields = line.split('\t', 5)
+        chr1, pos1, chr2, pos2 = fields[1], int(fields[2]), \
+            fields[3], int(fields[4])
+        if entry and (len(block) >= block_rows
+                      or (chr1, chr2) != (entry[0], entry[1])):
+            yield entry, ''.join(block)
+            block = []
+            entry = None
+        if entry is None:
+            entry = [chr1, chr2, pos1, pos1, pos2, pos2]
+        entry[3] = pos1
+        entry[4] = min(entry[4], pos2)
+        entry[5] = max(entry[5], pos2)
+        block.append(line)
+    if block:
+        yield entry, ''.join(block)
+
+
+def compress_block(block):
+
+    entry, text = block
+    return entry, compress(text.encode(), 'bgzf')
+
+
+def query(infile, region1, region2=None):
+
+    ''' Write header and rows of an indexed .pairs file with one end in
+        region1 and the other in region2 (anywhere if not given).
+    '''
+
+    log = pct.create_logger()
+
+    index = read_index(f'{infile}.{INDEX_SUFFIX}')
+    regions = [parse_region(region1),
+               parse_region(region2) if region2 else Region(None, 1, None)]
+    blocks = set()
+    for first, second in (regions, regions[::-1]):
+        blocks.update(find_blocks(index, first, second))
+    log.info(f'Reading {len(blocks)} of '
+             f'{sum(len(v) for v in index.values())} blocks.')
+
+    with open(infile, 'rb') as f:
+        header = []
+        for line in gzip.open(f, 'rt'):
+            if not line.startswith('#'):
+                break
+            header.append(line)
+        sys.stdout.write(''.join(header))
+        for offset, length in sorted(blocks):
+            f.seek(offset)
+            out = []
+            for line in gzip.decompress(f.read(length)).decode().splitlines(
+                    keepends=True):
+                fields = line.split('\t', 5)
+                ends = [(fields[1], int(fields[2])),
+                        (fields[3], int(fields[4]))]
+                if ((in_region(regions[0], *ends[0])
+                        and in_region(regions[1], *ends[1]))
+                        or (in_region(regions[1], *ends[0])
+                            and in_region(regions[0], *ends[1]))):
+                    out.append(line)
+            sys.stdout.write(''.join(out))
+
+
+def read_index(path):
+
+    ''' Return dict of chromosome pair to list of index entries
+        (pos1_start, pos1_end, pos2_start, pos2_end, offset, length) in
+        file order.
+    '''
+
+    index = collections.defaultdict(list)
+    with open(path) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            chr1, chr2, *values = line.split('\t')
+            index[(chr1, chr2)].append(tuple(map(int, values)))
+    return index
+
+
+def find_blocks(index, first, second):
+
+    ''' Return set of (offset, length) of blocks which may contain rows
+        with chr1/pos1 in region first and chr2/pos2 in region second.
+    '''
+
+    blocks = set()
+    for (chr1, chr2), entries in index.items():
+        if first.chrom not in (None, chr1) or second.chrom not in (None, chr2):
+            continue
+        # Blocks of a chromosome pair are sorted by pos1.
+        ends = [entry[1] for entry in entries]
+        for entry in entries[bisect.bisect_left(ends, first.start):]:
+            if first.end is not None and entry[0] > first.end:
+                break
+            if entry[3] >= second.start and (
+                    second.end is None or entry[2] <= second.end):
+                blocks.add((entry[4], entry[5]))
+    return blocks
+
+
+def in_region(region, chrom, pos):
+    return (region.chrom in (None, chrom) and pos >= region.start
+            and (region.end is None or pos <= region.end))
+
+
+def parse_region(region):
+
+    ''' Return Region of chrom[:start-end] with 1-based inclusive
+        coordinates, allowing commas and kb/Mb/Gb suffixes.
+    '''
+
+    log = pct.create_logger()
+
+    match = re.fullmatch(r'([^:]+)(?::([\d,.]+[kmg]?b?)-([\d,.]+[kmg]?b?))?',
+                         region, re.IGNORECASE)
+    if match is None:
+        log.error(f'Invalid region {region}.')
+        sys.exit(1)
+    chrom, start, end = match.groups()
+    if start is None:
+        return Region(chrom, 1, None)
+    return Region(chrom, region_position(start), region_position(end))
+
+
+def region_position(value):
+
+    value = value.lower().replace(',', '').rstrip('b')
+    scale = {'k': 10**3, 'm': 10**6, 'g': 10**9}.get(value[-1:], 1)
+    if scale > 1:
+        value = value[:-1]
+    return int(float(value) * scale)
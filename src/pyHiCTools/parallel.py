@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+""" Run a function over chunks of input in a pool of worker processes
+    while preserving input order.
+
+    Reading (including decompression) and writing run in their own
+    threads, connected to the compute stage by bounded queues, so I/O
+    overlaps computation while memory use stays bounded: a full queue
+    blocks the stage feeding it.
+"""
+
+import queue
+import threading
+import collections
+import multiprocessing
+from pyHiCTools import instrument
+
+
+# Items buffered in the queue between two stages.
+QUEUE_DEPTH = 4
+
+# Characters joined into each write by a Writer.
+WRITE_SIZE = 1048576
+
+# Marks the end of a stage queue.
+DONE = object()
+
+
+def imap_chunks(function, chunks, threads=1, initializer=None, initargs=()):
+
+    ''' Yield function(chunk) for each chunk in input order. With more
+        than one thread, chunks are processed by a pool of worker
+        processes with at most 2 * threads chunks in flight, so memory
+        use is bounded regardless of input size. Per-worker state is set
+        up by initializer(*initargs) in each worker.
+    '''
+
+    chunks = prefetch(instrument.timed_iter('read', chunks))
+    if threads == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for chunk in chunks:
+            with instrument.stage(function.__name__):
+                result = function(chunk)
+            with instrument.stage('write'):
+                yield result
+        return
+
+    with multiprocessing.Pool(threads, initializer, initargs) as pool:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(submit(pool, function, chunk))
+            if len(pending) >= 2 * threads:
+                yield from collect(pending.popleft())
+        while pending:
+            yield from collect(pending.popleft())
+
+
+def submit(pool, function, chunk):
+    if instrument.enabled():
+        return pool.apply_async(instrument.call_timed, (function, chunk))
+    return pool.apply_async(function, (chunk,))
+
+
+def collect(pending):
+
+    ''' Yield the result of a submitted chunk, merging any worker stage
+        timings.
+    '''
+
+    if not instrument.enabled():
+        yield pending.get()
+        return
+    with instrument.stage('wait'):
+        result, timings = pending.get()
+    instrument.merge(timings)
+    with instrument.stage('write'):
+        yield result
+
+
+def prefetch(iterable, name='read', depth=QUEUE_DEPTH):
+
+    ''' Yield items of iterable, produced by a background thread up to
+        depth items ahead of the consumer. Exceptions raised producing
+        items, including SystemExit, are re-raised in the consumer.
+    '''
+
+    items = queue.Queue(depth)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(items, item, stop):
+                    return
+        except BaseException as error:
+            put(items, (DONE, error), stop)
+        else:
+            put(items, (DONE, None), stop)
+
+    thread = threading.Thread(target=produce, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            instrument.queue_depth(name, items.qsize(), depth)
+            item = items.get()
+            if type(item) is tuple and item and item[0] is DONE:
+                if item[1] is not None:
+                    raise item[1]
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def put(items, item, stop):
+
+    ''' Put item on a bounded queue unless stop is set while waiting.
+        Return False if stopped.
+    '''
+
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+class Writer:
+
+    ''' Write to a file object from a background thread. Queued writes
+        are joined into writes of up to WRITE_SIZE, and write() blocks
+        while depth writes are queued. An error writing is raised by
+        the next call of write() or close().
+    '''
+
+    def __init__(self, out, name='output', depth=QUEUE_DEPTH):
+        self.out = out
+        self.name = name
+        self.depth = depth
+        self.items = queue.Queue(depth)
+        self.error = None
+        self.thread = threading.Thread(
+            target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.thread.is_alive():
+            self.items.put(DONE)
+            self.thread.join()
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        instrument.queue_depth(self.name, self.items.qsize(), self.depth)
+        self.items.put(data)
+
+    def run(self):
+        done = False
+        while not done:
+            data = []
+            size = 0
+            item = self.items.get()
+            while True:
+                if item is DONE:
+                    done = True
+                    break
+                data.append(item)
+                size += len(item)
+                if size >= WRITE_SIZE:
+                    break
+                try:
+                    item = self.items.get_nowait()
+                except queue.Empty:
+                    break
+            if not data or self.error is not None:
+                # Writes after an error are discarded so write() never
+                # blocks on a full queue.
+                continue
+            try:
+                with instrument.stage(self.name):
+                    self.out.write(data[0][:0].join(data))
+            except BaseException as error:
+                self.error = error
+
+    def close(self):
+
+        ''' Wait for queued writes, flush the output and raise any error
+            writing.
+        '''
+
+        if self.thread.is_alive():
+            self.items.put(DONE)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+        self.out.flush()
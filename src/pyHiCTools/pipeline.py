@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+""" Run process, filter and extract in a single pass over named-sorted
+    SAM/BAM. Each read pair is parsed once, assigned to restriction
+    fragments, filtered and written once, and the extract table and
+    filter QC are computed from the same in-memory pair.
+"""
+
+import sys
+import collections
+import pyCommonTools as pct
+from contextlib import ExitStack
+from pyHiCTools.reader import read_batches, CHUNK_SIZE
+from pyHiCTools.parallel import imap_chunks
+from pyHiCTools.digest_index import load_digest
+from pyHiCTools.digest_cache import resolve_digest, CACHE_SIZE
+from pyHiCTools.process import (
+    parse_batch, batch_filter, format_pairs, segment_columns, tag_segments)
+from pyHiCTools.filter import apply_filter, check_clauses, write_qc
+from pyHiCTools.extract import stats_rows, HEADER
+from pyHiCTools.expression import compile_clauses
+from pyHiCTools.pairs_file import PairsWriter
+from pyHiCTools.mates import pair_mates, BamRuns, MAX_PENDING
+from pyHiCTools.bam import (
+    use_pysam, open_input, open_output, read_segment_batches)
+
+
+# Per-process state set by set_worker.
+worker = {}
+
+
+def pipeline(infile, digest, qc, sample, min_inward, min_outward,
+             min_ditag, max_ditag, extract=None, batch_size=None,
+             threads=1, bam=False, pairs=None, unsorted=False,
+             max_pending=MAX_PENDING, expr=None, reference=None,
+             restriction=None, cache_dir=None, cache_size=CACHE_SIZE):
+
+    log = pct.create_logger()
+    inputs = [min_inward, min_outward, max_ditag, min_ditag]
+    if all(i is None for i in inputs) and not expr:
+        log.error('No filter settings defined.')
+        sys.exit(1)
+    clauses = check_clauses(expr)
+
+    if not sample:
+        if infile == '-':
+            sample = 'stdin'
+        else:
+            sample = infile
+
+    thresholds = {'min_inward': min_inward, 'min_outward': min_outward,
+                  'min_ditag': min_ditag, 'max_ditag': max_ditag}
+    batch_size = batch_size or CHUNK_SIZE
+    # Digest may be preloaded by pyHiCTools batch.
+    if not isinstance(digest, dict):
+        digest = resolve_digest(digest, reference, restriction, threads,
+                                cache_dir, cache_size)
+    d = load_digest(digest) if isinstance(digest, str) else digest
+
+    with ExitStack() as stack:
+        extract_out = None
+        if extract:
+            extract_out = stack.enter_context(pct.open(extract, mode='w'))
+            extract_out.write(HEADER)
+        writer = None
+        if pairs:
+            writer = stack.enter_context(PairsWriter(pairs, threads))
+
+        if use_pysam(infile, bam):
+            set_worker(d, thresholds, sample, extract_out is not None, expr)
+            counts = pipeline_bam(infile, batch_size, threads, bam,
+                                  extract_out, writer, unsorted, max_pending)
+        else:
+            in_obj = stack.enter_context(pct.open(infile))
+            if unsorted:
+                in_obj = pair_mates(in_obj, max_pending=max_pending)
+            # Worker processes memory-map the cached index themselves.
+            shared = d
+            if threads > 1 and isinstance(digest, str) and digest != '-':
+                shared = digest
+            counts = collections.Counter()
+            chunks = read_batches(in_obj, batch_size)
+            for out, rows, chunk_counts in imap_chunks(
+                    pipeline_chunk, chunks, threads, initializer=set_worker,
+                    initargs=(shared, thresholds, sample,
+                              extract_out is not None, expr)):
+                sys.stdout.write(out)
+                if extract_out is not None:
+                    extract_out.write(rows)
+                if writer is not None:
+                    writer.add_sam(out)
+                counts.update(chunk_counts)
+        if writer is not None:
+            writer.close()
+
+    write_qc(qc, sample, counts, min_inward, min_outward,
+             min_ditag, max_ditag, clauses)
+
+
+def set_worker(digest, thresholds, sample, extract, expr=None):
+
+    if isinstance(digest, str):
+        digest = load_digest(digest)
+    worker['digest'] = digest
+    worker['thresholds'] = thresholds
+    worker['sample'] = sample
+    worker['extract'] = extract
+    worker['clauses'] = compile_clauses(expr or [])
+
+
+def pipeline_chunk(chunk):
+
+    ''' Return retained SAM records, extract rows and filter counts of
+        a chunk from read_batches.
+    '''
+
+    is_header, lines = chunk
+    if is_header:
+        return ''.join(lines), '', {}
+    stats = batch_filter(parse_batch(lines), worker['digest'])
+    retained, counts = apply_filter(
+        stats, worker['thresholds'], worker['clauses'])
+    stats = {key: values[retained] for key, values in stats.items()}
+    lines = [line for i in retained for line in lines[2 * i: 2 * i + 2]]
+    out = ''.join(format_pairs(lines, stats, worker['digest']))
+    rows = stats_rows(stats, worker['sample']) if worker['extract'] else ''
+    return out, rows, counts
+
+
+def pipeline_bam(infile, batch_size, threads, bam, extract_out,
+                 writer=None, unsorted=False, max_pending=MAX_PENDING):
+
+    ''' Run pipeline with pysam and return filter counts. '''
+
+    counts = collections.Counter()
+    with open_input(infile, threads) as in_bam, \
+            open_output(in_bam, threads, bam) as out_bam:
+        if writer is not None:
+            writer.set_chroms(in_bam.references, in_bam.lengths)
+        in_segments = in_bam
+        if unsorted:
+            in_segments = pair_mates(in_bam, BamRuns(in_bam), max_pending)
+        for segments in read_segment_batches(in_segments, batch_size):
+            columns = segment_columns(segments, in_bam.references)
+            stats = batch_filter(columns, worker['digest'])
+            retained, batch_counts = apply_filter(
+                stats, worker['thresholds'], worker['clauses'])
+            counts.update(batch_counts)
+            stats = {key: values[retained] for key, values in stats.items()}
+            segments = [segment for i in retained
+                        for segment in segments[2 * i: 2 * i + 2]]
+            tag_segments(segments, stats)
+            for segment in segments:
+                out_bam.write(segment)
+            if writer is not None:
+                writer.add_segments(segments)
+            if extract_out is not None:
+                extract_out.write(stats_rows(stats, worker['sample']))
+    return counts
+
@@ -3,46 +3,351 @@
 """ Process named-sorted SAM/BAM alignment files to identify fragment
     mapping, insert size, ditag size and relative orientation of pairs.
 """
+import re
 import sys
-import bisect
 import math
 import fileinput
+import numpy as np
 import pyCommonTools as pct
 import pyHiCTools as hic
+from contextlib import ExitStack
+from pyHiCTools import instrument
+from pyHiCTools.reader import (
+    read_batches, pairs, reference_length, CHUNK_SIZE)
+from pyHiCTools.parallel import imap_chunks, Writer
+from pyHiCTools.digest_index import load_digest
+from pyHiCTools.digest_cache import resolve_digest, CACHE_SIZE
+from pyHiCTools.pairs_file import PairsWriter, combine_writers
+from pyHiCTools.checkpoint import open_checkpoint, CHECKPOINT_INTERVAL
+from pyHiCTools.mates import pair_mates, BamRuns, MAX_PENDING
+from pyHiCTools.subsample import make_subsample, sam_lines
+from pyHiCTools.bam import (
+    use_pysam, open_input, open_output, read_segment_batches)
 
 
-def process(infile, digest):
-
-    log = pct.create_logger()
-
-    with pct.open(infile) as in_obj, pct.open(digest) as digest:
-
-        d = process_digest(digest)
-        for line in in_obj:
-            if line.startswith("@"):
-                sys.stdout.write(line)
-                continue
-            else:
-                try:
-                    read1 = pct.Sam(line)
-                    read2 = pct.Sam(next(in_obj))
-                except StopIteration:
-                    log.exception("Odd number of alignments in file")
-                filter_stats = run_filter(read1, read2, d)
-                read1.optional['or:Z'] = filter_stats['orientation']
-                read2.optional['or:Z'] = filter_stats['orientation']
-                read1.optional['it:Z'] = filter_stats['interaction']
-                read2.optional['it:Z'] = filter_stats['interaction']
-                read1.optional['dt:i'] = filter_stats['ditag_length']
-                read2.optional['dt:i'] = filter_stats['ditag_length']
-                read1.optional['is:i'] = filter_stats['insert_size']
-                read2.optional['is:i'] = filter_stats['insert_size']
-                read1.optional['fs:i'] = filter_stats['fragment_seperation']
-                read2.optional['fs:i'] = filter_stats['fragment_seperation']
-                read1.optional['fn:i'] = filter_stats['read1_fragment']
-                read2.optional['fn:i'] = filter_stats['read2_fragment']
-                sys.stdout.write(read1.get_record())
-                sys.stdout.write(read2.get_record())
+ORIENTATIONS = ['Same-forward', 'Inward', 'Outward', 'Same-reverse']
+INTERACTIONS = ['cis', 'trans']
+PROCESS_TAGS = re.compile(r'\t(?:or|it|dt|is|fs|fn):[Zi]:')
+
+# Per-process state set by set_worker.
+worker = {}
+
+
+def process(infile, digest=None, batch_size=None, threads=1, bam=False,
+            pairs=None, unsorted=False, max_pending=MAX_PENDING,
+            reference=None, restriction=None, cache_dir=None,
+            cache_size=CACHE_SIZE, checkpoint=None, resume=False,
+            checkpoint_interval=CHECKPOINT_INTERVAL, subsample=None, seed=0,
+            decay=None):
+
+    keep = make_subsample(subsample, seed)
+    digest = resolve_digest(digest, reference, restriction, threads,
+                            cache_dir, cache_size)
+    d = load_digest(digest)
+    if checkpoint:
+        cp = open_checkpoint(
+            checkpoint, infile,
+            ['process', digest, batch_size, subsample, seed], resume,
+            checkpoint_interval, bam, pairs or decay, unsorted)
+        shared = digest if threads > 1 and digest != '-' else d
+        for out in imap_chunks(
+                process_chunk, cp.chunks(batch_size or CHUNK_SIZE, keep),
+                threads,
+                initializer=set_worker, initargs=(shared, batch_size)):
+            cp.write(out)
+        cp.finish()
+        return
+    with ExitStack() as stack:
+        writers = []
+        if pairs:
+            writers.append(stack.enter_context(PairsWriter(pairs, threads)))
+        if decay:
+            # Imported here as decay imports process.
+            from pyHiCTools.decay import DecayWriter
+            writers.append(
+                DecayWriter(decay, 'stdin' if infile == '-' else infile))
+        writer = combine_writers(writers)
+        if use_pysam(infile, bam):
+            process_bam(infile, d, batch_size or CHUNK_SIZE, threads, bam,
+                        writer, unsorted, max_pending, keep)
+        else:
+            in_obj = stack.enter_context(pct.open(infile))
+            if unsorted:
+                # Subsample before pairing so discarded reads are not held.
+                if keep is not None:
+                    in_obj, keep = sam_lines(in_obj, keep), None
+                in_obj = pair_mates(in_obj, max_pending=max_pending)
+            process_sam(in_obj, digest, d, batch_size, threads, writer, keep)
+        if writer is not None:
+            writer.close()
+
+
+def process_sam(in_obj, digest, d, batch_size, threads, writer, keep=None):
+
+    ''' Process SAM text input in chunks, as columnar batches of
+        batch_size pairs or pair by pair if batch_size is None, reading
+        only pairs accepted by keep if given.
+    '''
+
+    # Worker processes memory-map the cached index themselves.
+    shared = digest if threads > 1 and digest != '-' else d
+    chunks = read_batches(in_obj, batch_size or CHUNK_SIZE, keep)
+    with Writer(sys.stdout) as output:
+        for out in imap_chunks(
+                process_chunk, chunks, threads,
+                initializer=set_worker, initargs=(shared, batch_size)):
+            output.write(out)
+            if writer is not None:
+                writer.add_sam(out)
+
+
+def set_worker(digest, batch_size):
+
+    if isinstance(digest, str):
+        digest = load_digest(digest)
+    worker['digest'] = digest
+    worker['batch'] = bool(batch_size)
+
+
+def process_chunk(chunk):
+
+    ''' Return processed SAM records of a chunk from read_batches. '''
+
+    is_header, lines = chunk
+    if is_header:
+        return ''.join(lines)
+    elif worker['batch']:
+        return process_batch(lines, worker['digest'])
+    else:
+        return ''.join(
+            process_pair(pct.Sam(line1), pct.Sam(line2), worker['digest'])
+            for line1, line2 in pairs(lines))
+
+
+def process_bam(infile, digest, batch_size, threads, bam, writer=None,
+                unsorted=False, max_pending=MAX_PENDING, keep=None):
+
+    ''' Process SAM/BAM with pysam, setting HiC tags in binary form. '''
+
+    with open_input(infile, threads) as in_bam, \
+            open_output(in_bam, threads, bam) as out_bam:
+        if writer is not None:
+            writer.set_chroms(in_bam.references, in_bam.lengths)
+        in_segments = in_bam
+        if unsorted:
+            in_segments = pair_mates(in_bam, BamRuns(in_bam), max_pending)
+        for segments in read_segment_batches(
+                in_segments, batch_size, keep):
+            columns = segment_columns(segments, in_bam.references)
+            tag_segments(segments, batch_filter(columns, digest))
+            for segment in segments:
+                out_bam.write(segment)
+            if writer is not None:
+                writer.add_segments(segments)
+
+
+@instrument.timed
+def tag_segments(segments, stats):
+
+    ''' Set HiC tags of a batch of pysam segments from batch_filter. '''
+
+    stats = stats_lists(stats)
+    for i, (read1, read2) in enumerate(pairs(segments)):
+        for read, fragment in ((read1, 'read1_fragment'),
+                               (read2, 'read2_fragment')):
+            read.set_tag('or', stats['orientation'][i], 'Z')
+            read.set_tag('it', stats['interaction'][i], 'Z')
+            read.set_tag('dt', stats['ditag_length'][i], 'i')
+            read.set_tag('is', stats['insert_size'][i], 'i')
+            read.set_tag('fs', stats['fragment_seperation'][i], 'i')
+            read.set_tag('fn', stats[fragment][i], 'i')
+
+
+@instrument.timed
+def segment_columns(segments, references):
+
+    ''' Return columnar arrays of a batch of pysam segments in the same
+        form as parse_batch.
+    '''
+
+    rname = np.array([s.reference_id for s in segments], dtype=np.int64)
+    if rname.size and rname.min() < 0:
+        raise KeyError('*')
+    left = np.array([s.reference_start for s in segments], dtype=np.int64)
+    right = np.array([s.reference_end for s in segments], dtype=np.int64)
+    return {
+        'names': references,
+        'rname': rname,
+        'left': left + 1,
+        'right': right,
+        'reverse': np.array([s.is_reverse for s in segments]),
+    }
+
+
+def process_pair(read1, read2, digest):
+
+    ''' Return SAM records of a read pair with HiC tags added. '''
+
+    filter_stats = run_filter(read1, read2, digest)
+    read1.optional['or:Z'] = filter_stats['orientation']
+    read2.optional['or:Z'] = filter_stats['orientation']
+    read1.optional['it:Z'] = filter_stats['interaction']
+    read2.optional['it:Z'] = filter_stats['interaction']
+    read1.optional['dt:i'] = filter_stats['ditag_length']
+    read2.optional['dt:i'] = filter_stats['ditag_length']
+    read1.optional['is:i'] = filter_stats['insert_size']
+    read2.optional['is:i'] = filter_stats['insert_size']
+    read1.optional['fs:i'] = filter_stats['fragment_seperation']
+    read2.optional['fs:i'] = filter_stats['fragment_seperation']
+    read1.optional['fn:i'] = filter_stats['read1_fragment']
+    read2.optional['fn:i'] = filter_stats['read2_fragment']
+    return read1.get_record() + read2.get_record()
+
+
+def process_batch(lines, digest):
+
+    ''' Return processed SAM records for a batch of read pair lines.
+        Equivalent to process_pair applied to each pair but computed on
+        columnar arrays for the whole batch.
+    '''
+
+    stats = batch_filter(parse_batch(lines), digest)
+    return ''.join(format_pairs(lines, stats, digest))
+
+
+@instrument.timed
+def format_pairs(lines, stats, digest):
+
+    ''' Return list of processed SAM records, one string per read pair,
+        with HiC tags from batch_filter appended.
+    '''
+
+    stats = stats_lists(stats)
+    out = []
+    for i, (line1, line2) in enumerate(pairs(lines)):
+        # Records already carrying HiC tags must have them replaced.
+        if PROCESS_TAGS.search(line1) or PROCESS_TAGS.search(line2):
+            out.append(process_pair(pct.Sam(line1), pct.Sam(line2), digest))
+            continue
+        tags = (f'\tor:Z:{stats["orientation"][i]}'
+                f'\tit:Z:{stats["interaction"][i]}'
+                f'\tdt:i:{stats["ditag_length"][i]}'
+                f'\tis:i:{stats["insert_size"][i]}'
+                f'\tfs:i:{stats["fragment_seperation"][i]}\tfn:i:')
+        out.append(
+            f'{line1.rstrip(chr(10))}{tags}{stats["read1_fragment"][i]}\n'
+            f'{line2.rstrip(chr(10))}{tags}{stats["read2_fragment"][i]}\n')
+    return out
+
+
+def stats_lists(stats):
+
+    ''' Convert batch_filter arrays to lists of Python values, with
+        orientation and interaction codes replaced by their names.
+    '''
+
+    lists = {key: values.tolist() for key, values in stats.items()}
+    lists['orientation'] = [ORIENTATIONS[i] for i in lists['orientation']]
+    lists['interaction'] = [INTERACTIONS[i] for i in lists['interaction']]
+    return lists
+
+
+@instrument.timed
+def parse_batch(lines):
+
+    ''' Parse SAM lines into columnar arrays of reference code,
+        left and right reference positions and strand.
+    '''
+
+    fields = [line.split('\t', 6) for line in lines]
+    names, rname = np.unique([f[2] for f in fields], return_inverse=True)
+    flag = np.array([int(f[1]) for f in fields], dtype=np.int64)
+    left = np.array([int(f[3]) for f in fields], dtype=np.int64)
+    length = np.array(
+        [reference_length(f[5]) for f in fields], dtype=np.int64)
+    return {
+        'names': names.tolist(),
+        'rname': rname.reshape(-1),
+        'left': left,
+        'right': left + length - 1,
+        'reverse': (flag & 0x10) != 0,
+    }
+
+
+@instrument.timed
+def batch_filter(columns, digest):
+
+    ''' Vectorised run_filter over a batch of read pairs. Returns a
+        dict of per-pair arrays with the same keys as run_filter, with
+        orientation and interaction as indices into ORIENTATIONS and
+        INTERACTIONS.
+    '''
+
+    number, start, end = batch_fragments(columns, digest)
+    rname = columns['rname']
+    cis = rname[0::2] == rname[1::2]
+    # Reorder so read 1 is left of read 2 for cis pairs.
+    swap = cis & (columns['left'][0::2] > columns['left'][1::2])
+
+    def reorder(column):
+        return (np.where(swap, column[1::2], column[0::2]),
+                np.where(swap, column[0::2], column[1::2]))
+
+    reverse1, reverse2 = reorder(columns['reverse'])
+    left1, left2 = reorder(columns['left'])
+    right1, right2 = reorder(columns['right'])
+    number1, number2 = reorder(number)
+    start1, start2 = reorder(start)
+    end1, end2 = reorder(end)
+
+    tag_length1 = np.where(
+        reverse1, right1 - start1 + 1, end1 - left1 + 1)
+    tag_length2 = np.where(
+        reverse2, right2 - start2 + 1, end2 - left2 + 1)
+
+    return {
+        'orientation': reverse1 * 2 + reverse2,
+        'interaction': (~cis).astype(np.int8),
+        'ditag_length': tag_length1 + tag_length2,
+        'insert_size': right2 - left1 + 1,
+        'fragment_seperation': np.abs(number2 - number1),
+        'read1_fragment': number1,
+        'read2_fragment': number2,
+    }
+
+
+@instrument.timed
+def batch_fragments(columns, digest):
+
+    ''' Return fragment number, start and end of every read in a
+        batch, found by searchsorted of the read midpoint.
+    '''
+
+    middle = middle_pos(columns['left'], columns['right'])
+    number = np.empty_like(middle)
+    start = np.empty_like(middle)
+    end = np.empty_like(middle)
+    for code in np.unique(columns['rname']):
+        ref = columns['names'][code]
+        idx = np.flatnonzero(columns['rname'] == code)
+        ends = digest[ref]
+        rf_num = np.searchsorted(ends, middle[idx], side='left')
+        if rf_num.size and rf_num.max() >= len(ends):
+            raise IndexError(f'Read aligned beyond final fragment of {ref}.')
+        number[idx] = rf_num
+        end[idx] = ends[rf_num]
+        previous_end = ends[np.maximum(rf_num - 1, 0)].astype(np.int64)
+        start[idx] = np.where(rf_num == 0, 1, previous_end + 1)
+    return number, start, end
+
+
+def middle_pos(left, right):
+
+    ''' Vectorised pct.Sam.middle_pos, rounding half to even. '''
+
+    total = left + right
+    half = total >> 1
+    return half + (total & half & 1)
 
 
 def run_filter(read1, read2, digest):
@@ -100,9 +405,10 @@ def reorder_read_pair(read1, read2):
 
 
 def get_fragment(read, digest):
-    rf_num = bisect.bisect_left(digest[read.rname], read.middle_pos)
-    rf_start = 1 if rf_num == 0 else digest[read.rname][rf_num - 1] + 1
-    rf_end = digest[read.rname][rf_num]
+    ends = digest[read.rname]
+    rf_num = int(np.searchsorted(ends, read.middle_pos, side='left'))
+    rf_start = 1 if rf_num == 0 else int(ends[rf_num - 1]) + 1
+    rf_end = int(ends[rf_num])
     return fragment(rf_num, rf_start, rf_end)
 
 
@@ -132,36 +438,3 @@ class fragment:
         self.start = start
         self.end = end
 
-
-def process_digest(digest):
-    d = {}
-    for fragment in digest:
-        [ref, start, end, number] = fragment.split()
-        if not (int(start) > 0 and int(end) > 0):
-            log.error(f'Negative fragment start/end positions on ref {ref}.')
-        if ref not in d.keys():
-            if not (int(start) == 1 and int(number) == 1):
-                log.error(f'Invalid first fragment in ref {ref}.')
-            d[ref] = []
-        d[ref].append(int(end))
-    return(d)
-
-
-def pysam_test():
-    import pysam
-    samfile = pysam.AlignmentFile("/media/stephen/Data/hic_analysis/data/test.sam", "rb")
-    mysamfile = open("/media/stephen/Data/hic_analysis/data/test2.sam")
-    for read_pysam, read_mysam in zip(samfile.fetch(), mysamfile):
-        myread = pct.Sam(read_mysam.split())
-        assert read_pysam.get_reference_positions()[-1] + 1 == myread.right_pos
-        assert read_pysam.get_reference_positions()[0] + 1 == myread.left_pos
-        assert read_pysam.reference_length == myread.reference_length
-        assert read_pysam.is_paired == myread.is_paired
-        assert read_pysam.is_reverse == myread.is_reverse
-        if myread.is_reverse:
-            assert read_pysam.get_reference_positions()[-1] + 1 == myread.five_prime_pos
-            assert read_pysam.get_reference_positions()[0] + 1 == myread.three_prime_pos
-        else:
-            assert read_pysam.get_reference_positions()[-1] + 1 == myread.three_prime_pos
-            assert read_pysam.get_reference_positions()[0] + 1 == myread.five_prime_pos
-    mysamfile.close()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+""" Read name-sorted SAM files as batches of read pairs. """
+
+import re
+import sys
+import functools
+import pyCommonTools as pct
+from pyHiCTools import instrument
+from pyHiCTools.subsample import sam_lines
+
+
+# Read pairs per chunk dispatched to worker processes.
+CHUNK_SIZE = 10000
+
+CIGAR = re.compile(r'(\d+)([MIDNSHP=X])')
+
+
+def read_batches(in_obj, batch_size, keep=None):
+
+    ''' Yield (is_header, lines) from a name-sorted SAM stream. Header
+        lines are yielded as they are encountered and alignments are
+        yielded in batches of up to batch_size read pairs, with each
+        pair as two adjacent lines. If given, only pairs with a qname
+        accepted by keep (a subsample.Subsample) are read.
+    '''
+
+    log = pct.create_logger()
+
+    lines = iter(in_obj) if keep is None else sam_lines(in_obj, keep)
+    batch = []
+    for line in lines:
+        if line.startswith('@'):
+            if batch:
+                yield False, batch
+                batch = []
+            yield True, [line]
+            continue
+        mate = next(lines, None)
+        if mate is None:
+            log.error('Odd number of alignments in file.')
+            sys.exit(1)
+        check_mates(line[:line.find('\t')], mate[:mate.find('\t')])
+        batch.append(line)
+        batch.append(mate)
+        if len(batch) >= 2 * batch_size:
+            instrument.advance(len(batch), in_obj)
+            yield False, batch
+            batch = []
+    if batch:
+        instrument.advance(len(batch), in_obj)
+        yield False, batch
+
+
+def check_mates(name1, name2):
+
+    ''' Exit if adjacent alignments are not mates. '''
+
+    if name1 != name2:
+        log = pct.create_logger()
+        log.error(f'Qname mismatch: {name1} {name2}. Is file name sorted?')
+        sys.exit(1)
+
+
+def pairs(lines):
+
+    ''' Return iterator of (read1, read2) lines from a batch. '''
+
+    it = iter(lines)
+    return zip(it, it)
+
+
+def get_tags(line, tags):
+
+    ''' Return dict of pct.Sam style optional keys (e.g. "dt:i") to
+        values for the requested tags of a raw SAM line. Only the
+        requested tags are located and decoded; the mandatory fields are
+        skipped without being split.
+    '''
+
+    # Optional fields begin after the 11th tab.
+    start = -1
+    for _ in range(11):
+        start = line.find('\t', start + 1)
+        if start == -1:
+            raise KeyError(tags[0])
+    values = {}
+    for tag in tags:
+        begin = line.find(f'\t{tag}:', start)
+        if begin == -1:
+            raise KeyError(tag)
+        begin += len(tag) + 2
+        end = line.find('\t', begin)
+        value = line[begin:end] if end != -1 else line[begin:].rstrip('\n')
+        values[tag] = int(value) if tag.endswith(':i') else value
+    return values
+
+
+def raw_record(line):
+
+    ''' Return a SAM line unchanged, ensuring it is newline terminated. '''
+
+    return line if line.endswith('\n') else f'{line}\n'
+
+
+@functools.lru_cache(maxsize=4096)
+def reference_length(cigar):
+
+    ''' Return number of reference bases consumed by CIGAR string. '''
+
+    return sum(int(length) for length, op in CIGAR.findall(cigar)
+               if op in 'MDN=X')
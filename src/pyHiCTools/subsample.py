@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+""" Deterministic subsampling of read pairs. A pair is kept if a seeded
+    hash of its read name falls in the lowest FRACTION of the hash
+    range, so the same pairs are kept at every stage (truncate,
+    process, filter and extract) and in R1 and R2 FASTQ files given the
+    same --subsample and --seed. Records are tested on their name
+    alone, before any other parsing.
+"""
+
+import zlib
+
+
+class Subsample:
+
+    ''' Callable returning True if the read pair of a name is kept. The
+        result for the previous name is reused, as mates are adjacent.
+    '''
+
+    def __init__(self, fraction, seed=0):
+        self.threshold = int(fraction * 2 ** 32)
+        self.start = zlib.crc32(str(seed).encode())
+        self.last = None
+        self.kept = False
+
+    def __call__(self, name):
+        if name != self.last:
+            self.last = name
+            self.kept = mix(zlib.crc32(name.encode(), self.start)) \
+                < self.threshold
+        return self.kept
+
+
+def mix(value):
+
+    ''' Return 32-bit value with bits avalanched (MurmurHash3 fmix32) so
+        similar names give unrelated hashes.
+    '''
+
+    value ^= value >> 16
+    value = (value * 0x85ebca6b) & 0xffffffff
+    value ^= value >> 13
+    value = (value * 0xc2b2ae35) & 0xffffffff
+    return value ^ (value >> 16)
+
+
+def make_subsample(fraction=None, seed=0):
+
+    ''' Return Subsample of fraction, or None if fraction is None. '''
+
+    return None if fraction is None else Subsample(fraction, seed)
+
+
+def sam_lines(lines, keep):
+
+    ''' Yield SAM header lines and the alignments kept by keep. '''
+
+    for line in lines:
+        if line.startswith('@') or keep(line[:line.find('\t')]):
+            yield line
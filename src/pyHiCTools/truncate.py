@@ -5,8 +5,24 @@
     ligation junction.
 '''
 
+import re
 import sys
+import itertools
+import collections
 import pyCommonTools as pct
+from contextlib import ExitStack
+from pyHiCTools import instrument
+from pyHiCTools.digest import iupac_pattern
+from pyHiCTools.parallel import imap_chunks, Writer
+from pyHiCTools.compress import compress, finish
+from pyHiCTools.subsample import make_subsample
+
+
+# FASTQ records per block.
+BLOCK_SIZE = 10000
+
+# Per-process state set by set_worker.
+worker = {}
 
 
 def process_restriction(restriction):
@@ -21,49 +37,274 @@ def process_restriction(restriction):
     return ligation_seq, restriction_seq
 
 
-def truncate(infile, qc, sample, restriction):
+def truncate(infile, qc, sample, restriction, mate=None, output=None,
+             mate_output=None, threads=1, compression=None, subsample=None,
+             seed=0):
 
     ''' Run main loop. '''
 
     log = pct.create_logger()
 
-    ligation_seq, restriction_seq = process_restriction(restriction)
-    total = 0
-    truncated = 0
-    truncated_length = 0
+    if isinstance(restriction, str):
+        restriction = [restriction]
 
     if not sample:
         sample = infile
 
-    with pct.open(infile) as in_obj:
-
-        is_truncated = False
-        for index, line in enumerate(in_obj):
-            line = line.rstrip('\n')
-            # Sequence line
-            if index % 4 == 1:
-                total += 1
-                line = line.upper()
-                if ligation_seq in line:
-                    line = line[0: line.index(ligation_seq)] + restriction_seq
-                    is_truncated = True
-                seq_length = len(line)
-            # Quality line
-            elif index % 4 == 3:
-                line = line[0:seq_length]
-                if is_truncated:
-                    truncated += 1
-                    truncated_length += seq_length
-                    is_truncated = False
-            sys.stdout.write(f'{line}\n')
+    if mate and not (output and mate_output):
+        log.error('Paired-end mode requires --output and --mate_output.')
+        sys.exit(1)
+
+    if compression is None and output and output.endswith('.gz'):
+        compression = 'gzip'
+
+    with ExitStack() as stack:
+        in_objs = [stack.enter_context(pct.open(infile))]
+        outs = [open_output(stack, output, compression)]
+        if mate:
+            in_objs.append(stack.enter_context(pct.open(mate)))
+            outs.append(open_output(stack, mate_output, compression))
+        writers = [stack.enter_context(Writer(out, f'output{i}'))
+                   for i, out in enumerate(outs, 1)]
+
+        counts = [collections.Counter() for _ in in_objs]
+        keep = make_subsample(subsample, seed)
+        blocks = itertools.zip_longest(
+            *[read_blocks(in_obj, BLOCK_SIZE, keep) for in_obj in in_objs])
+        if mate:
+            blocks = (check_pairs(*block) for block in blocks)
+        for results in imap_chunks(
+                truncate_chunk, blocks, threads, initializer=set_worker,
+                initargs=(restriction, compression)):
+            for (truncated, block_counts), writer, read_counts in zip(
+                    results, writers, counts):
+                writer.write(truncated)
+                read_counts.update(block_counts)
+        for writer in writers:
+            writer.close()
+        for out in outs:
+            finish(out, compression)
+
+    write_qc(qc, sample, counts, ligation_junctions(restriction))
+
+
+def open_output(stack, path, compression):
+
+    ''' Return output for truncated FASTQ; binary if blocks are
+        compressed by workers.
+    '''
+
+    if compression:
+        return stack.enter_context(open(path, 'wb')) if path \
+            else sys.stdout.buffer
+    return stack.enter_context(pct.open(path, mode='w')) if path \
+        else sys.stdout
+
+
+def set_worker(restriction, compression):
+
+    worker['matcher'] = LigationMatcher(restriction)
+    worker['compression'] = compression
+
+
+def truncate_chunk(block):
+
+    ''' Return (truncated FASTQ, counts) for each read of a block,
+        compressing the FASTQ if required.
+    '''
+
+    results = []
+    for lines in block:
+        truncated, counts = worker['matcher'].truncate_block(lines)
+        if worker['compression']:
+            truncated = compress(truncated.encode(), worker['compression'])
+        results.append((truncated, counts))
+    return results
+
+
+def read_blocks(in_obj, block_size, keep=None):
+
+    ''' Yield lists of lines of up to block_size FASTQ records, reading
+        only records with a read name accepted by keep if given.
+    '''
+
+    log = pct.create_logger()
+
+    lines = iter(in_obj) if keep is None else kept_records(in_obj, keep)
+    while True:
+        block = list(itertools.islice(lines, 4 * block_size))
+        if not block:
+            return
+        if len(block) % 4:
+            log.error('Incomplete FASTQ record at end of file.')
+            sys.exit(1)
+        instrument.advance(len(block) // 4, in_obj)
+        yield block
+
+
+def kept_records(in_obj, keep):
+
+    ''' Yield lines of FASTQ records with a read name, without the "@"
+        (as the qname of the aligned pair), accepted by keep.
+    '''
+
+    lines = iter(in_obj)
+    while True:
+        record = list(itertools.islice(lines, 4))
+        if not record:
+            return
+        # An incomplete record is passed on to be reported.
+        if len(record) < 4 or keep(read_name(record[0])[1:]):
+            yield from record
+
+
+def check_pairs(block1, block2):
+
+    ''' Return R1 and R2 blocks, exiting if they are not in sync. '''
+
+    log = pct.create_logger()
+
+    if block1 is None or block2 is None or len(block1) != len(block2):
+        log.error('R1 and R2 FASTQ differ in number of records.')
+        sys.exit(1)
+    for name1, name2 in zip(block1[0::4], block2[0::4]):
+        if read_name(name1) != read_name(name2):
+            log.error(f'Read name mismatch: {name1.strip()} '
+                      f'{name2.strip()}. Are R1 and R2 in sync?')
+            sys.exit(1)
+    return block1, block2
+
+
+def read_name(header):
+
+    name = header.split(maxsplit=1)[0]
+    if name.endswith(('/1', '/2')):
+        name = name[:-2]
+    return name
+
+
+class LigationMatcher:
+
+    ''' Find the first ligation junction formed by any pair of enzymes
+        in a sequence. Junctions are searched in a single pass with one
+        compiled alternation; a single, non-degenerate junction uses a
+        plain substring search.
+    '''
+
+    def __init__(self, restrictions):
+        self.junctions = ligation_junctions(restrictions)
+        literal = re.fullmatch('[ACGT]+', self.junctions[0][0])
+        if len(self.junctions) == 1 and literal:
+            self.literal = self.junctions[0][0]
+        else:
+            self.literal = None
+            # Prefer longer junctions when several match at one position.
+            order = sorted(range(len(self.junctions)),
+                           key=lambda i: -len(self.junctions[i][0]))
+            self.groups = order
+            self.pattern = re.compile('|'.join(
+                f'({iupac_pattern(self.junctions[i][0])})' for i in order))
+
+    def search(self, seq):
+
+        ''' Return (start, junction index) of first junction or None. '''
+
+        if self.literal is not None:
+            start = seq.find(self.literal)
+            return None if start == -1 else (start, 0)
+        match = self.pattern.search(seq)
+        if match is None:
+            return None
+        return match.start(), self.groups[match.lastindex - 1]
+
+    def truncate(self, seq):
+
+        ''' Return seq truncated after the first restriction site of the
+            first ligation junction, and the junction index or None.
+        '''
+
+        found = self.search(seq)
+        if found is None:
+            return seq, None
+        start, index = found
+        junction, left, site = self.junctions[index]
+        if self.literal is not None:
+            return seq[0:start] + site, index
+        # Keep sequenced bases of the left site so degenerate positions
+        # are not replaced by IUPAC codes.
+        return seq[0:start + left] + site[left:], index
+
+    def truncate_block(self, lines):
+
+        ''' Return truncated FASTQ text and counts of a block of lines. '''
+
+        counts = collections.Counter()
+        junction_counts = [0] * len(self.junctions)
+        out = []
+        for i in range(0, len(lines), 4):
+            header, seq, plus, quality = lines[i: i + 4]
+            seq, index = self.truncate(seq.rstrip('\n').upper())
+            seq_length = len(seq)
+            if index is not None:
+                junction_counts[index] += 1
+                counts['truncated_length'] += seq_length
+            out.append(f'{header.rstrip(chr(10))}\n{seq}\n'
+                       f'{plus.rstrip(chr(10))}\n'
+                       f'{quality.rstrip(chr(10))[0:seq_length]}\n')
+        counts['total'] += len(lines) // 4
+        counts['truncated'] += sum(junction_counts)
+        for (junction, left, site), count in zip(
+                self.junctions, junction_counts):
+            counts[f'junction {junction}'] += count
+        return ''.join(out), counts
+
+
+def ligation_junctions(restrictions):
+
+    ''' Return list of (junction, left length, left site) for every
+        ligation of a fragment end cut by one enzyme to a fragment end
+        cut by another (or the same) enzyme.
+    '''
+
+    ends = []
+    for restriction in restrictions:
+        site = restriction.upper().replace('^', '')
+        cut_site1 = restriction.index('^')
+        cut_site2 = len(restriction) - cut_site1 - 1
+        ends.append((site[0:cut_site2], site[cut_site1:], site))
+    junctions = []
+    for left, _, site in ends:
+        for _, right, _ in ends:
+            if (left + right) not in [j[0] for j in junctions]:
+                junctions.append((left + right, len(left), site))
+    return junctions
+
+
+def write_qc(qc, sample, counts, junctions):
+
+    ''' Write QC of each read, with per-junction counts for
+        multi-junction or paired-end runs.
+    '''
+
+    paired = len(counts) > 1
+    rows = []
+    for read, read_counts in enumerate(counts, 1):
+        prefix = f'R{read} ' if paired else ''
+        total = read_counts['total']
+        truncated = read_counts['truncated']
+        truncated_length = read_counts['truncated_length']
         try:
             mean_truncated_length = truncated_length/truncated
         except ZeroDivisionError:
             mean_truncated_length = 'na'
-
-        with pct.open(qc, stderr = True, mode = 'w') as qc_out:
-            qc_out.write(
-                f'{sample}\tTotal\t{total}\n'
-                f'{sample}\tTruncated\t{truncated}\n'
-                f'{sample}\tNot truncated\t{total-truncated}\n'
-                f'{sample}\tMean truncated length\t{mean_truncated_length}\n')
+        rows.extend([
+            (f'{prefix}Total', total),
+            (f'{prefix}Truncated', truncated),
+            (f'{prefix}Not truncated', total-truncated),
+            (f'{prefix}Mean truncated length', mean_truncated_length)])
+        if paired or len(junctions) > 1:
+            for junction, left, site in junctions:
+                rows.append((f'{prefix}Truncated at {junction}',
+                             read_counts[f'junction {junction}']))
+    with pct.open(qc, stderr = True, mode = 'w') as qc_out:
+        instrument.write_qc_rows(qc_out, sample, rows)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import contextlib
+import pytest
+
+from pyHiCTools.filter import filter
+from pyHiCTools.extract import extract
+from pyHiCTools.decay import decay
+from pyHiCTools.estimate import estimate
+from pyHiCTools.process import process_batch
+from test_process import random_pairs, digest
+
+HEADER = ('@HD\tVN:1.6\tSO:queryname\n'
+          '@SQ\tSN:chr1\tLN:1000\n@SQ\tSN:chr2\tLN:900\n')
+
+
+@contextlib.contextmanager
+def redirect(fd, path, mode):
+    # pysam reads and writes '-' through the file descriptors.
+    sys.stdout.flush()
+    saved = os.dup(fd)
+    with open(path, mode) as f:
+        os.dup2(f.fileno(), fd)
+    try:
+        yield
+    finally:
+        os.dup2(saved, fd)
+        os.close(saved)
+
+
+@pytest.fixture
+def processed_sam(tmp_path, digest):
+    sam = tmp_path / 'in.sam'
+    # Mate fields htslib accepts unchanged.
+    lines = [line.replace('\t=\t0\t', '\t*\t0\t')
+             for line in random_pairs(500)]
+    sam.write_text(HEADER + process_batch(lines, digest))
+    return sam
+
+
+def test_filter_bam(tmp_path, processed_sam, capsys):
+    pysam = pytest.importorskip('pysam')
+    sam = processed_sam
+    thresholds = dict(min_inward=None, min_outward=None,
+                      min_ditag=None, max_ditag=300)
+    filter(str(sam), str(tmp_path / 'qc'), 'x', **thresholds)
+    expected = capsys.readouterr().out.splitlines()
+    assert expected[:3] == HEADER.splitlines() and len(expected) > 3
+
+    bam = tmp_path / 'out.bam'
+    with redirect(1, bam, 'wb'):
+        filter(str(sam), str(tmp_path / 'qc_bam'), 'x', bam=True,
+               **thresholds)
+    with pysam.AlignmentFile(str(bam), 'rb') as f:
+        assert [read.to_string() for read in f] == expected[3:]
+    assert ((tmp_path / 'qc').read_text()
+            == (tmp_path / 'qc_bam').read_text())
+
+    # BAM input is detected from files but needs --bam on stdin.
+    out = tmp_path / 'out.sam'
+    with redirect(0, bam, 'rb'), redirect(1, out, 'w'):
+        filter('-', str(tmp_path / 'qc_stdin'), 'x', bam=True,
+               **thresholds)
+    with pysam.AlignmentFile(str(out), 'r') as f:
+        assert [read.to_string() for read in f] == expected[3:]
+
+
+@pytest.mark.parametrize('command', [
+    lambda infile, bam: extract(infile, 'x', bam=bam),
+    lambda infile, bam: extract(infile, 'x', output_format='summary',
+                                bam=bam),
+    lambda infile, bam: decay(infile, 'x', bam=bam),
+    lambda infile, bam: estimate([infile], 'x', min_count=10, bam=bam)])
+def test_stdin_bam(tmp_path, processed_sam, capsys, command):
+    pysam = pytest.importorskip('pysam')
+    bam = tmp_path / 'in.bam'
+    with pysam.AlignmentFile(str(processed_sam)) as in_sam, \
+            pysam.AlignmentFile(str(bam), 'wb', template=in_sam) as out:
+        for read in in_sam:
+            out.write(read)
+    command(str(processed_sam), False)
+    expected = capsys.readouterr().out
+    assert expected
+    command(str(bam), False)
+    assert capsys.readouterr().out == expected
+    # BAM on stdin is only read as BAM with --bam.
+    with redirect(0, bam, 'rb'):
+        command('-', True)
+    assert capsys.readouterr().out == expected
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import pytest
+
+import pyHiCTools.batch
+from pyHiCTools.batch import batch, read_sheet
+from test_process import random_pairs, digest
+
+
+def write_digest(path, digest):
+    with open(path, 'w') as f:
+        for ref, ends in digest.items():
+            start = 1
+            for number, end in enumerate(ends, 1):
+                f.write(f'{ref}\t{start}\t{end}\t{number}\n')
+                start = end + 1
+
+
+def test_batch(tmp_path, digest, monkeypatch):
+    write_digest(tmp_path / 'digest.txt', digest)
+    sheet = tmp_path / 'sheet.tsv'
+    lines = []
+    for sample, seed in (('a', 1), ('b', 2)):
+        path = tmp_path / f'{sample}.sam'
+        path.write_text(''.join(random_pairs(200, seed)))
+        lines.append(f'{sample}\t{path}\n')
+    sheet.write_text('# sample\tpath\n' + ''.join(lines))
+    outdir = tmp_path / 'out'
+    qc = tmp_path / 'all.qc'
+    options = dict(
+        sheet=str(sheet), digest=str(tmp_path / 'digest.txt'), qc=str(qc),
+        min_inward=None, min_outward=None, min_ditag=None, max_ditag=300,
+        outdir=str(outdir), threads=2)
+    batch(**options)
+    table = qc.read_text().splitlines()
+    assert [row.split('\t')[:2] for row in table[:2]] == [
+        ['a', 'Total'], ['a', 'Retained']]
+    assert (outdir / 'a.qc').read_text() + (outdir / 'b.qc').read_text() \
+        == qc.read_text()
+    assert (outdir / 'b.sam').stat().st_size > 0
+
+    # Completed samples are skipped when the batch is resumed.
+    (outdir / 'b.qc').unlink()
+    ran = []
+    monkeypatch.setattr(
+        pyHiCTools.batch, 'run_samples',
+        lambda samples, *args: ran.extend(samples) or [])
+    batch(**options)
+    assert [sample for sample, path in ran] == ['b']
+
+
+@pytest.mark.parametrize('text', [
+    'a\n', 'a\tx.sam\na\ty.sam\n', 'a/b\tx.sam\n', '# empty\n'])
+def test_read_sheet_invalid(tmp_path, text):
+    sheet = tmp_path / 'sheet.tsv'
+    sheet.write_text(text)
+    with pytest.raises(SystemExit):
+        read_sheet(str(sheet))
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import pytest
+
+import pyHiCTools.filter
+from pyHiCTools.checkpoint import Checkpoint
+from pyHiCTools.compress import compress, BGZF_EOF
+from pyHiCTools.filter import filter
+from pyHiCTools.process import process_batch
+from test_process import random_pairs, digest
+
+
+class Interrupt(Exception):
+    pass
+
+
+@pytest.mark.parametrize('compression', [None, 'bgzf'])
+def test_resume(tmp_path, digest, monkeypatch, capsys, compression):
+    data = ('@HD\tVN:1.6\n'
+            + process_batch(random_pairs(500), digest)).encode()
+    (tmp_path / 'in.sam').write_bytes(data)
+    monkeypatch.setattr(pyHiCTools.filter, 'CHUNK_SIZE', 20)
+    options = dict(
+        infile=str(tmp_path / 'in.sam'), sample='x', min_inward=None,
+        min_outward=None, min_ditag=None, max_ditag=300,
+        checkpoint_interval=50)
+    filter(qc=str(tmp_path / 'expected.qc'), **options)
+    expected = capsys.readouterr().out
+
+    if compression:
+        infile = tmp_path / 'in.sam.gz'
+        infile.write_bytes(compress(data, compression) + BGZF_EOF)
+        options['infile'] = str(infile)
+
+    write = Checkpoint.write
+    calls = []
+
+    def interrupted(self, out):
+        calls.append(out)
+        if len(calls) == 12:
+            raise Interrupt()
+        write(self, out)
+
+    monkeypatch.setattr(Checkpoint, 'write', interrupted)
+    checkpoint = str(tmp_path / 'checkpoint')
+    with pytest.raises(Interrupt):
+        filter(qc=str(tmp_path / 'qc'), checkpoint=checkpoint, **options)
+    assert capsys.readouterr().out == ''
+
+    monkeypatch.setattr(Checkpoint, 'write', write)
+    with pytest.raises(SystemExit):
+        # Existing checkpoint requires --resume.
+        filter(qc=str(tmp_path / 'qc'), checkpoint=checkpoint, **options)
+    filter(qc=str(tmp_path / 'qc'), checkpoint=checkpoint, resume=True,
+           **options)
+    assert capsys.readouterr().out == expected
+    assert ((tmp_path / 'qc').read_text()
+            == (tmp_path / 'expected.qc').read_text())
+    assert not list((tmp_path / 'checkpoint').iterdir())
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import os
+import gzip
+import random
+import pytest
+
+import pyHiCTools.truncate
+from pyHiCTools.compress import (
+    compress, bgzf_block, finish, is_bgzf, BGZF_EOF, BGZF_BLOCK_SIZE)
+from pyHiCTools.truncate import truncate
+
+
+def text(n, seed=0):
+    rng = random.Random(seed)
+    return ''.join(f'read{i}\t{rng.randrange(10 ** 9)}\n'
+                   for i in range(n)).encode()
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'bgzf'])
+def test_compress(tmp_path, compression):
+    data = text(20000)
+    path = tmp_path / 'out.gz'
+    with open(path, 'wb') as out:
+        # Concatenated members of independent blocks.
+        out.write(compress(data[:100000], compression))
+        out.write(compress(data[100000:], compression))
+        finish(out, compression)
+    with gzip.open(path) as f:
+        assert f.read() == data
+    assert is_bgzf(path) == (compression == 'bgzf')
+    assert path.read_bytes().endswith(BGZF_EOF) == (compression == 'bgzf')
+
+
+def test_compress_pysam(tmp_path):
+    pysam = pytest.importorskip('pysam')
+    data = text(20000)
+    path = tmp_path / 'out.gz'
+    with open(path, 'wb') as out:
+        out.write(compress(data, 'bgzf'))
+        finish(out, 'bgzf')
+    with pysam.BGZFile(str(path)) as f:
+        assert f.read() == data
+
+
+def test_bgzf_block_incompressible():
+    data = os.urandom(BGZF_BLOCK_SIZE)
+    block = bgzf_block(data, level=9)
+    # Falls back to level 0 so the block size fits in 16 bits.
+    assert len(block) <= 65536
+    assert int.from_bytes(block[16:18], 'little') == len(block) - 1
+    assert gzip.decompress(block) == data
+
+
+def test_compress_unknown():
+    with pytest.raises(ValueError):
+        compress(b'', 'zstd')
+
+
+def test_truncate_threads(tmp_path, monkeypatch):
+    monkeypatch.setattr(pyHiCTools.truncate, 'BLOCK_SIZE', 50)
+    rng = random.Random(1)
+    fastq = tmp_path / 'in.fq'
+    with open(fastq, 'w') as f:
+        for i in range(1000):
+            seq = ''.join(rng.choice('ACGT') for _ in range(60))
+            f.write(f'@read{i}\n{seq}\n+\n{"I" * len(seq)}\n')
+    outputs = []
+    for threads in [1, 2]:
+        output = tmp_path / f'out{threads}.fq.gz'
+        truncate(str(fastq), str(tmp_path / f'qc{threads}'), 'x', '^GATC',
+                 output=str(output), threads=threads, compression='bgzf')
+        outputs.append(output.read_bytes())
+    assert outputs[0] == outputs[1]
+    assert outputs[0].endswith(BGZF_EOF)
+    with gzip.open(tmp_path / 'out1.fq.gz', 'rt') as f:
+        assert f.read().count('\n') == 4000
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+import pytest
+
+import pyHiCTools.decay
+from pyHiCTools.decay import decay, Decay, DecayWriter
+from pyHiCTools.process import process_batch
+from test_process import random_pairs, digest
+
+
+def test_add():
+    summary = Decay()
+    summary.add(
+        ['chr1', 'chr1', 'chr1', 'chr2'], ['chr1', 'chr1', 'chr2', 'chr3'],
+        [{'or:Z': 'Inward', 'it:Z': 'cis', 'is:i': 150},
+         {'or:Z': 'Inward', 'it:Z': 'cis', 'is:i': 5000},
+         {'or:Z': 'Outward', 'it:Z': 'trans', 'is:i': 0},
+         {'or:Z': 'Inward', 'it:Z': 'trans', 'is:i': 0}])
+    assert summary.cis['chr1'].sum() == 2
+    assert summary.trans['chr1'].tolist() == [0, 0, 1, 0]
+    assert summary.trans['chr2'].tolist() == [0, 1, 1, 0]
+    assert summary.trans['chr3'].tolist() == [0, 1, 0, 0]
+    rows = [row.split('\t') for row in summary.rows('x')]
+    assert [row[1:3] for row in rows] == [
+        ['chr1', 'cis'], ['chr1', 'cis'], ['chr1', 'trans'],
+        ['chr2', 'trans'], ['chr2', 'trans'], ['chr3', 'trans']]
+    assert sum(float(row[7]) * (int(row[5]) - int(row[4]) + 1)
+               for row in rows[:2]) == pytest.approx(1)
+
+
+def test_decay_threads(tmp_path, digest, capsys):
+    path = tmp_path / 'in.sam'
+    path.write_text(process_batch(random_pairs(500), digest))
+    tables = []
+    for threads in (1, 2):
+        decay(str(path), sample='x', threads=threads)
+        tables.append(capsys.readouterr().out)
+    assert tables[0] == tables[1]
+    # Trans pairs are counted for both chromosomes.
+    rows = [row.split('\t') for row in tables[0].splitlines()[1:]]
+    assert sum(int(row[6]) if row[2] == 'cis' else int(row[6]) / 2
+               for row in rows) == 500
+
+
+def test_decay_writer(tmp_path, digest, monkeypatch):
+    monkeypatch.setattr(pyHiCTools.decay, 'CHUNK_SIZE', 100)
+    adds = []
+    add = Decay.add
+
+    def counted_add(self, chroms1, chroms2, tags):
+        if tags:
+            adds.append(len(tags))
+        return add(self, chroms1, chroms2, tags)
+
+    monkeypatch.setattr(Decay, 'add', counted_add)
+    lines = process_batch(random_pairs(500), digest).splitlines(True)
+    whole = DecayWriter(str(tmp_path / 'whole'), 'x')
+    whole.add_sam(''.join(lines))
+    whole.close()
+    # Pairs added one by one are summarised in chunks.
+    adds.clear()
+    single = DecayWriter(str(tmp_path / 'single'), 'x')
+    for i in range(0, len(lines), 2):
+        single.add_sam(''.join(lines[i: i + 2]))
+    single.close()
+    assert adds == [100] * 5
+    assert ((tmp_path / 'single').read_text()
+            == (tmp_path / 'whole').read_text())
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import random
+import pytest
+import numpy as np
+import pyCommonTools as pct
+
+import pyHiCTools.deduplicate
+from pyHiCTools.deduplicate import deduplicate, KeySet, pair_hashes, MAX_KEYS
+from pyHiCTools.process import parse_batch
+from test_process import random_pairs
+
+
+def expected_duplicates(lines):
+    seen = set()
+    duplicate = []
+    for line1, line2 in zip(lines[0::2], lines[1::2]):
+        ends = []
+        for read in (pct.Sam(line1), pct.Sam(line2)):
+            ends.append((read.rname, read.five_prime_pos, read.is_reverse))
+        key = tuple(sorted(ends))
+        duplicate.append(key in seen)
+        seen.add(key)
+    return duplicate
+
+
+def with_duplicates(n, seed=42):
+    rng = random.Random(seed)
+    lines = random_pairs(n, seed)
+    pairs = [tuple(lines[i: i + 2]) for i in range(0, len(lines), 2)]
+    for _ in range(n // 2):
+        pair = rng.choice(pairs)
+        # Mate order does not affect duplicate status.
+        pairs.insert(rng.randrange(len(pairs)),
+                     pair[::-1] if rng.random() < 0.5 else pair)
+    return [line for pair in pairs for line in pair]
+
+
+def test_pair_hashes_mate_order():
+    lines = random_pairs(100)
+    swapped = [line for i in range(0, len(lines), 2)
+               for line in (lines[i + 1], lines[i])]
+    assert np.array_equal(pair_hashes(parse_batch(lines)),
+                          pair_hashes(parse_batch(swapped)))
+
+
+@pytest.mark.parametrize('max_keys', [10000, 150, 1])
+def test_keyset(tmp_path, max_keys):
+    lines = with_duplicates(400)
+    keys = KeySet(max_keys, str(tmp_path))
+    duplicate = []
+    for i in range(0, len(lines), 100):
+        batch = keys.add(pair_hashes(parse_batch(lines[i: i + 100])))
+        if batch is not None:
+            duplicate.extend(batch.tolist())
+    if keys.spooled:
+        duplicate.extend(keys.spooled_duplicates().tolist())
+    assert duplicate == expected_duplicates(lines)
+    assert keys.counts['duplicate'] == sum(duplicate)
+
+
+def test_deduplicate_threads(tmp_path, capsys):
+    # Input is read by a single consumer when chunks are prefetched.
+    path = tmp_path / 'in.sam'
+    path.write_text('@HD\tVN:1.6\n' + ''.join(with_duplicates(5000)))
+    outputs = []
+    for threads in (1, 2):
+        qc = tmp_path / f'{threads}.qc'
+        deduplicate(str(path), str(qc), 'x', threads=threads)
+        outputs.append((capsys.readouterr().out, qc.read_text()))
+    assert outputs[0] == outputs[1]
+    assert outputs[0][0].startswith('@HD')
+
+
+@pytest.mark.parametrize('threads', [1, 2])
+@pytest.mark.parametrize('max_keys', [MAX_KEYS, 150])
+def test_deduplicate(tmp_path, capsys, monkeypatch, threads, max_keys):
+    monkeypatch.setattr(pyHiCTools.deduplicate, 'CHUNK_SIZE', 100)
+    lines = with_duplicates(400)
+    path = tmp_path / 'in.sam'
+    path.write_text('@HD\tVN:1.6\n' + ''.join(lines))
+    qc = tmp_path / 'qc'
+    deduplicate(str(path), str(qc), 'x', max_keys=max_keys,
+                threads=threads)
+    duplicate = expected_duplicates(lines)
+    expected = [line for i, is_duplicate in enumerate(duplicate)
+                if not is_duplicate for line in lines[2 * i: 2 * i + 2]]
+    assert capsys.readouterr().out == '@HD\tVN:1.6\n' + ''.join(expected)
+    rows = dict(row.split('\t')[1:] for row in qc.read_text().splitlines())
+    assert int(rows['Duplicate']) == sum(duplicate) > 0
+    assert int(rows['Total']) == len(duplicate)
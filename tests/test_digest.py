@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+import pytest
+
+from pyHiCTools.digest import (
+    digest, find_cut_sites, digest_lines, CutSiteScanner)
+from pyHiCTools.digest_index import read_index
+
+
+@pytest.mark.parametrize(
+    'seq,          restriction', [
+    ('AGATCTTGATCGATCAAAGATC', '^GATC'),
+    ('GATCAAGATCTGATCTAGATCT', 'A^GATCT'),
+    ('AAAAAAAAAA',             'AA^A')])
+@pytest.mark.parametrize('chunk_size', [1, 3, 5, 100])
+def test_chunked_scan(capsys, seq, restriction, chunk_size):
+
+    # Whole sequence digest
+    find_cut_sites(seq, 'chr1', restriction)
+    expected, _ = capsys.readouterr()
+
+    # Chunked digest must find sites spanning chunk boundaries
+    scanner = CutSiteScanner(restriction)
+    for i in range(0, len(seq), chunk_size):
+        scanner.feed(seq[i:i + chunk_size])
+    assert scanner.finish('chr1') is None
+    assert ''.join(digest_lines('chr1', scanner.ends)) == expected
+    assert ''.join(digest_lines('chr1', scanner.ends, 2)) == expected
+
+
+@pytest.mark.parametrize('threads', [1, 2])
+def test_digest_index(tmp_path, capsys, threads):
+    fasta = tmp_path / 'ref.fa'
+    fasta.write_text('>chr1\nAAGATCAAAAAGATCAA\nAAGATC\n>bad\nAXA\n'
+                     '>chr2\nCCCC\n')
+    digest(str(fasta), '^GATC', threads)
+    expected = capsys.readouterr().out
+    index = tmp_path / 'ref.pht'
+    digest(str(fasta), '^GATC', threads, index=str(index))
+    assert capsys.readouterr().out == expected
+    d = read_index(str(index))
+    assert list(d) == ['chr1', 'chr2']
+    assert d['chr1'].tolist() == [2, 11, 19, 23]
+    assert d['chr2'].tolist() == [4]
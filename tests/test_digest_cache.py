@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+import os
+import pytest
+
+import pyHiCTools.digest_cache
+from pyHiCTools.digest_cache import cached_digest, evict
+from pyHiCTools.digest_index import load_digest
+
+
+@pytest.fixture
+def reference(tmp_path):
+    path = tmp_path / 'ref.fa'
+    path.write_text('>chr1\nAAGATCAAAAAGATCAA\nAAGATC\n>chr2\nCCCC\n')
+    return str(path)
+
+
+def test_cached_digest(tmp_path, reference, monkeypatch):
+    cache = str(tmp_path / 'cache')
+    path = cached_digest(reference, '^GATC', 1, cache, 1)
+    d = load_digest(path)
+    assert d['chr1'].tolist() == [2, 11, 19, 23]
+    assert d['chr2'].tolist() == [4]
+
+    # Later runs, by path or by content, load the cached index.
+    monkeypatch.setattr(pyHiCTools.digest_cache, 'digest_reference', None)
+    assert cached_digest(reference, '^GATC', 1, cache, 1) == path
+    copy = tmp_path / 'copy.fa'
+    copy.write_text(open(reference).read())
+    assert cached_digest(str(copy), '^GATC', 1, cache, 1) == path
+
+
+def test_evict(tmp_path):
+    paths = [tmp_path / f'{i}.pht' for i in range(4)]
+    for i, path in enumerate(paths):
+        path.write_bytes(b'x' * 400000)
+        os.utime(path, (i, i))
+    evict(str(tmp_path), 1, keep=str(paths[0]))
+    assert [path.exists() for path in paths] == [True, False, False, True]
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import os
+import glob
+import pytest
+import numpy as np
+
+import pyHiCTools.digest_index
+from pyHiCTools.digest_index import (
+    write_index, read_index, read_header, is_index, load_digest,
+    find_cached_index, source_stat)
+
+
+@pytest.fixture
+def digest(tmp_path):
+    path = tmp_path / 'digest.txt'
+    path.write_text('chr1\t1\t10\t1\nchr1\t11\t25\t2\nchr2\t1\t7\t1\n')
+    return str(path)
+
+
+@pytest.mark.parametrize('ends, dtype', [
+    ([10, 25, 4000000000], '<u4'),
+    ([10, 25, 5000000000], '<i8')])
+def test_index(tmp_path, ends, dtype):
+    path = str(tmp_path / 'index.pht')
+    write_index(path, {'chr1': ends, 'chr2': [7], 'chr3': []})
+    assert is_index(path)
+    d = read_index(path)
+    assert list(d) == ['chr1', 'chr2', 'chr3']
+    assert d['chr1'].dtype == np.dtype(dtype)
+    assert d['chr1'].tolist() == ends
+    assert d['chr2'].tolist() == [7]
+    assert d['chr3'].tolist() == []
+    assert not d['chr1'].flags.writeable
+
+
+def test_load_digest_cache(digest, monkeypatch):
+    assert not is_index(digest)
+    d = load_digest(digest)
+    assert d['chr1'].tolist() == [10, 25]
+    assert d['chr2'].tolist() == [7]
+    cache = find_cached_index(digest)
+    assert cache and is_index(cache)
+
+    # Unchanged size and mtime reuse the cache without parsing or hashing.
+    monkeypatch.setattr(pyHiCTools.digest_index, 'process_digest', None)
+    monkeypatch.setattr(pyHiCTools.digest_index, 'file_hash', None)
+    assert load_digest(digest)['chr1'].tolist() == [10, 25]
+
+
+def test_load_digest_touched(digest, monkeypatch):
+    load_digest(digest)
+    cache = find_cached_index(digest)
+    # New mtime but same content still finds the cache by hash.
+    os.utime(digest, (0, 0))
+    monkeypatch.setattr(pyHiCTools.digest_index, 'process_digest', None)
+    assert find_cached_index(digest) == cache
+    # The new mtime is recorded so later runs do not rehash.
+    assert read_header(cache)[0]['source'] == source_stat(digest)
+    monkeypatch.setattr(pyHiCTools.digest_index, 'file_hash', None)
+    assert load_digest(digest)['chr2'].tolist() == [7]
+
+
+def test_load_digest_rebuild(digest):
+    load_digest(digest)
+    old = find_cached_index(digest)
+    with open(digest, 'a') as f:
+        f.write('chr2\t8\t30\t2\n')
+    assert find_cached_index(digest) is None
+    d = load_digest(digest)
+    assert d['chr2'].tolist() == [7, 30]
+    # Stale index of the previous digest is removed.
+    assert glob.glob(f'{digest}.*.pht') == [find_cached_index(digest)]
+    assert not os.path.exists(old)
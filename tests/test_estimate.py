@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pytest
+
+from pyHiCTools.estimate import Sketch, limit_pairs, file_sketch
+from pyHiCTools.process import ORIENTATIONS, process_batch
+from test_process import random_pairs, digest
+
+
+def simulated_stats(pairs=200000, seed=0):
+
+    ''' Return stats with Inward pairs enriched below 1kb and Outward
+        pairs enriched below 5kb.
+    '''
+
+    rng = np.random.default_rng(seed)
+    insert_size = (10 ** rng.uniform(2, 7, pairs)).astype(np.int64)
+    orientation = rng.integers(0, 4, pairs)
+    # Enrich by converting same strand pairs, leaving other proportions.
+    same_forward = orientation == ORIENTATIONS.index('Same-forward')
+    same_reverse = orientation == ORIENTATIONS.index('Same-reverse')
+    orientation[same_reverse & (insert_size < 1000)
+                & (rng.random(pairs) < 0.5)] = ORIENTATIONS.index('Inward')
+    orientation[same_forward & (insert_size < 5000)
+                & (rng.random(pairs) < 0.5)] = ORIENTATIONS.index('Outward')
+    return {
+        'orientation': orientation.astype(np.uint8),
+        'interaction': np.zeros(pairs, dtype=np.uint8),
+        'insert_size': insert_size,
+        'ditag_length': rng.integers(100, 1000, pairs),
+    }
+
+
+def test_thresholds():
+    thresholds = Sketch().add(simulated_stats()).thresholds()
+    assert 800 <= thresholds['min_inward'] <= 1300
+    assert 4000 <= thresholds['min_outward'] <= 6500
+    assert thresholds['min_ditag'] <= 110
+    assert thresholds['max_ditag'] >= 990
+
+
+def test_merge_save(tmp_path):
+    stats = simulated_stats()
+    half = {column: values[::2] for column, values in stats.items()}
+    other = {column: values[1::2] for column, values in stats.items()}
+    Sketch().add(half).save(tmp_path / 'half.npz')
+    merged = Sketch.load(tmp_path / 'half.npz').merge(Sketch().add(other))
+    whole = Sketch().add(stats)
+    assert np.array_equal(merged.insert_size.counts, whole.insert_size.counts)
+    assert merged.thresholds() == whole.thresholds()
+
+
+def test_merge_different_bins():
+    with pytest.raises(ValueError):
+        Sketch().merge(Sketch(bins_per_decade=5))
+
+
+def test_limit_pairs():
+    chunks = [(True, ['@HD\n']), (False, list('aabbcc')),
+              (False, list('ddee'))]
+    assert list(limit_pairs(chunks, 4)) == [
+        (True, ['@HD\n']), (False, list('aabbcc')), (False, list('dd'))]
+
+
+@pytest.mark.parametrize('threads', [1, 2])
+def test_file_sketch(tmp_path, digest, threads):
+    path = tmp_path / 'in.sam'
+    path.write_text(process_batch(random_pairs(300), digest))
+    assert file_sketch(str(path), threads).pairs == 300
+    assert file_sketch(str(path), threads, max_pairs=120).pairs == 120
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import pytest
+import numpy as np
+
+from pyHiCTools.process import ORIENTATIONS, INTERACTIONS
+from pyHiCTools.expression import compile_clauses, first_failed
+
+
+@pytest.fixture
+def columns():
+    rng = np.random.default_rng(1)
+    n = 1000
+    return {
+        'ditag_length': rng.integers(0, 2000, n),
+        'insert_size': rng.integers(0, 5000, n),
+        'fragment_seperation': rng.integers(0, 10, n),
+        'read1_fragment': rng.integers(0, 100, n),
+        'orientation': rng.integers(0, len(ORIENTATIONS), n),
+        'interaction': rng.integers(0, len(INTERACTIONS), n),
+    }
+
+
+def reference(columns, i):
+    return {
+        'dt': columns['ditag_length'][i],
+        'is_': columns['insert_size'][i],
+        'fs': columns['fragment_seperation'][i],
+        'fn': columns['read1_fragment'][i],
+        'or_': ORIENTATIONS[columns['orientation'][i]],
+        'it': INTERACTIONS[columns['interaction'][i]],
+    }
+
+
+@pytest.mark.parametrize('expression, python', [
+    ("dt < 1000", "dt < 1000"),
+    ("100 <= dt <= 2 * 500", "100 <= dt <= 2 * 500"),
+    ("it == 'trans' or fs > 2", "it == 'trans' or fs > 2"),
+    ("or != 'Inward' or is - dt >= 1000",
+     "or_ != 'Inward' or is_ - dt >= 1000"),
+    ("not (fs == 0 and 'cis' == it)", "not (fs == 0 and 'cis' == it)"),
+    ("fn / 2 > -fs + 10", "fn / 2 > -fs + 10"),
+])
+def test_compile(columns, expression, python):
+    clauses = compile_clauses([expression])
+    assert len(clauses) == 1
+    result = clauses[0].predicate(columns)
+    for i in range(len(result)):
+        assert result[i] == eval(python, {}, reference(columns, i))
+
+
+def test_clauses(columns):
+    clauses = compile_clauses(
+        ["dt < 1000 and (it == 'cis' or fs < 5)", 'is > 100'])
+    assert [clause.text for clause in clauses] == [
+        'dt < 1000', "(it == 'cis' or fs < 5)", 'is > 100']
+    assert [clause.tags for clause in clauses] == [
+        ('dt:i',), ('it:Z', 'fs:i'), ('is:i',)]
+    reasons = first_failed(
+        clauses, columns, np.zeros(1000, dtype=np.int64), 1)
+    for i, reason in enumerate(reasons):
+        values = reference(columns, i)
+        failed = [not values['dt'] < 1000,
+                  not (values['it'] == 'cis' or values['fs'] < 5),
+                  not values['is_'] > 100]
+        expected = failed.index(True) + 1 if any(failed) else 0
+        assert reason == expected
+
+
+@pytest.mark.parametrize('expression', [
+    'dt <', 'dt', 'or == 1', "or == 'inward'", "dt > 'cis'", 'xy > 1',
+    'dt > 1)', '(dt > 1', 'dt > 1 and', 'dt ~ 1', "it < 'cis'"])
+def test_invalid(expression):
+    with pytest.raises(ValueError):
+        compile_clauses([expression])
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+
+import pytest
+
+import pyHiCTools.extract
+from pyHiCTools.extract import extract
+from pyHiCTools.process import process_batch
+from test_process import random_pairs, digest
+
+
+@pytest.mark.parametrize('output_format', ['tsv', 'summary'])
+def test_extract_threads(tmp_path, digest, monkeypatch, capsys,
+                         output_format):
+    monkeypatch.setattr(pyHiCTools.extract, 'CHUNK_SIZE', 50)
+    path = tmp_path / 'in.sam'
+    path.write_text('@HD\tVN:1.6\tSO:queryname\n'
+                    + process_batch(random_pairs(1000), digest))
+    outputs = []
+    for threads in [1, 2]:
+        extract(str(path), 'x', threads=threads,
+                output_format=output_format)
+        outputs.append(capsys.readouterr().out)
+    assert outputs[0] == outputs[1]
+    rows = [row.split('\t') for row in outputs[0].splitlines()[1:]]
+    pairs = len(rows) if output_format == 'tsv' else sum(
+        int(row[6]) for row in rows if row[1] == 'ditag_length')
+    assert pairs == 1000
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+import pytest
+
+import pyHiCTools.filter
+from pyHiCTools.process import batch_filter, parse_batch, process_batch
+from pyHiCTools.filter import (
+    filter, filter_reason, batch_filter_reasons, REASONS)
+from test_process import random_pairs, digest
+
+
+@pytest.mark.parametrize(
+    'min_inward, min_outward, min_ditag, max_ditag', [
+    (None,       None,        None,      300),
+    (100,        None,        50,        None),
+    (None,       200,         None,      None),
+    (100,        200,         50,        300)])
+def test_batch_filter_reasons(
+        digest, min_inward, min_outward, min_ditag, max_ditag):
+    lines = random_pairs(500)
+    thresholds = dict(min_inward=min_inward, min_outward=min_outward,
+                      min_ditag=min_ditag, max_ditag=max_ditag)
+    stats = batch_filter(parse_batch(lines), digest)
+    reasons = batch_filter_reasons(stats, **thresholds)
+    for i, reason in enumerate(reasons):
+        optional = {
+            'dt:i': stats['ditag_length'][i],
+            'is:i': stats['insert_size'][i],
+            'fs:i': stats['fragment_seperation'][i],
+            'or:Z': ['Same-forward', 'Inward', 'Outward',
+                     'Same-reverse'][stats['orientation'][i]],
+            'it:Z': ['cis', 'trans'][stats['interaction'][i]]}
+        expected = filter_reason(optional, **thresholds) or 'retained'
+        assert REASONS[reason] == expected
+
+
+@pytest.mark.parametrize('expr', [None, ['is > 200 or it == "trans"']])
+def test_filter_threads(tmp_path, digest, monkeypatch, capsys, expr):
+    monkeypatch.setattr(pyHiCTools.filter, 'CHUNK_SIZE', 50)
+    path = tmp_path / 'in.sam'
+    path.write_text('@HD\tVN:1.6\tSO:queryname\n'
+                    + process_batch(random_pairs(1000), digest))
+    outputs = []
+    for threads in [1, 2]:
+        qc = tmp_path / f'qc{threads}'
+        filter(str(path), str(qc), 'x', None, 100, None, 300,
+               threads=threads, expr=expr)
+        outputs.append((capsys.readouterr().out, qc.read_text()))
+    assert outputs[0] == outputs[1]
+    assert 0 < outputs[0][0].count('\n') - 1 < 2000
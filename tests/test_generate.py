@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import numpy as np
+import pyCommonTools as pct
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+import generate
+from pyHiCTools.digest import CutSiteScanner
+from pyHiCTools.process import process_batch, process_pair
+from pyHiCTools.truncate import LigationMatcher
+
+
+def test_generate_deterministic(tmp_path):
+    genome = generate.make_genome(20000)
+    assert genome == generate.make_genome(20000)
+    for i in range(2):
+        generate.write_sam(tmp_path / f'{i}.sam', genome, 100)
+    assert (tmp_path / '0.sam').read_text() == (tmp_path / '1.sam').read_text()
+
+
+def test_generated_sam_processes(tmp_path):
+    genome = generate.make_genome(20000)
+    digest = {}
+    for name, seq in genome.items():
+        scanner = CutSiteScanner('^GATC')
+        scanner.feed(seq)
+        scanner.finish(name)
+        digest[name] = np.array(scanner.ends, dtype=np.int64)
+    generate.write_sam(tmp_path / 'test.sam', genome, 200)
+    lines = [line for line in open(tmp_path / 'test.sam')
+             if not line.startswith('@')]
+    assert len(lines) == 400
+    expected = ''.join(
+        process_pair(pct.Sam(line1), pct.Sam(line2), digest)
+        for line1, line2 in zip(lines[0::2], lines[1::2]))
+    assert process_batch(lines, digest) == expected
+
+
+def test_generated_fastq_junctions(tmp_path):
+    genome = generate.make_genome(20000)
+    generate.write_fastq(tmp_path / 'test.fq', genome, 200)
+    lines = open(tmp_path / 'test.fq').read().splitlines(keepends=True)
+    truncated, counts = LigationMatcher(['^GATC']).truncate_block(lines)
+    assert counts['total'] == 200
+    assert counts['truncated'] >= 80
@@ -2,7 +2,8 @@
 
 import pytest, os
 
-from hictools.hictools_truncate import *
+from pyHiCTools.truncate import (
+    process_restriction, truncate, check_pairs, LigationMatcher)
 
 arguments = (
     [('^GATC',  ('GATCGATC', 'GATC')), 
@@ -22,12 +23,13 @@ def test_process_restriction(test_input, expected):
 @pytest.mark.parametrize(
      'test_in,     exp_out,        exp_err,        re', [
     ('test.txt',  'test_out.txt', 'test_err.txt', '^GATC')])
-def test_truncate(capsys, test_in, exp_out, exp_err, re):
-    
+def test_truncate(capsys, monkeypatch, test_in, exp_out, exp_err, re):
+
+    # Test files are relative to the tests directory.
+    monkeypatch.chdir(os.path.dirname(os.path.abspath(__file__)))
+
     # Tool to test
-    truncate(infile = test_in, output = None, 
-        read_gzip = False, write_gzip = False, 
-        sample = None, restriction = re)
+    truncate(infile = test_in, qc = None, sample = None, restriction = re)
     
     # Capture stdout and stderr
     out, err = capsys.readouterr()
@@ -35,3 +37,71 @@ def test_truncate(capsys, test_in, exp_out, exp_err, re):
     # Compare stdour and stderr against expected
     assert out == open(exp_out).read()
     assert err == open(exp_err).read()
+
+
+def test_longest_junction_first():
+    # AGATCGATC (BglII + DpnII) is a prefix of AGATCGATCT (BglII + BglII).
+    matcher = LigationMatcher(['^GATC', 'A^GATCT'])
+    start, index = matcher.search('TTAGATCGATCTAA')
+    assert start == 2
+    assert matcher.junctions[index][0] == 'AGATCGATCT'
+
+
+def test_iupac_truncation():
+    # HinfI junction GANTANTC; sequenced bases replace the N.
+    matcher = LigationMatcher(['G^ANTC'])
+    assert matcher.truncate('CCCGACTACTCAAA') == ('CCCGACTC', 0)
+    assert matcher.truncate('CCCGGGAAA') == ('CCCGGGAAA', None)
+
+
+@pytest.mark.parametrize('seq, expected, junction', [
+    ('TTGATCAGTCAA', 'TTGATC', 'GATCANTC'),
+    ('TTGAATGATCAA', 'TTGAATC', 'GANTGATC'),
+    ('TTGATCGATCAA', 'TTGATC', 'GATCGATC'),
+    ('TTGACTAATCAA', 'TTGACTC', 'GANTANTC')])
+def test_mixed_junctions(seq, expected, junction):
+    matcher = LigationMatcher(['^GATC', 'G^ANTC'])
+    truncated, index = matcher.truncate(seq)
+    assert truncated == expected
+    assert matcher.junctions[index][0] == junction
+
+
+def fastq(names, seq='ACGT'):
+    return [line for name in names
+            for line in (f'@{name} x\n', f'{seq}\n', '+\n',
+                         f'{"I" * len(seq)}\n')]
+
+
+@pytest.mark.parametrize('block1, block2', [
+    (fastq(['a/1', 'b/1']), fastq(['a/2', 'c/2'])),
+    (fastq(['a/1', 'b/1']), fastq(['a/2'])),
+    (fastq(['a/1']), None)])
+def test_check_pairs_invalid(block1, block2):
+    with pytest.raises(SystemExit):
+        check_pairs(block1, block2)
+
+
+def test_check_pairs():
+    block1, block2 = fastq(['a/1', 'b/1']), fastq(['a/2', 'b/2'])
+    assert check_pairs(block1, block2) == (block1, block2)
+
+
+def test_junction_qc(tmp_path, capsys):
+    r1 = tmp_path / 'r1.fq'
+    r2 = tmp_path / 'r2.fq'
+    r1.write_text(''.join(fastq(['a/1'], 'TTGATCAGTCAA')
+                          + fastq(['b/1'], 'TTGAATGATCAA')))
+    r2.write_text(''.join(fastq(['a/2'], 'CCCCCC')
+                          + fastq(['b/2'], 'TTGATCGATCAA')))
+    qc = tmp_path / 'qc'
+    truncate(str(r1), str(qc), 'x', ['^GATC', 'G^ANTC'], mate=str(r2),
+             output=str(tmp_path / 'o1.fq'),
+             mate_output=str(tmp_path / 'o2.fq'))
+    rows = dict(row.split('\t')[1:] for row in qc.read_text().splitlines())
+    assert rows['R1 Truncated'] == '2'
+    assert rows['R1 Truncated at GATCANTC'] == '1'
+    assert rows['R1 Truncated at GANTGATC'] == '1'
+    assert rows['R1 Truncated at GATCGATC'] == '0'
+    assert rows['R2 Not truncated'] == '1'
+    assert rows['R2 Truncated at GATCGATC'] == '1'
+    assert (tmp_path / 'o2.fq').read_text().splitlines()[5] == 'TTGATC'
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+from pyHiCTools.histogram import LogHistogram
+
+
+def test_log_histogram():
+    values = np.array([-5, 0, 1, 9, 10, 11, 999, 10**12])
+    hist = LogHistogram(bins_per_decade=1, decades=3)
+    hist.add(values)
+    intervals = hist.intervals()
+    counts = {intervals[b]: c for b, c in enumerate(hist.counts) if c}
+    assert counts == {
+        ('-inf', '0'): 2, ('1', '9'): 2, ('10', '99'): 2,
+        ('100', '999'): 1, ('1000', 'inf'): 1}
+
+
+def test_merge_groups():
+    hist1 = LogHistogram((2,))
+    hist2 = LogHistogram((2,))
+    hist1.add(np.array([5, 50]), np.array([0, 1]))
+    hist2.add(np.array([5]), np.array([1]))
+    merged = hist1.merge(hist2)
+    assert merged.counts[0].sum() == 1
+    assert merged.counts[1].sum() == 2
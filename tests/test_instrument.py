@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import collections
+import pytest
+
+from pyHiCTools import instrument
+from pyHiCTools.parallel import imap_chunks
+
+
+@pytest.fixture(autouse=True)
+def reset_state(monkeypatch):
+    monkeypatch.setitem(instrument.state, 'enabled', False)
+    monkeypatch.setitem(
+        instrument.state, 'stages', collections.defaultdict(float))
+    monkeypatch.setitem(instrument.state, 'calls', collections.Counter())
+    monkeypatch.setitem(instrument.state, 'records', 0)
+    monkeypatch.setitem(instrument.state, 'qc', {})
+
+
+def square(chunk):
+    return [x * x for x in chunk]
+
+
+def run(threads):
+    chunks = [list(range(i, i + 10)) for i in range(0, 100, 10)]
+    results = []
+    for result in imap_chunks(square, chunks, threads):
+        instrument.advance(len(result))
+        results.extend(result)
+    instrument.write_qc_rows(io.StringIO(), 'sample', [('Total', 100)])
+    return results
+
+
+@pytest.mark.parametrize('threads', [1, 2])
+def test_wrap_json(tmp_path, threads):
+    path = tmp_path / 'report.json'
+    results = instrument.wrap(run)(threads, json_file=str(path))
+    assert results == [x * x for x in range(100)]
+    report = json.loads(path.read_text())
+    assert report['command'] == 'run'
+    assert report['records'] == 100
+    assert report['qc'] == {'sample': {'Total': 100}}
+    assert report['stages']['square']['calls'] == 10
+    assert report['stages']['read']['calls'] == 11
+
+
+def test_disabled():
+    assert instrument.wrap(run)(1) == [x * x for x in range(100)]
+    assert not instrument.state['stages']
+    assert instrument.state['records'] == 0
+
+
+def test_write_qc_rows():
+    out = io.StringIO()
+    instrument.write_qc_rows(out, 'a', [('Total', 2), ('Retained', 1)])
+    assert out.getvalue() == 'a\tTotal\t2\na\tRetained\t1\n'
+    assert instrument.state['qc'] == {'a': {'Total': 2, 'Retained': 1}}
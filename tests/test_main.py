@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+import sys
+import importlib
+import subprocess
+import pytest
+
+from pyHiCTools.main import module_doc
+
+
+@pytest.mark.parametrize('module', [
+    'digest', 'truncate', 'process', 'extract', 'filter', 'deduplicate',
+    'estimate', 'decay', 'pipeline', 'batch', 'matrix', 'pairs_file',
+    'digest_cache'])
+def test_module_doc(module):
+    assert (module_doc(module)
+            == importlib.import_module(f'pyHiCTools.{module}').__doc__)
+
+
+def imported_modules(module):
+    code = (f'import sys, {module}; '
+            f'print(sorted(m for m in sys.modules '
+            f'if m.startswith("pyHiCTools.") or m == "numpy"))')
+    return subprocess.run(
+        [sys.executable, '-c', code], check=True,
+        capture_output=True, text=True).stdout
+
+
+def test_lazy_import():
+    modules = imported_modules('pyHiCTools.main')
+    assert 'numpy' not in modules
+    assert 'pyHiCTools.process' not in modules
+
+
+def test_filter_lazy_decay():
+    modules = imported_modules('pyHiCTools.filter')
+    assert 'pyHiCTools.decay' not in modules
+    assert 'pyHiCTools.histogram' not in modules
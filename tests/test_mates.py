@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+import random
+import pytest
+
+from pyHiCTools.mates import pair_mates
+from test_process import random_pairs
+
+
+@pytest.mark.parametrize('max_pending', [1000000, 50, 1])
+def test_pair_mates(max_pending):
+    lines = random_pairs(300)
+    shuffled = lines[:]
+    random.Random(1).shuffle(shuffled)
+    secondary = lines[0].split('\t')
+    secondary[1] = str(int(secondary[1]) | 0x100)
+    orphan = 'orphan' + lines[0][lines[0].find('\t'):]
+    header = ['@HD\tVN:1.6\n']
+    paired = list(pair_mates(
+        header + shuffled + ['\t'.join(secondary), orphan],
+        max_pending=max_pending))
+    assert paired[0] == header[0]
+    paired = paired[1:]
+    assert sorted(paired) == sorted(lines)
+    for line1, line2 in zip(paired[0::2], paired[1::2]):
+        assert line1.split('\t')[0] == line2.split('\t')[0]
+        # Mates are emitted in input order.
+        assert shuffled.index(line1) < shuffled.index(line2)
+
+
+def test_pair_mates_sorted():
+    lines = random_pairs(100)
+    assert list(pair_mates(lines, max_pending=1)) == lines
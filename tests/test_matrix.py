@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+import collections
+import numpy as np
+import pyCommonTools as pct
+
+from pyHiCTools import matrix
+from pyHiCTools.process import process_batch
+from test_process import random_pairs, digest
+
+
+CHROMS = [('chr1', 1000), ('chr2', 900)]
+
+
+def expected_counts(lines, resolution):
+    offsets = {'chr1': 0, 'chr2': -(-1000 // resolution)}
+    counts = collections.Counter()
+    for line1, line2 in zip(lines[0::2], lines[1::2]):
+        bins = []
+        for read in (pct.Sam(line1), pct.Sam(line2)):
+            bins.append(offsets[read.rname]
+                        + (read.five_prime_pos - 1) // resolution)
+        counts[(min(bins), max(bins))] += 1
+    return counts
+
+
+def test_matrix_counts(digest, monkeypatch):
+    monkeypatch.setattr(matrix, 'MERGE_SIZE', 50)
+    lines = process_batch(random_pairs(500), digest).splitlines(
+        keepends=True)
+    binnings = matrix.make_binnings(CHROMS, [100, 250])
+    matrix.set_worker(CHROMS, binnings)
+    chunks = (matrix.sam_chunk(lines[i: i + 100])
+              for i in range(0, len(lines), 100))
+    matrices = matrix.count_matrices(chunks, binnings)
+    for binning, (keys, counts) in zip(binnings, matrices):
+        bin1, bin2, indptr = matrix.pixels(keys, binning['nbins'])
+        assert dict(zip(zip(bin1.tolist(), bin2.tolist()), counts.tolist())) \
+            == expected_counts(lines, binning['resolution'])
+        assert np.array_equal(np.diff(indptr), np.bincount(
+            bin1, minlength=binning['nbins']))
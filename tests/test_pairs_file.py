@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import gzip
+import pytest
+
+from pyHiCTools import pairs_file
+from pyHiCTools.process import process_batch
+from test_process import random_pairs, digest
+
+
+@pytest.mark.parametrize('region, expected', [
+    ('chr1', ('chr1', 1, None)),
+    ('chr3:1-5Mb', ('chr3', 1, 5000000)),
+    ('chr2:1,000-2.5kb', ('chr2', 1000, 2500)),
+])
+def test_parse_region(region, expected):
+    assert pairs_file.parse_region(region) == expected
+
+
+@pytest.fixture
+def indexed_pairs(tmp_path, digest, monkeypatch):
+    monkeypatch.setattr(pairs_file, 'BLOCK_ROWS', 20)
+    path = str(tmp_path / 'test.pairs.gz')
+    header = '@SQ\tSN:chr1\tLN:1000\n@SQ\tSN:chr2\tLN:900\n'
+    with pairs_file.PairsWriter(path, buffer_rows=50) as writer:
+        writer.add_sam(header + process_batch(random_pairs(500), digest))
+        writer.close()
+    return path
+
+
+def test_pairs_sorted(indexed_pairs):
+    chroms = {'chr1': 0, 'chr2': 1}
+    rows = [line.split('\t') for line in gzip.open(indexed_pairs, 'rt')
+            if not line.startswith('#')]
+    keys = [(chroms[r[1]], chroms[r[3]], int(r[2]), int(r[4])) for r in rows]
+    assert len(rows) == 500
+    assert keys == sorted(keys)
+    # Upper triangle: end 1 is never after end 2.
+    assert all((c1, p1) <= (c2, p2) for c1, c2, p1, p2 in keys)
+
+
+@pytest.mark.parametrize('region1, region2', [
+    ('chr1:100-300', None),
+    ('chr1:100-300', 'chr2'),
+    ('chr2:500-600', 'chr1:1-400'),
+    ('chr2', 'chr2:200-250'),
+])
+def test_query(indexed_pairs, capsys, region1, region2):
+    regions = [pairs_file.parse_region(region1),
+               pairs_file.parse_region(region2) if region2
+               else pairs_file.Region(None, 1, None)]
+    expected = []
+    for line in gzip.open(indexed_pairs, 'rt'):
+        if line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        ends = [(fields[1], int(fields[2])), (fields[3], int(fields[4]))]
+        if ((pairs_file.in_region(regions[0], *ends[0])
+                and pairs_file.in_region(regions[1], *ends[1]))
+                or (pairs_file.in_region(regions[1], *ends[0])
+                    and pairs_file.in_region(regions[0], *ends[1]))):
+            expected.append(line)
+    pairs_file.query(indexed_pairs, region1, region2)
+    out = capsys.readouterr().out.splitlines(keepends=True)
+    assert [line for line in out if not line.startswith('#')] == expected
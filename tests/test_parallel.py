@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import io
+import sys
+import threading
+import pytest
+
+from pyHiCTools.parallel import imap_chunks, prefetch, Writer
+
+
+def square(chunk):
+    return [x * x for x in chunk]
+
+
+def test_prefetch():
+    assert list(prefetch(range(100), depth=2)) == list(range(100))
+
+
+def test_prefetch_error():
+    def items():
+        yield 1
+        sys.exit(1)
+    with pytest.raises(SystemExit):
+        list(prefetch(items()))
+
+
+def test_prefetch_close():
+    # Producer blocked on a full queue stops when the consumer does.
+    running = threading.active_count()
+    items = prefetch(iter(range(1000)), depth=1)
+    assert next(items) == 0
+    items.close()
+    assert threading.active_count() == running
+
+
+@pytest.mark.parametrize('threads', [1, 2])
+def test_imap_chunks(threads):
+    chunks = (list(range(i, i + 10)) for i in range(0, 100, 10))
+    results = [x for result in imap_chunks(square, chunks, threads)
+               for x in result]
+    assert results == [x * x for x in range(100)]
+
+
+class Output(io.StringIO):
+
+    def __init__(self, release=None):
+        super().__init__()
+        self.writes = 0
+        self.release = release
+
+    def write(self, data):
+        if self.release is not None:
+            # Hold the writer thread so that writes queue up.
+            self.release.wait()
+        self.writes += 1
+        return super().write(data)
+
+
+def test_writer():
+    release = threading.Event()
+    out = Output(release)
+    with Writer(out, depth=1000) as writer:
+        for i in range(1000):
+            writer.write(f'{i}\n')
+        release.set()
+    assert out.getvalue() == ''.join(f'{i}\n' for i in range(1000))
+    # Writes queued while the output was busy are joined into one.
+    assert out.writes <= 2
+
+
+def test_writer_error():
+    out = io.StringIO()
+    out.close()
+    writer = Writer(out, depth=1)
+    with pytest.raises(ValueError):
+        for i in range(100):
+            writer.write('x')
+        writer.close()
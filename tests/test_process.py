@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import json
+import random
+import pytest
+import numpy as np
+import pyCommonTools as pct
+
+from pyHiCTools import instrument
+from pyHiCTools.process import (
+    process, process_batch, process_pair, middle_pos)
+
+
+@pytest.fixture
+def digest():
+    return {
+        'chr1': np.array([100, 250, 400, 700, 1000], dtype=np.uint32),
+        'chr2': np.array([300, 600, 900], dtype=np.uint32)}
+
+
+def random_pairs(n, seed=42):
+    rng = random.Random(seed)
+    lines = []
+    for i in range(n):
+        for read in (0x40, 0x80):
+            ref = rng.choice(['chr1', 'chr2'])
+            pos = rng.randint(1, 800)
+            cigar = rng.choice(['50M', '10S40M', '20M5D30M', '20M2I28M'])
+            flag = 1 | read | (0x10 if rng.random() < 0.5 else 0)
+            lines.append(f'read{i}\t{flag}\t{ref}\t{pos}\t60\t{cigar}\t'
+                         f'=\t0\t0\t*\t*\tNM:i:0\n')
+    return lines
+
+
+def test_process_batch(digest):
+    lines = random_pairs(500)
+    expected = ''.join(
+        process_pair(pct.Sam(line1), pct.Sam(line2), digest)
+        for line1, line2 in zip(lines[0::2], lines[1::2]))
+    assert process_batch(lines, digest) == expected
+
+
+@pytest.mark.parametrize('left', range(1, 6))
+@pytest.mark.parametrize('right', range(5, 10))
+def test_middle_pos(left, right):
+    assert middle_pos(np.array([left]), np.array([right]))[0] == round(
+        (left + right) / 2)
+
+
+@pytest.mark.parametrize('batch_size', [None, 100])
+def test_process_records(tmp_path, monkeypatch, capsys, batch_size):
+    monkeypatch.setitem(instrument.state, 'records', 0)
+    digest = tmp_path / 'digest.txt'
+    digest.write_text('chr1\t1\t100\t1\nchr1\t101\t1000\t2\n'
+                      'chr2\t1\t300\t1\nchr2\t301\t900\t2\n')
+    sam = tmp_path / 'in.sam'
+    sam.write_text('@HD\tVN:1.6\tSO:queryname\n'
+                   + ''.join(random_pairs(500)))
+    report = tmp_path / 'report.json'
+    instrument.wrap(process)(str(sam), digest=str(digest),
+                             batch_size=batch_size, json_file=str(report))
+    assert json.loads(report.read_text())['records'] == 1000
+    out = capsys.readouterr().out.splitlines()
+    assert len(out) == 1001
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+
+import pytest
+import pyCommonTools as pct
+
+from pyHiCTools.reader import get_tags, read_batches
+
+
+line = ('read1\t99\tchr1\t100\t60\t50M\t=\t300\t250\t*\tdt:i:1\t'
+        'NM:i:0\tdt:i:250\tor:Z:Inward\tit:Z:cis\n')
+
+
+@pytest.mark.parametrize('tags', [['dt:i'], ['or:Z', 'it:Z'], ['it:Z']])
+def test_get_tags(tags):
+    read = pct.Sam(line)
+    assert get_tags(line, tags) == {tag: read.optional[tag] for tag in tags}
+
+
+def test_get_tags_missing():
+    with pytest.raises(KeyError):
+        get_tags(line, ['fs:i'])
+
+
+def test_read_batches_mismatch():
+    lines = [line, line.replace('read1', 'read2', 1)]
+    with pytest.raises(SystemExit):
+        list(read_batches(lines, 10))
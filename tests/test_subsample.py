@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+import pytest
+
+from pyHiCTools.reader import read_batches
+from pyHiCTools.truncate import read_blocks
+from pyHiCTools.subsample import Subsample
+
+
+NAMES = [f'SRR000001.{i}' for i in range(20000)]
+
+
+@pytest.mark.parametrize('fraction', [0.01, 0.5])
+def test_fraction(fraction):
+    kept = sum(map(Subsample(fraction, seed=1), NAMES))
+    assert abs(kept / len(NAMES) - fraction) < 0.01
+
+
+def test_seed():
+    kept1 = [name for name in NAMES if Subsample(0.5, seed=1)(name)]
+    kept2 = [name for name in NAMES if Subsample(0.5, seed=2)(name)]
+    assert kept1 == [name for name in NAMES if Subsample(0.5, seed=1)(name)]
+    assert 0.4 < len(set(kept1) & set(kept2)) / len(kept1) < 0.6
+
+
+def test_stages_agree():
+    keep = Subsample(0.2, seed=5)
+    names = NAMES[:500]
+    sam = ['@HD\tVN:1.6\n'] + [f'{name}\t{flag}\n' for name in names
+                                for flag in (65, 129)]
+    fastq = [line for name in names
+             for line in (f'@{name}/1 x\n', 'ACGT\n', '+\n', 'IIII\n')]
+    alignments = [line for is_header, lines in read_batches(sam, 50, keep)
+                  if not is_header for line in lines]
+    records = [line for block in read_blocks(fastq, 50, keep)
+               for line in block]
+    kept = [name for name in names if keep(name)]
+    assert [line.split('\t')[0] for line in alignments[::2]] == kept
+    assert [line.split('\t')[0] for line in alignments[1::2]] == kept
+    assert [line[1:].split('/')[0] for line in records[::4]] == kept